@@ -1,20 +1,120 @@
+import logging
+
 from aiogram import executor
 
 import middlewares
 import handlers
+from data import config
 from loader import dp
+from utils import metrics, pdf_engine
+from utils.job_queue import job_queue
+from utils.loop_monitor import loop_monitor
+from utils.sharding import start_sharded
 from utils.notify_admin import notify_on_startup
 from utils.set_bot_commands import set_default_commands
+from utils.soffice_pool import soffice_pool
+
+
+async def start_services(dispatcher):
+    """
+    Warms up the PDF engine, starts the LibreOffice instances (in the
+    background, the bot doesn't wait for them), starts the jobs
+    that were left in the queue, exposes the metrics and starts watching
+    the event loop.
+    (every worker of the sharded mode uses the next port for the metrics)
+    """
+    loop_monitor.start()
+    await metrics.start_server(
+        config.METRICS_HOST, config.METRICS_PORT and config.METRICS_PORT + config.SHARD
+    )
+    await pdf_engine.start()
+    soffice_pool.start()
+    await job_queue.start()
 
 
 async def on_startup(dispatcher):
     """
-    Sets default commands for the bot and notifies the admin of bot startup.
+    Sets default commands for the bot, starts the services and notifies
+    the admin of bot startup.
     """
     await set_default_commands(dispatcher)
+    await start_services(dispatcher)
     await notify_on_startup(dispatcher)
 
 
-if __name__ == "__main__":
-    executor.start_polling(dp, on_startup=on_startup)
+async def on_startup_polling(dispatcher):
+    """
+    Removes the webhook (if the bot was running in webhook mode before),
+    otherwise telegram doesn't give out the updates.
+    """
+    await dispatcher.bot.delete_webhook()
+    await on_startup(dispatcher)
+
+
+async def on_startup_webhook(dispatcher):
+    """
+    Tells telegram where to send the updates.
+    Only one instance of the bot may run at a time (they would share the
+    job queue, the states and the files of the users), use WORKERS to
+    handle more updates.
+    """
+    await dispatcher.bot.set_webhook(config.WEBHOOK_URL)
+    logging.info(f"Webhook set to {config.WEBHOOK_URL}")
+    await on_startup(dispatcher)
 
+
+async def on_startup_sharded(dispatcher):
+    """
+    The front process of the sharded mode only passes the updates on
+    (the ones it polls or the ones telegram sends to the webhook),
+    the services are started by the workers.
+    """
+    if config.MODE == "webhook":
+        await dispatcher.bot.set_webhook(config.WEBHOOK_URL)
+        logging.info(f"Webhook set to {config.WEBHOOK_URL}")
+    else:
+        await dispatcher.bot.delete_webhook()
+    await set_default_commands(dispatcher)
+    await notify_on_startup(dispatcher)
+
+
+async def on_shutdown(dispatcher):
+    """
+    Stops the running jobs (they'll run again after the restart),
+    the LibreOffice instances and the PDF engine workers.
+    (the webhook is not removed, so telegram keeps the updates
+    until the bot is back)
+    """
+    loop_monitor.stop()
+    await job_queue.close()
+    await metrics.stop_server()
+    await soffice_pool.close()
+    pdf_engine.shutdown()
+
+
+if __name__ == "__main__":
+    if config.WORKERS > 1:
+        start_sharded(
+            dp,
+            config.WORKERS,
+            on_startup=on_startup_sharded,
+            worker_startup=start_services,
+            worker_shutdown=on_shutdown,
+            # in webhook mode the front process runs the web server instead
+            webhook_path=config.WEBHOOK_PATH if config.MODE == "webhook" else None,
+            host=config.WEBAPP_HOST,
+            port=config.WEBAPP_PORT,
+        )
+    elif config.MODE == "webhook":
+        executor.start_webhook(
+            dp,
+            webhook_path=config.WEBHOOK_PATH,
+            on_startup=on_startup_webhook,
+            on_shutdown=on_shutdown,
+            host=config.WEBAPP_HOST,
+            port=config.WEBAPP_PORT,
+        )
+    else:
+        executor.start_polling(
+            dp, on_startup=on_startup_polling, on_shutdown=on_shutdown
+        )
@@ -0,0 +1,42 @@
+"""
+Compares two result files of benchmarks/run.py:
+
+    python -m benchmarks.compare old.json new.json
+
+Negative numbers are improvements (less time, memory or output).
+"""
+import json
+import sys
+
+
+def _delta(old, new) -> str:
+    if not old:
+        return "-"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def compare(old: dict, new: dict):
+    print(f"{old['commit']} -> {new['commit']}\n")
+    print(f"{'case':<32} {'time':>16} {'peak RSS':>16} {'output':>16}")
+
+    for name, result in new["cases"].items():
+        before = old["cases"].get(name)
+
+        if before is None or "skipped" in before or "skipped" in result:
+            print(f"{name:<32} {'(not in both runs)':>16}")
+            continue
+
+        print(
+            f"{name:<32}"
+            f" {_delta(before['seconds'], result['seconds']):>16}"
+            f" {_delta(before['peak_rss_mb'], result['peak_rss_mb']):>16}"
+            f" {_delta(before['output_bytes'], result['output_bytes']):>16}"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+
+    with open(sys.argv[1]) as old, open(sys.argv[2]) as new:
+        compare(json.load(old), json.load(new))
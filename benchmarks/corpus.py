@@ -0,0 +1,299 @@
+"""
+Generates the files the benchmarks run on. Everything is made from fixed
+seeds, so the same corpus comes out on every machine and every run
+(nothing is downloaded).
+
+    python -m benchmarks.corpus [directory]
+
+The corpus has:
+    text_<N>.pdf          N pages of text (1 to 2000 pages)
+    images_<N>.pdf        N pages with a different image on every page
+    shared_<N>.pdf        images_<N>.pdf with one resource dictionary (with
+                          all the images) shared by all the pages, like books
+    encrypted_<N>.pdf     text_<N>.pdf encrypted with PASSWORD
+    png_<N>/, jpg_<N>/    N images each (the PNGs have an alpha channel)
+    doc_<N>.docx          a Word document with N paragraphs
+"""
+import os
+import random
+import sys
+import zipfile
+import zlib
+from typing import List
+from unittest import mock
+
+from PIL import Image, ImageDraw
+from PyPDF2 import PdfFileReader, PdfFileWriter
+
+default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+PASSWORD = "benchmark"
+
+TEXT_PAGES = (1, 10, 100, 500, 2000)
+IMAGE_PAGES = (10, 100)
+SHARED_PAGES = (100,)
+ENCRYPTED_PAGES = (10, 100)
+IMAGE_SETS = (5, 20)
+DOCX_PARAGRAPHS = (50, 1000)
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+    "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo"
+).split()
+
+
+def _sentence(rng: random.Random, words: int = 12) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _image_bytes(rng: random.Random, width: int, height: int) -> bytes:
+    """
+    RGB pixels of a gradient with some noise, so that it doesn't compress
+    to nothing (like a scanned page or a photo).
+    """
+    red, green = rng.randrange(256), rng.randrange(256)
+    noise = bytes(rng.randrange(16) for _ in range(4096))
+
+    pixels = bytearray()
+    for y in range(height):
+        for x in range(width):
+            grain = noise[(x * 31 + y * 17) % len(noise)]
+            pixels += bytes(
+                ((red + x) % 256 ^ grain, (green + y) % 256 ^ grain, (x + y) % 256)
+            )
+
+    return bytes(pixels)
+
+
+def write_pdf(
+    path: str, pages: int, images: bool = False, shared: bool = False, seed: int = 0
+):
+    """
+    Writes a PDF by hand (PyPDF2 can't draw text or images), every page has
+    40 lines of text or a full page image with a caption.
+    shared: the pages inherit one resource dictionary from the page tree
+    """
+    rng = random.Random(seed)
+
+    # object number -> body (without the "n 0 obj" wrapper)
+    objects = {}
+
+    def stream(dictionary: str, data: bytes) -> bytes:
+        return b"<< %s /Length %d >>\nstream\n%s\nendstream" % (
+            dictionary.encode(),
+            len(data),
+            data,
+        )
+
+    # 1: catalog, 2: pages, 3: font, then 2 or 3 objects per page
+    per_page = 3 if images else 2
+    kids = [4 + index * per_page for index in range(pages)]
+
+    # the shared resources are the last object
+    shared_resources = 4 + pages * per_page
+    tree_resources = b" /Resources %d 0 R" % shared_resources if shared else b""
+
+    objects[1] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[2] = b"<< /Type /Pages /Kids [%s] /Count %d%s >>" % (
+        " ".join(f"{kid} 0 R" for kid in kids).encode(),
+        pages,
+        tree_resources,
+    )
+    objects[3] = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+
+    shared_images = []
+
+    for index, page in enumerate(kids):
+        content = page + 1
+        resources = "/Font << /F1 3 0 R >>"
+
+        lines = ["BT /F1 10 Tf 50 800 Td 12 TL"]
+
+        if images:
+            image = page + 2
+            resources += f" /XObject << /Im1 {image} 0 R >>"
+            shared_images.append(f"/Im{index + 1} {image} 0 R")
+
+            width, height = 300, 300
+            objects[image] = stream(
+                f"/Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                "/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode",
+                zlib.compress(_image_bytes(rng, width, height)),
+            )
+
+            lines.append(f"(Page {index + 1}: {_sentence(rng)}) Tj ET")
+            lines.append(f"q 495 0 0 700 50 60 cm /Im{index + 1 if shared else 1} Do Q")
+        else:
+            for _ in range(40):
+                lines.append(f"({_sentence(rng)}) '")
+            lines.append("ET")
+
+        objects[content] = stream("", "\n".join(lines).encode())
+        page_resources = b""
+        if not shared:
+            page_resources = b"/Resources << %s >> " % resources.encode()
+        objects[page] = (
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"%s/Contents %d 0 R >>" % (page_resources, content)
+        )
+
+    if shared:
+        objects[shared_resources] = (
+            b"<< /Font << /F1 3 0 R >> /XObject << %s >> >>"
+            % " ".join(shared_images).encode()
+        )
+
+    with open(path, "wb") as pdf:
+        pdf.write(b"%PDF-1.4\n")
+
+        offsets = {}
+        for number in sorted(objects):
+            offsets[number] = pdf.tell()
+            pdf.write(b"%d 0 obj\n%s\nendobj\n" % (number, objects[number]))
+
+        xref = pdf.tell()
+        count = max(objects) + 1
+
+        pdf.write(b"xref\n0 %d\n0000000000 65535 f \n" % count)
+        for number in range(1, count):
+            pdf.write(b"%010d 00000 n \n" % offsets[number])
+
+        pdf.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (count, xref)
+        )
+
+
+def write_encrypted(source: str, path: str):
+    reader = PdfFileReader(source)
+    writer = PdfFileWriter()
+    writer.appendPagesFromReader(reader)
+
+    # PyPDF2 makes the file ID out of the current time and a random number,
+    # and the key depends on it
+    with mock.patch("time.time", return_value=0), mock.patch(
+        "random.random", return_value=0.5
+    ):
+        writer.encrypt(PASSWORD)
+
+    with open(path, "wb") as result:
+        writer.write(result)
+
+
+def write_images(directory: str, count: int, extension: str, seed: int = 0):
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+
+    for index in range(count):
+        mode = "RGBA" if extension == "png" else "RGB"
+        image = Image.new(mode, (1200, 900), (255, 255, 255, 0)[: len(mode)])
+        draw = ImageDraw.Draw(image)
+
+        for _ in range(60):
+            x, y = rng.randrange(1200), rng.randrange(900)
+            color = tuple(rng.randrange(256) for _ in range(len(mode)))
+            draw.rectangle((x, y, x + rng.randrange(400), y + rng.randrange(300)), fill=color)
+
+        # the names sort the same way as the bot names the images it gets
+        image.save(os.path.join(directory, f"{index:03d}.{extension}"))
+
+
+def write_docx(path: str, paragraphs: int, seed: int = 0):
+    """The smallest Word document LibreOffice accepts."""
+    rng = random.Random(seed)
+
+    body = "".join(
+        f"<w:p><w:r><w:t>{_sentence(rng, 40)}</w:t></w:r></w:p>"
+        for _ in range(paragraphs)
+    )
+
+    files = {
+        "[Content_Types].xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" '
+            'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            "</Types>"
+        ),
+        "_rels/.rels": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+            'officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>'
+            "</Relationships>"
+        ),
+        "word/document.xml": (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/'
+            'wordprocessingml/2006/main">'
+            f"<w:body>{body}</w:body></w:document>"
+        ),
+    }
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as docx:
+        for name, content in files.items():
+            # a fixed date, otherwise the zip is different every time
+            docx.writestr(zipfile.ZipInfo(name, (1980, 1, 1, 0, 0, 0)), content)
+
+
+def build(path: str = default_path) -> List[str]:
+    """Generates the files that are missing and returns their names."""
+    os.makedirs(path, exist_ok=True)
+    made = []
+
+    def missing(name: str) -> bool:
+        if os.path.exists(os.path.join(path, name)):
+            return False
+        made.append(name)
+        return True
+
+    for pages in TEXT_PAGES:
+        if missing(f"text_{pages}.pdf"):
+            write_pdf(os.path.join(path, f"text_{pages}.pdf"), pages, seed=pages)
+
+    for pages in IMAGE_PAGES:
+        if missing(f"images_{pages}.pdf"):
+            write_pdf(
+                os.path.join(path, f"images_{pages}.pdf"), pages, images=True, seed=pages
+            )
+
+    for pages in SHARED_PAGES:
+        if missing(f"shared_{pages}.pdf"):
+            write_pdf(
+                os.path.join(path, f"shared_{pages}.pdf"),
+                pages,
+                images=True,
+                shared=True,
+                seed=pages,
+            )
+
+    for pages in ENCRYPTED_PAGES:
+        if missing(f"encrypted_{pages}.pdf"):
+            write_encrypted(
+                os.path.join(path, f"text_{pages}.pdf"),
+                os.path.join(path, f"encrypted_{pages}.pdf"),
+            )
+
+    for count in IMAGE_SETS:
+        for extension in ("png", "jpg"):
+            if missing(f"{extension}_{count}"):
+                write_images(
+                    os.path.join(path, f"{extension}_{count}"), count, extension, seed=count
+                )
+
+    for paragraphs in DOCX_PARAGRAPHS:
+        if missing(f"doc_{paragraphs}.docx"):
+            write_docx(
+                os.path.join(path, f"doc_{paragraphs}.docx"), paragraphs, seed=paragraphs
+            )
+
+    return made
+
+
+if __name__ == "__main__":
+    made = build(sys.argv[1] if len(sys.argv) > 1 else default_path)
+    print(f"Generated {len(made)} files")
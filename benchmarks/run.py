@@ -0,0 +1,386 @@
+"""
+Runs the operations behind the handlers (merging, extracting pages,
+encrypting, decrypting, compressing, converting images and Word files) on
+the generated corpus, without the bot around them.
+
+    python -m benchmarks.run [--repeat 3] [--only merge] [--out results.json]
+
+Every run of a case happens in a fresh process, so the peak memory of one
+case doesn't leak into the next one. For every case the wall time (the
+median of the runs), the peak RSS and the size of the output are saved to
+benchmarks/results/<date>-<commit>.json. Compare two of them with
+benchmarks/compare.py.
+
+Cases that need gs or soffice are skipped if those aren't installed.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import partial
+from multiprocessing import get_context
+from typing import Callable, List, Optional
+
+# the benchmarks import the same code the bot runs
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import corpus  # noqa: E402
+from utils.ghostscript import compress_args  # noqa: E402
+from utils.pdf_ops import (  # noqa: E402
+    BurstJob,
+    DecryptJob,
+    EncryptJob,
+    ExtractJob,
+    ImagesJob,
+    MergeJob,
+)
+
+results_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+@dataclass
+class Case:
+    name: str
+    # called with the corpus directory and a scratch directory,
+    # returns the path of the output
+    run: Callable[[str, str], str]
+    # an executable the case needs
+    requires: Optional[str] = None
+    tags: List[str] = field(default_factory=list)
+
+
+def merge(
+    corpus_path: str, work: str, files: List[str], compact: bool = False
+) -> str:
+    output = os.path.join(work, "merged.pdf")
+    MergeJob(
+        [os.path.join(corpus_path, file) for file in files], output, compact
+    ).run()
+    return output
+
+
+def extract(
+    corpus_path: str, work: str, file: str, pages, compact: bool = False
+) -> str:
+    output = os.path.join(work, "extracted.pdf")
+    ExtractJob(os.path.join(corpus_path, file), pages, output, compact).run()
+    return output
+
+
+def burst(corpus_path: str, work: str, file: str, mode: str, value) -> str:
+    output = os.path.join(work, "split.zip")
+    BurstJob(os.path.join(corpus_path, file), mode, value, output).run()
+    return output
+
+
+def encrypt(corpus_path: str, work: str, file: str, compact: bool = False) -> str:
+    output = os.path.join(work, "encrypted.pdf")
+    EncryptJob(
+        os.path.join(corpus_path, file), corpus.PASSWORD, output, compact
+    ).run()
+    return output
+
+
+def decrypt(corpus_path: str, work: str, file: str, compact: bool = False) -> str:
+    output = os.path.join(work, "decrypted.pdf")
+    DecryptJob(
+        os.path.join(corpus_path, file), corpus.PASSWORD, output, compact
+    ).run()
+    return output
+
+
+def compress(corpus_path: str, work: str, file: str) -> str:
+    output = os.path.join(work, "compressed.pdf")
+    subprocess.run(
+        ["gs", *compress_args(os.path.join(corpus_path, file), output)], check=True
+    )
+    return output
+
+
+def images(corpus_path: str, work: str, directory: str) -> str:
+    # the flattened PNGs are written next to the originals,
+    # so the images are copied first (like the bot downloads them)
+    source = os.path.join(corpus_path, directory)
+    copies = []
+    for name in sorted(os.listdir(source)):
+        copies.append(shutil.copy(os.path.join(source, name), work))
+
+    output = os.path.join(work, "images.pdf")
+    ImagesJob(copies, output).run()
+    return output
+
+
+def word(corpus_path: str, work: str, file: str) -> str:
+    # the bot keeps soffice running (utils/soffice_pool.py), this also
+    # measures starting it, which is what the pool saves
+    subprocess.run(
+        [
+            "soffice",
+            f"-env:UserInstallation=file://{work}/profile",
+            "--headless",
+            "--convert-to",
+            "pdf",
+            "--outdir",
+            work,
+            os.path.join(corpus_path, file),
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return os.path.join(work, os.path.splitext(file)[0] + ".pdf")
+
+
+CASES: List[Case] = [
+    Case("merge_text_10x10", partial(merge, files=["text_10.pdf"] * 10), tags=["merge"]),
+    Case(
+        "merge_text_100_500_2000",
+        partial(merge, files=["text_100.pdf", "text_500.pdf", "text_2000.pdf"]),
+        tags=["merge"],
+    ),
+    Case(
+        "merge_images_10_100",
+        partial(merge, files=["images_10.pdf", "images_100.pdf"]),
+        tags=["merge"],
+    ),
+    # the peak memory should stay about the same as for a single input
+    Case(
+        "merge_images_100x20",
+        partial(merge, files=["images_100.pdf"] * 20),
+        tags=["merge"],
+    ),
+    Case(
+        "extract_text_2000_first",
+        partial(extract, file="text_2000.pdf", pages=[1]),
+        tags=["extract"],
+    ),
+    Case(
+        "extract_text_2000_ranges",
+        partial(extract, file="text_2000.pdf", pages=[(1, 100), 500, (1900, 2000)]),
+        tags=["extract"],
+    ),
+    Case(
+        "extract_images_100_half",
+        partial(extract, file="images_100.pdf", pages=[(1, 50)]),
+        tags=["extract"],
+    ),
+    # a page of a book that shares its resources between the pages
+    Case(
+        "extract_shared_100_one",
+        partial(extract, file="shared_100.pdf", pages=[50]),
+        tags=["extract"],
+    ),
+    Case(
+        "burst_text_2000_every_10",
+        partial(burst, file="text_2000.pdf", mode="every", value=10),
+        tags=["split"],
+    ),
+    Case(
+        "burst_images_100_parts_4",
+        partial(burst, file="images_100.pdf", mode="parts", value=4),
+        tags=["split"],
+    ),
+    Case(
+        "burst_shared_100_every_10",
+        partial(burst, file="shared_100.pdf", mode="every", value=10),
+        tags=["split"],
+    ),
+    Case("encrypt_text_500", partial(encrypt, file="text_500.pdf"), tags=["encrypt"]),
+    # PyPDF2 encrypts in pure python, 100 image pages take minutes
+    Case("encrypt_images_10", partial(encrypt, file="images_10.pdf"), tags=["encrypt"]),
+    Case("decrypt_10", partial(decrypt, file="encrypted_10.pdf"), tags=["decrypt"]),
+    Case("decrypt_100", partial(decrypt, file="encrypted_100.pdf"), tags=["decrypt"]),
+    # the same as above, written compactly (compare the output sizes)
+    Case(
+        "merge_text_100_500_2000_compact",
+        partial(
+            merge, files=["text_100.pdf", "text_500.pdf", "text_2000.pdf"], compact=True
+        ),
+        tags=["merge", "compact"],
+    ),
+    Case(
+        "merge_images_10_100_compact",
+        partial(merge, files=["images_10.pdf", "images_100.pdf"], compact=True),
+        tags=["merge", "compact"],
+    ),
+    Case(
+        "extract_text_2000_ranges_compact",
+        partial(
+            extract,
+            file="text_2000.pdf",
+            pages=[(1, 100), 500, (1900, 2000)],
+            compact=True,
+        ),
+        tags=["extract", "compact"],
+    ),
+    Case(
+        "encrypt_text_500_compact",
+        partial(encrypt, file="text_500.pdf", compact=True),
+        tags=["encrypt", "compact"],
+    ),
+    Case(
+        "decrypt_100_compact",
+        partial(decrypt, file="encrypted_100.pdf", compact=True),
+        tags=["decrypt", "compact"],
+    ),
+    Case(
+        "compress_text_100",
+        partial(compress, file="text_100.pdf"),
+        requires="gs",
+        tags=["compress"],
+    ),
+    Case(
+        "compress_images_100",
+        partial(compress, file="images_100.pdf"),
+        requires="gs",
+        tags=["compress"],
+    ),
+    Case("images_png_5", partial(images, directory="png_5"), tags=["images"]),
+    Case("images_png_20", partial(images, directory="png_20"), tags=["images"]),
+    Case("images_jpg_20", partial(images, directory="jpg_20"), tags=["images"]),
+    Case(
+        "word_50", partial(word, file="doc_50.docx"), requires="soffice", tags=["word"]
+    ),
+    Case(
+        "word_1000",
+        partial(word, file="doc_1000.docx"),
+        requires="soffice",
+        tags=["word"],
+    ),
+]
+
+
+def _size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+    return os.path.getsize(path)
+
+
+def _measure(name: str, corpus_path: str) -> dict:
+    """Runs a single case (in a fresh worker process)."""
+    case = next(case for case in CASES if case.name == name)
+
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as work:
+        start = time.perf_counter()
+        output = case.run(corpus_path, work)
+        seconds = time.perf_counter() - start
+
+        output_bytes = _size(output)
+
+    # gs and soffice are child processes, their memory counts too
+    # (ru_maxrss is in kilobytes on linux)
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+    return {"seconds": seconds, "peak_rss_mb": peak / 1024, "output_bytes": output_bytes}
+
+
+def run_case(case: Case, corpus_path: str, repeat: int) -> dict:
+    if case.requires and shutil.which(case.requires) is None:
+        return {"skipped": f"{case.requires} is not installed"}
+
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            runs.append(executor.submit(_measure, case.name, corpus_path).result())
+
+    return {
+        "seconds": statistics.median(run["seconds"] for run in runs),
+        "runs": [round(run["seconds"], 4) for run in runs],
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "output_bytes": runs[-1]["output_bytes"],
+    }
+
+
+def _commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return f"{commit}-dirty" if dirty else commit
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--corpus", default=corpus.default_path)
+    parser.add_argument("--out", help="where to save the results")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--only",
+        action="append",
+        help="run only the cases with this name or tag (can be repeated)",
+    )
+    args = parser.parse_args(argv)
+
+    made = corpus.build(args.corpus)
+    if made:
+        print(f"Generated {len(made)} corpus files in {args.corpus}")
+
+    cases = [
+        case
+        for case in CASES
+        if not args.only or case.name in args.only or set(case.tags) & set(args.only)
+    ]
+
+    commit = _commit()
+    results = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cases": {},
+    }
+
+    for case in cases:
+        result = run_case(case, args.corpus, args.repeat)
+        results["cases"][case.name] = result
+
+        if "skipped" in result:
+            print(f"{case.name:<32} skipped ({result['skipped']})")
+        else:
+            print(
+                f"{case.name:<32} {result['seconds']:8.3f} s"
+                f" {result['peak_rss_mb']:8.1f} MB"
+                f" {result['output_bytes'] / 1024:10.1f} KB"
+            )
+
+    out = args.out
+    if out is None:
+        os.makedirs(results_path, exist_ok=True)
+        date = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(results_path, f"{date}-{commit}.json")
+
+    with open(out, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(f"Saved to {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,4 +5,120 @@ env.read_env()
 
 BOT_TOKEN = env.str("BOT_TOKEN")
 ADMIN = env.str("ADMIN")
-IP = env.str("ip")
\ No newline at end of file
+IP = env.str("ip")
+
+# how many external tool processes of each kind may run at the same time,
+# the rest of the jobs wait in line for a free slot
+GS_WORKERS = env.int("GS_WORKERS", 2)
+# seconds after which a stuck Ghostscript process gets killed
+GS_TIMEOUT = env.int("GS_TIMEOUT", 300)
+
+# LibreOffice pool used for Word to PDF conversions
+SOFFICE_POOL_SIZE = env.int("SOFFICE_POOL_SIZE", 2)
+SOFFICE_BINARY = env.str("SOFFICE_BINARY", "soffice")
+# instances listen on consecutive ports starting from this one
+SOFFICE_BASE_PORT = env.int("SOFFICE_BASE_PORT", 2002)
+# an instance gets restarted after this many conversions or if it grows
+# bigger than this many megabytes
+SOFFICE_MAX_JOBS = env.int("SOFFICE_MAX_JOBS", 50)
+SOFFICE_MAX_RSS_MB = env.int("SOFFICE_MAX_RSS_MB", 1024)
+SOFFICE_TIMEOUT = env.int("SOFFICE_TIMEOUT", 120)
+# python interpreter that has the LibreOffice UNO bindings installed
+UNO_PYTHON = env.str("UNO_PYTHON", "/usr/bin/python3")
+
+# number of processes doing the PDF work (merging, splitting, encrypting),
+# 0 means one per CPU core
+PDF_WORKERS = env.int("PDF_WORKERS", 0)
+# the results of PDFs at least this big (in kilobytes) are written compactly
+# (object streams, compressed xref and page contents), -1 turns it off
+COMPACT_OUTPUT_KB = env.int("COMPACT_OUTPUT_KB", 256)
+
+# how many results (file_ids of documents that were already sent) are
+# remembered and for how long (in seconds)
+RESULT_CACHE_SIZE = env.int("RESULT_CACHE_SIZE", 10000)
+RESULT_CACHE_TTL = env.int("RESULT_CACHE_TTL", 7 * 24 * 60 * 60)
+
+# how much space (in megabytes) the downloaded files may take up
+BLOB_STORE_MAX_MB = env.int("BLOB_STORE_MAX_MB", 2048)
+
+# how many files of an album are downloaded at the same time
+DOWNLOAD_CONCURRENCY = env.int("DOWNLOAD_CONCURRENCY", 4)
+
+# where the states of the users are kept: "memory" (lost on restart),
+# "sqlite" (a local database) or "redis" (shared by several bot processes)
+FSM_STORAGE = env.str("FSM_STORAGE", "sqlite")
+REDIS_HOST = env.str("REDIS_HOST", "localhost")
+REDIS_PORT = env.int("REDIS_PORT", 6379)
+REDIS_DB = env.int("REDIS_DB", 0)
+REDIS_PASSWORD = env.str("REDIS_PASSWORD", None)
+# changes to the states are written in batches, at most this many
+# milliseconds after they happen
+FSM_FLUSH_INTERVAL_MS = env.int("FSM_FLUSH_INTERVAL_MS", 50)
+# how many states are kept in memory
+FSM_CACHE_SIZE = env.int("FSM_CACHE_SIZE", 10000)
+
+# "polling" (the default, good for development) or "webhook"
+# (either way only one instance of the bot may run, the job queue and the
+# files of the users are local, see WORKERS for handling more updates)
+MODE = env.str("MODE", "polling")
+# the address telegram sends the updates to, it should lead (through a
+# reverse proxy doing HTTPS) to the web server below
+WEBHOOK_PATH = env.str("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = env.str("WEBHOOK_URL", f"https://{IP}{WEBHOOK_PATH}")
+# where the web server of the bot listens
+WEBAPP_HOST = env.str("WEBAPP_HOST", "127.0.0.1")
+WEBAPP_PORT = env.int("WEBAPP_PORT", 8080)
+
+# number of worker processes handling the updates (see utils/sharding.py),
+# every worker has its own LibreOffice pool and PDF engine
+# (works in both modes, the front process polls or runs the webhook server)
+WORKERS = env.int("WORKERS", 1)
+# which worker this process is, set by the front process
+SHARD = env.int("SHARD", 0)
+
+# a job that was running when the bot crashed is started again after the
+# restart, but only this many times
+JOB_MAX_ATTEMPTS = env.int("JOB_MAX_ATTEMPTS", 3)
+
+# files are checked before they're downloaded: bigger files are rejected
+# (telegram doesn't let bots download files bigger than 20 MB anyway),
+# and no new files are taken if there are too many jobs in the queue,
+# too little disk space left or the bot (with its worker processes)
+# takes up too much memory (0 means no limit)
+MAX_FILE_MB = env.int("MAX_FILE_MB", 20)
+MAX_QUEUE_DEPTH = env.int("MAX_QUEUE_DEPTH", 50)
+MIN_FREE_DISK_MB = env.int("MIN_FREE_DISK_MB", 500)
+MAX_RSS_MB = env.int("MAX_RSS_MB", 0)
+
+# throttling (see middlewares/throttling.py): every chat gets this many
+# tokens per second, up to the burst, and every operation of a chat has
+# its own smaller budget. a heavy operation costs 5 tokens, a message 1
+THROTTLE_CHAT_RATE = env.float("THROTTLE_CHAT_RATE", 1)
+THROTTLE_CHAT_BURST = env.float("THROTTLE_CHAT_BURST", 30)
+THROTTLE_OPERATION_RATE = env.float("THROTTLE_OPERATION_RATE", 0.5)
+THROTTLE_OPERATION_BURST = env.float("THROTTLE_OPERATION_BURST", 20)
+# a throttled chat is told about it at most once in this many seconds
+THROTTLE_WARN_INTERVAL = env.int("THROTTLE_WARN_INTERVAL", 10)
+
+# where the metrics are exposed (in the Prometheus format, at /metrics),
+# port 0 turns the endpoint off
+METRICS_HOST = env.str("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = env.int("METRICS_PORT", 9101)
+
+# how often the event loop lag is measured, and after how long of the loop
+# being stuck the blocking code gets logged (in milliseconds)
+LOOP_LAG_INTERVAL_MS = env.int("LOOP_LAG_INTERVAL_MS", 100)
+LOOP_LAG_THRESHOLD_MS = env.int("LOOP_LAG_THRESHOLD_MS", 500)
+
+# the Bot API server the bot talks to, api.telegram.org if it's not set
+# (a local telegram-bot-api server, or the fake one of the load test)
+TELEGRAM_API_URL = env.str("TELEGRAM_API_URL", None)
+
+# an album is handled once none of its files arrived for ALBUM_QUIET_MS,
+# or ALBUM_MAX_WAIT_MS after its first file (in milliseconds)
+ALBUM_QUIET_MS = env.int("ALBUM_QUIET_MS", 250)
+ALBUM_MAX_WAIT_MS = env.int("ALBUM_MAX_WAIT_MS", 3000)
+
+# the files to merge are merged in the background once the list of files
+# didn't change for this long (in milliseconds), -1 turns it off
+SPECULATIVE_MERGE_DELAY_MS = env.int("SPECULATIVE_MERGE_DELAY_MS", 2000)
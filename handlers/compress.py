@@ -2,17 +2,25 @@
 The part that deals with compressing PDF files.
 """
 
+import asyncio
 import logging
-import subprocess
 from os import listdir
-from os.path import getsize
+from os.path import basename, getsize
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from loader import bot, dp, input_path, output_path
+from data import config
+from loader import dp, input_path, output_path
 from states.all_states import CompressingStates
+from utils.admission import admit
+from utils.blob_store import blob_store
 from utils.clean_up import reset
 from utils.convert_file_size import convert_bytes
+from utils.ghostscript import compress_args
+from utils.job_queue import Job, job_queue
+from utils.result_cache import result_cache, send_cached_result
+from utils.runner import run_tool
+from utils.throttling import rate_limit
 
 
 @dp.message_handler(
@@ -20,13 +28,18 @@ from utils.convert_file_size import convert_bytes
     content_types=types.message.ContentType.DOCUMENT,
     state=CompressingStates.waiting_for_files_to_compress,
     )
-async def compress_file_received(message: types.Message):
+@rate_limit(2, "compress")
+async def compress_file_received(message: types.Message, state: FSMContext):
     """
     This handler will be called when user provides a file to compress.
     Checks if the file is a PDF and asks to name the output file.
     """
     name = message.document.file_name
     if name.endswith(".pdf"):
+        # checking the file before downloading it
+        if not await admit(message, [message.document]):
+            return
+
         await message.answer("Downloading the file, please wait")
 
         # replacing empty spaces in the file name with underscores
@@ -35,13 +48,16 @@ async def compress_file_received(message: types.Message):
         if " " in name:
             name = name.replace(" ", "_")
 
-        await bot.download_file_by_id(
-            message.document.file_id,
+        await blob_store.fetch(
+            message.document,
             destination=f"{input_path}/{message.chat.id}/{name}",
             timeout=90,
             )
         logging.info("File (to be compressed) downloaded")
- 
+
+        # the unique id of the file is used to look up cached results
+        await state.update_data(unique_id=message.document.file_unique_id)
+
         keyboard = types.InlineKeyboardMarkup()
 
         keyboard.add(
@@ -68,6 +84,7 @@ async def compress_file_received(message: types.Message):
     text_startswith="Compressed_",
     state=CompressingStates.waiting_for_a_name
     )
+@rate_limit(5, "compress")
 async def give_default_name(call: types.CallbackQuery, state: FSMContext):
     """
     This handler will be called when user doesn't want to type in a
@@ -87,6 +104,7 @@ async def give_default_name(call: types.CallbackQuery, state: FSMContext):
 
 
 @dp.message_handler(state=CompressingStates.waiting_for_a_name)
+@rate_limit(5, "compress")
 async def compress_file(message: types.Message, state: FSMContext):
     """
     This handler will be called when user sends a name for 
@@ -108,10 +126,6 @@ async def compress_file(message: types.Message, state: FSMContext):
 
     file = f"{input_path}/{message.chat.id}/{files[0]}"
 
-    logging.info("Compressing started")
-
-    await message.answer("Compressing the file, please wait")
-
     if " " in output_name:
         output_name = output_name.replace(" ", "_")
 
@@ -120,14 +134,55 @@ async def compress_file(message: types.Message, state: FSMContext):
     else:
         compressed_pdf = f"{output_path}/{message.chat.id}/{output_name}.pdf"
 
-    # using ghostscript to compress the file
-    script = (
-        "gs -sDEVICE=pdfwrite -dNOPAUSE -dQUIET -dBATCH -dPDFSETTINGS=/screen"
-        f" -dCompatibilityLevel=1.4 -sOutputFile={compressed_pdf} {file}"
+    # if this file has already been compressed (with the same name for the
+    # result), just send the document that was sent back then
+    cache_key = result_cache.make_key(
+        "compress",
+        [data.get("unique_id")],
+        profile="/screen",
+        name=basename(compressed_pdf),
     )
-    command = script.split(" ")
 
-    subprocess.run(command)
+    if await send_cached_result(message, cache_key):
+        return await reset(message, state)
+
+    await message.answer("Compressing the file, please wait")
+
+    # the compression itself is done once it's this file's turn in the queue
+    # (the file is kept by the job, so the user's files can be cleaned up)
+    await job_queue.submit(
+        "compress",
+        message,
+        inputs=[file],
+        name=basename(compressed_pdf),
+        cache_key=cache_key,
+    )
+
+    await reset(message, state)
+
+
+@job_queue.runner("compress", tool="gs")
+async def run_compression(job: Job):
+    """
+    Compresses the file of the job and sends it back to the user.
+    """
+    logging.info("Compressing started")
+
+    file = job.inputs[0]
+    compressed_pdf = job.output(job.params["name"])
+
+    # using ghostscript to compress the file
+    # (it runs as a separate process, so other users don't have to wait
+    # for the compression to finish to get a reply from the bot)
+    command = compress_args(file, compressed_pdf, profile="/screen")
+
+    try:
+        returncode, _ = await run_tool("gs", command, timeout=config.GS_TIMEOUT)
+    except asyncio.TimeoutError:
+        returncode = None
+
+    if returncode != 0:
+        return await job.reply("Sorry, the compression failed.")
 
     # getting the original file and compressed file size and calculating the
     # reduction in size. using convert_bytes to display the bytes in a
@@ -136,15 +191,15 @@ async def compress_file(message: types.Message, state: FSMContext):
     compressed_size = convert_bytes(getsize(compressed_pdf))
     reduction = round((1 - (getsize(compressed_pdf) / getsize(file))) * 100)
 
-    await message.answer(
+    summary = (
         f"Original file size: <b>{original_size}</b>\n"
         f"Compressed file size: <b>{compressed_size}</b>\n\n"
         f"PDF size reduced by: <b>{reduction}%</b>"
-        )
+    )
 
-    with open(compressed_pdf, "rb") as result:
-        await message.answer_chat_action(action="upload_document")
-        await message.reply_document(result, caption="Here you go")
-        logging.info("Sent the compressed document")
+    await job.answer(summary)
 
-    await reset(message, state)
+    sent = await job.reply_document(types.InputFile(compressed_pdf))
+    logging.info("Sent the compressed document")
+
+    result_cache.put(job.params["cache_key"], sent.document.file_id, summary)
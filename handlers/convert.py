@@ -2,18 +2,26 @@
 The part that deals with converting Word to PDF and images to PDF.
 """
 
+import asyncio
 import logging
-import subprocess
-from os import listdir
+from os.path import splitext
 from typing import List
 
-import img2pdf
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from loader import bot, dp, input_path, output_path
-from PIL import Image
+from aiogram.utils.exceptions import BadRequest
+from loader import dp, input_path
 from states.all_states import ConvertingStates
+from utils.admission import admit
+from utils.blob_store import blob_store
 from utils.clean_up import reset
+from utils.job_queue import Job, job_queue
+from utils.merge_manifest import add_files, get_files
+from utils.pdf_engine import run_pdf_job
+from utils.pdf_ops import ImagesJob
+from utils.result_cache import result_cache, send_cached_result
+from utils.soffice_pool import soffice_pool
+from utils.throttling import rate_limit
 
 
 @dp.message_handler(
@@ -21,6 +29,7 @@ from utils.clean_up import reset
     content_types=types.ContentType.DOCUMENT,
     state=ConvertingStates.waiting_for_word_docs,
 )
+@rate_limit(5, "convert")
 async def convert_word_album(
     message: types.Message, album: List[types.Message], state: FSMContext
 ):
@@ -31,6 +40,14 @@ async def convert_word_album(
     """
     await message.answer("Downloading files, please wait")
 
+    # the names are kept in the order in which the files were sent,
+    # so that the PDFs are sent back in the same order
+    names = []
+    # documents that were already converted before are not downloaded
+    # and converted again, their cached results are used instead
+    cache_keys = []
+    cached_results = []
+
     for obj in album:
         name = obj.document.file_name
 
@@ -45,45 +62,57 @@ async def convert_word_album(
         if " " in name:
             name = name.replace(" ", "_")
 
-        await bot.download_file_by_id(
-            obj.document.file_id,
-            destination=f"{input_path}/{message.chat.id}/{name}",
+        cache_key = result_cache.make_key(
+            "word2pdf", [obj.document.file_unique_id], name=name
         )
-        logging.info("File downloaded.")
-
-    await message.answer("Converting in progress, please wait")
-
-    # LibreOffice is used to convert the Word documents to PDF
-    script = (
-        "libreoffice --headless "
-        f"--convert-to pdf --outdir {output_path}/{message.chat.id}/"
+        cached_result = result_cache.get(cache_key)
+
+        names.append(name)
+        cache_keys.append(cache_key)
+        cached_results.append(cached_result)
+
+    # checking the files before downloading them
+    if not await admit(
+        message,
+        [
+            obj.document
+            for obj, cached_result in zip(album, cached_results)
+            if cached_result is None
+        ],
+    ):
+        return
+
+    # the files are downloaded at the same time
+    await blob_store.fetch_many(
+        [
+            (obj.document, f"{input_path}/{message.chat.id}/{name}")
+            for obj, name, cached_result in zip(album, names, cached_results)
+            if cached_result is None
+        ]
     )
+    logging.info("Files downloaded.")
 
-    # the output PDFs will be sent also as a group of files
-    media = types.MediaGroup()
+    await message.answer("Converting in progress, please wait")
 
+    # the conversion itself is done once it's this user's turn in the queue,
+    # the cached results are sent along with the converted documents
     in_path = f"{input_path}/{message.chat.id}"
-    for doc in listdir(in_path):
-        convert_script = f"{script} {in_path}/{doc}"
-        convert_script.split(" ")
-        subprocess.run(convert_script, shell=True)
-
-    docs = listdir(f"{output_path}/{message.chat.id}")
-
-    for index, file in enumerate(docs):
-        # the last word document in the group of files should have the caption
-        if index == len(docs) - 1:
-            media.attach_document(
-                types.InputFile(f"{output_path}/{message.chat.id}/{file}"),
-                caption="Here you go",
-            )
-        else:
-            media.attach_document(
-                types.InputFile(f"{output_path}/{message.chat.id}/{file}")
-            )
-
-    await message.answer_chat_action(action="upload_document")
-    await message.reply_media_group(media=media)
+    await job_queue.submit(
+        "word2pdf",
+        message,
+        inputs=[
+            f"{in_path}/{name}"
+            for name, cached_result in zip(names, cached_results)
+            if cached_result is None
+        ],
+        docs=[
+            {
+                "cache_key": cache_key,
+                "file_id": cached_result and cached_result["file_id"],
+            }
+            for cache_key, cached_result in zip(cache_keys, cached_results)
+        ],
+    )
 
     await reset(message, state)
 
@@ -93,6 +122,7 @@ async def convert_word_album(
     content_types=types.message.ContentType.DOCUMENT,
     state=ConvertingStates.waiting_for_word_docs,
 )
+@rate_limit(5, "convert")
 async def convert_word_file(message: types.Message, state: FSMContext):
     """
     This handler will be called when user provided a Word document to convert
@@ -114,8 +144,21 @@ async def convert_word_file(message: types.Message, state: FSMContext):
     if " " in name:
         name = name.replace(" ", "_")
 
-    await bot.download_file_by_id(
-        message.document.file_id,
+    # if this document has already been converted, there is no need to even
+    # download it, the document that was sent back then is sent again
+    cache_key = result_cache.make_key(
+        "word2pdf", [message.document.file_unique_id], name=name
+    )
+
+    if await send_cached_result(message, cache_key):
+        return await reset(message, state)
+
+    # checking the file before downloading it
+    if not await admit(message, [message.document]):
+        return
+
+    await blob_store.fetch(
+        message.document,
         destination=f"{input_path}/{message.chat.id}/{name}",
     )
 
@@ -123,26 +166,125 @@ async def convert_word_file(message: types.Message, state: FSMContext):
 
     await message.answer("Converting in progress, please wait")
 
-    in_path = f"{input_path}/{message.chat.id}"
+    # the conversion itself is done once it's this user's turn in the queue
+    await job_queue.submit(
+        "word2pdf",
+        message,
+        inputs=[f"{input_path}/{message.chat.id}/{name}"],
+        docs=[{"cache_key": cache_key, "file_id": None}],
+    )
+
+    await reset(message, state)
 
-    # LibreOffice is used to convert the Word documents to PDF
-    script = (
-        "libreoffice --headless "
-        f"--convert-to pdf --outdir {output_path}/{message.chat.id}/ "
-        f"{in_path}/{name}"
+
+@job_queue.runner("word2pdf", tool="soffice")
+async def run_word_conversion(job: Job):
+    """
+    Converts the Word documents of the job and sends them back to the user,
+    as an album if there are several of them. The documents that were
+    converted before (their file_ids are in the params) are sent as they are.
+    """
+    docs = job.params["docs"]
+
+    # LibreOffice (the already running instances from the pool) is used
+    # to convert the Word documents to PDF. all the documents are converted
+    # at the same time, each one by a separate instance with its own profile,
+    # and gather returns the results in the same order as the documents
+    results = await asyncio.gather(
+        *(soffice_pool.convert(file, job.output_dir) for file in job.inputs)
     )
+    results = iter(results)
+
+    # (cache key, file_id or converted file, whether it's a new result)
+    # documents that failed to convert are skipped
+    converted = []
+    for doc in docs:
+        if doc["file_id"] is not None:
+            converted.append((doc["cache_key"], doc["file_id"], False))
+        else:
+            file = next(results)
+            if file is not None:
+                converted.append((doc["cache_key"], types.InputFile(file), True))
 
-    script.split(" ")
-    subprocess.run(script, shell=True)
+    if not converted:
+        return await job.reply("Sorry, the conversion failed.")
 
-    output = listdir(f"{output_path}/{message.chat.id}")[0]
+    try:
+        sent = await _send_converted(job, converted)
+    except BadRequest:
+        # telegram didn't take one of the cached file_ids, those results
+        # are converted again the next time
+        for cache_key, _, is_new in converted:
+            if not is_new:
+                result_cache.delete(cache_key)
+        raise
 
-    with open(f"{output_path}/{message.chat.id}/{output}", "rb") as output:
-        await message.answer_chat_action(action="upload_document")
-        await message.reply_document(output, caption="Here you go")
-        logging.info("Sent the document")
+    logging.info("Sent the document")
+
+    # remembering the file_ids of the newly converted documents
+    for (cache_key, _, is_new), sent_message in zip(converted, sent):
+        if is_new:
+            result_cache.put(cache_key, sent_message.document.file_id)
+
+
+async def _send_converted(job: Job, converted: list) -> List[types.Message]:
+    """Sends the converted documents, as an album if there are several."""
+    # an album needs at least two files
+    if len(converted) == 1:
+        return [await job.reply_document(converted[0][1])]
+
+    # the output PDFs will be sent also as a group of files
+    media = types.MediaGroup()
+
+    for index, (_, file, _) in enumerate(converted):
+        # the last word document in the group of files should have the caption
+        if index == len(converted) - 1:
+            media.attach_document(file, caption="Here you go")
+        else:
+            media.attach_document(file)
+
+    return await job.reply_media_group(media)
+
+
+def _image_entry(obj: types.Message) -> dict:
+    """
+    The entry of the image in the list of images (see utils/merge_manifest.py).
+    Photos don't have names, so the files are named after their unique ids
+    (the extension tells ImagesJob what kind of image it is).
+    """
+    if obj.photo:
+        file, extension = obj.photo[-1], ".jpg"
+    else:
+        file, extension = obj.document, splitext(obj.document.file_name)[1].lower()
+
+    return {
+        "id": file.file_unique_id,
+        "name": f"{file.file_unique_id}{extension}",
+        "msg": obj.message_id,
+    }
 
-    await reset(message, state)
+
+def _image_path(chat_id: int, entry: dict) -> str:
+    return f"{input_path}/{chat_id}/{entry['name']}"
+
+
+async def _fetch_images(
+    chat_id: int, state: FSMContext, messages: List[types.Message]
+):
+    """
+    Downloads the images (at the same time) and adds them to the list of
+    images, in the order in which they were sent (albums that arrive at the
+    same time don't get mixed up).
+    """
+    entries = [_image_entry(obj) for obj in messages]
+
+    await blob_store.fetch_many(
+        [
+            (obj.photo[-1] if obj.photo else obj.document, _image_path(chat_id, entry))
+            for obj, entry in zip(messages, entries)
+        ]
+    )
+    await add_files(state, chat_id, entries, key="images")
 
 
 @dp.message_handler(
@@ -150,28 +292,22 @@ async def convert_word_file(message: types.Message, state: FSMContext):
     content_types=types.message.ContentTypes.PHOTO,
     state=ConvertingStates.waiting_for_images,
 )
-async def name_pdf_img_album(message: types.Message, album: List[types.Message]):
+@rate_limit(3, "convert")
+async def name_pdf_img_album(
+    message: types.Message, album: List[types.Message], state: FSMContext
+):
     """
     This handler will be called when user sends an album of photos to
     convert to PDF. Downloads the photos and asks to name the output PDF.
     """
+    # checking the photos before downloading them
+    if not await admit(message, [obj.photo[-1] for obj in album]):
+        return
+
     await message.answer("Downloading images, please wait")
 
-    for obj in album:
-        file_id = obj.photo[-1].file_id
-
-        # since we cannot obtain the file name of a photo which was sent
-        # as part of an album, we will be using the image count to name
-        # each file.
-        img_count = len(listdir(f"{input_path}/{message.chat.id}"))
-
-        # all the files are saved as jpg since the photo names cannot be
-        # obtained. i could not come up with anything else cause im retarded.
-        await bot.download_file_by_id(
-            file_id,
-            destination=f"{input_path}/{message.chat.id}/{img_count}.jpg",
-        )
-        logging.info("Image downloaded.")
+    await _fetch_images(message.chat.id, state, album)
+    logging.info("Images downloaded.")
 
     await ConvertingStates.waiting_for_name.set()
 
@@ -183,26 +319,21 @@ async def name_pdf_img_album(message: types.Message, album: List[types.Message])
     content_types=types.message.ContentTypes.PHOTO,
     state=ConvertingStates.waiting_for_images,
 )
-async def name_pdf_img(message: types.Message):
+@rate_limit(2, "convert")
+async def name_pdf_img(message: types.Message, state: FSMContext):
     """
     This handler will be called when user sends a single photo to
     convert to PDF.
     """
-    await message.answer("Downloading image, please wait")
+    photo = message.photo[-1]
 
-    file_id = message.photo[-1].file_id
+    # checking the photo before downloading it
+    if not await admit(message, [photo]):
+        return
 
-    # since we cannot obtain the file name of a photo which was sent
-    # as part of an album, we will be using the image count to name
-    # each file.
-    img_count = len(listdir(f"{input_path}/{message.chat.id}"))
+    await message.answer("Downloading image, please wait")
 
-    # all the files are saved as jpg since the photo names cannot be
-    # obtained. i could not come up with anything else cause im retarded.
-    await bot.download_file_by_id(
-        file_id,
-        destination=f"{input_path}/{message.chat.id}/{img_count}.jpg",
-    )
+    await _fetch_images(message.chat.id, state, [message])
     logging.info("Image downloaded.")
 
     await ConvertingStates.waiting_for_name.set()
@@ -215,7 +346,10 @@ async def name_pdf_img(message: types.Message):
     content_types=types.message.ContentTypes.DOCUMENT,
     state=ConvertingStates.waiting_for_images,
 )
-async def name_pdf_img_album(message: types.Message, album: List[types.Message]):
+@rate_limit(3, "convert")
+async def name_pdf_img_album(
+    message: types.Message, album: List[types.Message], state: FSMContext
+):
     """
     This handler will be called when user sends an album of photos (as files)
     to convert to PDF. Downloads the files, checks if they're images and
@@ -233,15 +367,12 @@ async def name_pdf_img_album(message: types.Message, album: List[types.Message])
                 "Sorry, I cannot convert from this image format."
             )
 
-        # here this variable is used to keep track of the order in which
-        # images are sent
-        img_count = len(listdir(f"{input_path}/{message.chat.id}"))
+    # checking the files before downloading them
+    if not await admit(message, [obj.document for obj in album]):
+        return
 
-        await bot.download_file_by_id(
-            obj.document.file_id,
-            destination=f"{input_path}/{message.chat.id}/{img_count}_{name}",
-        )
-        logging.info("Image downloaded.")
+    await _fetch_images(message.chat.id, state, album)
+    logging.info("Images downloaded.")
 
     await ConvertingStates.waiting_for_name.set()
 
@@ -253,7 +384,8 @@ async def name_pdf_img_album(message: types.Message, album: List[types.Message])
     content_types=types.message.ContentTypes.DOCUMENT,
     state=ConvertingStates.waiting_for_images,
 )
-async def name_pdf_img(message: types.Message):
+@rate_limit(2, "convert")
+async def name_pdf_img(message: types.Message, state: FSMContext):
     """
     This handler will be called when user sends a single photo (as a file) to
     convert to PDF.
@@ -267,12 +399,11 @@ async def name_pdf_img(message: types.Message):
     ):
         return await message.answer("Sorry, I cannot convert from this image format.")
 
-    img_count = len(listdir(f"{input_path}/{message.chat.id}"))
+    # checking the file before downloading it
+    if not await admit(message, [message.document]):
+        return
 
-    await bot.download_file_by_id(
-        message.document.file_id,
-        destination=f"{input_path}/{message.chat.id}/{img_count}_{name}",
-    )
+    await _fetch_images(message.chat.id, state, [message])
     logging.info("Image downloaded.")
 
     await ConvertingStates.waiting_for_name.set()
@@ -281,6 +412,7 @@ async def name_pdf_img(message: types.Message):
 
 
 @dp.message_handler(state=ConvertingStates.waiting_for_name)
+@rate_limit(5, "convert")
 async def convert_images(message: types.Message, state: FSMContext):
     """
     This handler will be called once user provides a name for the output PDF.
@@ -299,39 +431,35 @@ async def convert_images(message: types.Message, state: FSMContext):
     if not message.text.lower().endswith(".pdf"):
         output_name = output_name + ".pdf"
 
-    out_path = f"{output_path}/{message.chat.id}/{output_name}"
-    img_path = f"{input_path}/{message.chat.id}"
+    # the images go into the PDF in the order in which they were sent
+    images = await get_files(state, key="images")
 
-    imgs = [img_path + "/" + name for name in sorted(listdir(img_path))]
-
-    for index, img in enumerate(sorted(listdir(img_path))):
-        # removing the alpha channel
-        if img.endswith(".png"):
-            png = Image.open(f"{img_path}/{img}").convert("RGBA")
-            background = Image.new("RGBA", png.size, (255, 255, 255))
+    await job_queue.submit(
+        "images",
+        message,
+        inputs=[_image_path(message.chat.id, image) for image in images],
+        name=output_name,
+    )
 
-            alpha_composite = Image.alpha_composite(background, png)
-            alpha_composite.convert("RGB").save(
-                f"{img_path}/{index}.jpg", "JPEG", quality=80
-            )
+    await reset(message, state)
 
-    imgs = [
-        img_path + "/" + name
-        for name in sorted(listdir(img_path))
-        if not name.endswith(".png")
-    ]
 
+@job_queue.runner("images", tool="pdf")
+async def run_image_conversion(job: Job):
+    """
+    Puts the images of the job into a PDF and sends it to the user.
+    """
     logging.info("Converting images started")
 
-    try:
-        with open(out_path, "wb") as result:
-            result.write(img2pdf.convert(imgs))
-    except:
-        return await message.reply("Sorry, the conversion failed.")
+    out_path = job.output(job.params["name"])
 
-    with open(out_path, "rb") as result:
-        await message.answer_chat_action(action="upload_document")
-        await message.reply_document(result, caption="Here you go")
-        logging.info("Sent the document")
+    # removing the alpha channel and the conversion itself are done
+    # in a separate process
+    try:
+        await run_pdf_job(ImagesJob(images=job.inputs, output=out_path))
+    except Exception:
+        logging.exception("Converting images failed")
+        return await job.reply("Sorry, the conversion failed.")
 
-    await reset(message, state)
+    await job.reply_document(types.InputFile(out_path))
+    logging.info("Sent the document")
@@ -4,13 +4,20 @@ The part that deals with encryption and decryption of PDF files.
 
 import logging
 from os import listdir, rename
+from os.path import basename
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from loader import bot, dp, input_path, output_path
-from PyPDF2 import PdfFileReader, PdfFileWriter
+from loader import dp, input_path
 from states.all_states import CryptingStates
+from utils.admission import admit
+from utils.blob_store import blob_store
 from utils.clean_up import reset
+from utils.job_queue import Job, job_queue
+from utils.pdf_engine import compact_output, run_pdf_job
+from utils.pdf_ops import DecryptJob, EncryptJob, NotEncryptedError, WrongPasswordError
+from utils.result_cache import hash_password, result_cache, send_cached_result
+from utils.throttling import rate_limit
 
 
 @dp.message_handler(
@@ -21,6 +28,7 @@ from utils.clean_up import reset
         CryptingStates.waiting_for_files_to_decrypt,
     ],
 )
+@rate_limit(2, "crypt")
 async def crypt_file_received(message: types.Message, state: FSMContext):
     """
     This handler will be called when user provides a file to encrypt/decrypt.
@@ -35,6 +43,10 @@ async def crypt_file_received(message: types.Message, state: FSMContext):
     name = message.document.file_name
 
     if name.endswith(".pdf"):
+        # checking the file before downloading it
+        if not await admit(message, [message.document]):
+            return
+
         await message.answer("Downloading the file, please wait")
 
         # replacing empty spaces in the file name with underscores
@@ -43,13 +55,16 @@ async def crypt_file_received(message: types.Message, state: FSMContext):
         if " " in name:
             name = name.replace(" ", "_")
 
-        await bot.download_file_by_id(
-            message.document.file_id,
+        await blob_store.fetch(
+            message.document,
             destination=f"{input_path}/{message.chat.id}/{name}",
             timeout=90,
         )
         logging.info(f"File (to be {action}ed) downloaded")
 
+        # the unique id of the file is used to look up cached results
+        await state.update_data(unique_id=message.document.file_unique_id)
+
         await message.reply(
             f"Great, type the password you want to {action} with.",
         )
@@ -63,6 +78,7 @@ async def crypt_file_received(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(state=CryptingStates.waiting_for_en_password)
+@rate_limit(3, "crypt")
 async def encrypt_file(message: types.Message, state: FSMContext):
     """
     This handler will be called when user types in a password for encryption.
@@ -87,29 +103,58 @@ async def encrypt_file(message: types.Message, state: FSMContext):
         file_name = files[0]
 
     input_file = f"{input_path}/{message.chat.id}/{file_name}"
-    output_file = f"{output_path}/{message.chat.id}/Encrypted_{file_name}"
 
-    file = open(input_file, "rb")
+    # if this file has already been encrypted with the same password,
+    # just send the document that was sent back then
+    data = await state.get_data()
+    cache_key = result_cache.make_key(
+        "encrypt",
+        [data.get("unique_id")],
+        password=hash_password(message.text),
+        name=file_name,
+    )
+
+    if await send_cached_result(message, cache_key):
+        return await reset(message, state)
+
+    # the encryption is done once it's this file's turn in the queue
+    # (the password is kept with the job until it's done)
+    await job_queue.submit(
+        "encrypt",
+        message,
+        inputs=[input_file],
+        password=message.text,
+        cache_key=cache_key,
+    )
 
-    input_pdf = PdfFileReader(file)
-
-    output_pdf = PdfFileWriter()
-    output_pdf.appendPagesFromReader(input_pdf)
-    output_pdf.encrypt(message.text)
+    await reset(message, state)
 
-    with open(output_file, "wb") as result:
-        output_pdf.write(result)
 
-    file.close()
+@job_queue.runner("encrypt", tool="pdf")
+async def run_encryption(job: Job):
+    """
+    Encrypts the file of the job and sends it back to the user.
+    """
+    input_file = job.inputs[0]
+    output_file = job.output(f"Encrypted_{basename(input_file)}")
+
+    # the encryption itself is done in a separate process
+    await run_pdf_job(
+        EncryptJob(
+            input=input_file,
+            password=job.params["password"],
+            output=output_file,
+            compact=compact_output(input_file),
+        )
+    )
 
-    with open(output_file, "rb") as result:
-        await message.answer_chat_action(action="upload_document")
-        await message.reply_document(result, caption="Here you go")
+    sent = await job.reply_document(types.InputFile(output_file))
 
-    await reset(message, state)
+    result_cache.put(job.params["cache_key"], sent.document.file_id)
 
 
 @dp.message_handler(state=CryptingStates.waiting_for_de_password)
+@rate_limit(3, "crypt")
 async def decrypt_file(message: types.Message, state: FSMContext):
     """
     This handler will be called when user types in a password for encryption.
@@ -132,44 +177,67 @@ async def decrypt_file(message: types.Message, state: FSMContext):
         file_name = files[0]
 
     input_file = f"{input_path}/{message.chat.id}/{file_name}"
-    output_file = f"{output_path}/{message.chat.id}/Decrypted_{file_name}"
 
-    file = open(input_file, "rb")
+    # only successful decryptions get cached, so a hit means that
+    # the password is correct
+    data = await state.get_data()
+    cache_key = result_cache.make_key(
+        "decrypt",
+        [data.get("unique_id")],
+        password=hash_password(message.text),
+        name=file_name,
+    )
+
+    if await send_cached_result(message, cache_key):
+        return await reset(message, state)
+
+    await job_queue.submit(
+        "decrypt",
+        message,
+        inputs=[input_file],
+        password=message.text,
+        cache_key=cache_key,
+        unique_id=data.get("unique_id"),
+        user_id=message.from_user.id,
+    )
 
-    input_pdf = PdfFileReader(file)
+    await reset(message, state)
 
-    password = message.text
 
-    if input_pdf.isEncrypted:
-        try:
-            response = input_pdf.decrypt(password)
-        except NotImplementedError:
-            await message.reply(
-                "Sorry, your file is encrypted with a method that I am not "
-                "familiar with :(\n\nTry decrypting it here:\n"
-                "https://smallpdf.com/unlock-pdf \n"
-                "(not sponsored, just want to help)"
+@job_queue.runner("decrypt", tool="pdf")
+async def run_decryption(job: Job):
+    """
+    Decrypts the file of the job and sends it back to the user.
+    If the password is wrong, the user is asked for it again.
+    """
+    input_file = job.inputs[0]
+    output_file = job.output(f"Decrypted_{basename(input_file)}")
+
+    # the decryption itself is done in a separate process
+    try:
+        await run_pdf_job(
+            DecryptJob(
+                input=input_file,
+                password=job.params["password"],
+                output=output_file,
+                compact=compact_output(input_file),
             )
-        else:
-            if response == 0:
-                await message.reply(
-                    "Are you sure you typed the password correctly?\nTry again."
-                )
-                await CryptingStates.waiting_for_de_password.set()
-                return
-
-            output_pdf = PdfFileWriter()
-            output_pdf.appendPagesFromReader(input_pdf)
-
-            with open(output_file, "wb") as result:
-                output_pdf.write(result)
-
-            with open(output_file, "rb") as result:
-                await message.answer_chat_action(action="upload_document")
-                await message.reply_document(result, caption="Here you go")
-
-            await reset(message, state)
-        finally:
-            file.close()
+        )
+    except NotImplementedError:
+        await job.reply(
+            "Sorry, your file is encrypted with a method that I am not "
+            "familiar with :(\n\nTry decrypting it here:\n"
+            "https://smallpdf.com/unlock-pdf \n"
+            "(not sponsored, just want to help)"
+        )
+    except WrongPasswordError as err:
+        await job.reply(str(err))
+        await job.ask_again(
+            CryptingStates.waiting_for_de_password, unique_id=job.params["unique_id"]
+        )
+    except NotEncryptedError as err:
+        await job.reply(str(err))
     else:
-        await message.reply("PDF is not encrypted.")
+        sent = await job.reply_document(types.InputFile(output_file))
+
+        result_cache.put(job.params["cache_key"], sent.document.file_id)
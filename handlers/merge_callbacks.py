@@ -4,16 +4,18 @@ The part that deals with merging PDF files into one.
 """
 
 import logging
-from os import listdir, rename, unlink
+from os import listdir, unlink
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from loader import bot, dp, input_path
+from loader import dp, input_path
 from states.all_states import MergingStates
+from utils import speculative_merge
+from utils.merge_manifest import confirmation_keyboard, format_file_list, get_files
 
 
 @dp.callback_query_handler(text="ask_for_name")
-async def ask_for_name(call: types.CallbackQuery):
+async def ask_for_name(call: types.CallbackQuery, state: FSMContext):
     """
     This handler wll be called when the user confirms the files that
     need to be merged.
@@ -21,6 +23,10 @@ async def ask_for_name(call: types.CallbackQuery):
     """
     await MergingStates.waiting_for_a_name.set()
 
+    # the files are merged while the user comes up with a name
+    # (nothing happens if they were merged in this order already)
+    speculative_merge.schedule(call.message.chat.id, await get_files(state), delay=0)
+
     # delete the inline keyboard (the one that has Yes and No)
     await call.message.delete_reply_markup()
 
@@ -30,7 +36,7 @@ async def ask_for_name(call: types.CallbackQuery):
 
 
 @dp.callback_query_handler(text="modify_files")
-async def modification_options(call: types.CallbackQuery):
+async def modification_options(call: types.CallbackQuery, state: FSMContext):
     """
     This handler will provide the user some options to choose from if they
     are not happy with the file list. Options include:
@@ -60,9 +66,11 @@ async def modification_options(call: types.CallbackQuery):
 
     keyboard.add(*buttons)
 
+    files = await get_files(state)
+
     await call.message.edit_text(
         "<b><u>Choose one of the options below</u></b>\n\n"
-        + call.message.text[call.message.text.index("1.") :],
+        + format_file_list(files),
         reply_markup=keyboard,
     )
 
@@ -70,7 +78,7 @@ async def modification_options(call: types.CallbackQuery):
 
 
 @dp.callback_query_handler(text_endswith="_file")
-async def choose_file(call: types.CallbackQuery):
+async def choose_file(call: types.CallbackQuery, state: FSMContext):
     """
     This handler will be called when user indicates that they want to either:
     1. Rearrange the order of the files
@@ -81,23 +89,24 @@ async def choose_file(call: types.CallbackQuery):
     action = call.data.split("_")[0]
 
     # this will be used to specify the callback_data for the buttons
+    # (the callback_data only has the position of the file in the list,
+    # so it's always short enough for telegram)
     prefix = "mv_" if action == "move" else "rm_"
 
-    # sorted is called since the file names have corresponding file counts
-    # this is done to maintain the order of the files
-    # (the files will be merged in the order that the user sends the files in)
-    files = sorted(listdir(f"{input_path}/{call.message.chat.id}"))
+    files = await get_files(state)
 
     keyboard = types.InlineKeyboardMarkup()
 
-    for file in files:
+    for index, file in enumerate(files):
         keyboard.add(
-            types.InlineKeyboardButton(text=file[3:], callback_data=prefix + file)
+            types.InlineKeyboardButton(
+                text=file["name"], callback_data=f"{prefix}{index}"
+            )
         )
 
     await call.message.edit_text(
         f"<b><u>Choose the file that you want to {action}</u></b>\n\n"
-        + call.message.text[call.message.text.index("1.") :],
+        + format_file_list(files),
         reply_markup=keyboard,
     )
 
@@ -105,17 +114,17 @@ async def choose_file(call: types.CallbackQuery):
 
 
 @dp.callback_query_handler(text_startswith="mv_")
-async def choose_position(call: types.CallbackQuery):
+async def choose_position(call: types.CallbackQuery, state: FSMContext):
     """
     This handler will be called once the user chooses the file to move.
     """
-    files_num = len(listdir(f"{input_path}/{call.message.chat.id}"))
+    files = await get_files(state)
 
     keyboard = types.InlineKeyboardMarkup()
 
     buttons = []
 
-    for i in range(1, files_num + 1):
+    for i in range(1, len(files) + 1):
         buttons.append(
             types.InlineKeyboardButton(
                 text=str(i),
@@ -125,20 +134,15 @@ async def choose_position(call: types.CallbackQuery):
 
     keyboard.add(*buttons)
 
-    # because the call.data contains the "mv_" + the file name,
-    # the file name starts from the third index location
-    file_name = call.data[3:]
-
-    # rename that chosen file so that it has the prefix "id_"
-    # this is done so that we can later differentiate this file from others
-    rename(
-        f"{input_path}/{call.message.chat.id}/{file_name}",
-        f"{input_path}/{call.message.chat.id}/id_{file_name}",
-    )
+    # because the call.data contains the "mv_" + the index of the file,
+    # the index starts from the third index location.
+    # the index is stored in the state, so that we know which file to move
+    # once the user chooses the position
+    await state.update_data(moving=int(call.data[3:]))
 
     await call.message.edit_text(
         "<b><u>Choose where you want to move it</u></b>\n\n"
-        + call.message.text[call.message.text.index("1.") :],
+        + format_file_list(files),
         reply_markup=keyboard,
     )
 
@@ -146,7 +150,7 @@ async def choose_position(call: types.CallbackQuery):
 
 
 @dp.callback_query_handler(text_startswith="pos_")
-async def rearrange(call: types.CallbackQuery):
+async def rearrange(call: types.CallbackQuery, state: FSMContext):
     """
     This handler will be called once the user chooses the position to move
     the file. Moves the file to that position in the list.
@@ -154,161 +158,93 @@ async def rearrange(call: types.CallbackQuery):
     """
     logging.info("Rearranging in progress")
 
-    # sorted is called since the file names have corresponding file counts
-    # this is done to maintain the order of the files
-    # (the files will be merged in the order that the user sends the files in)
-    files = sorted(listdir(f"{input_path}/{call.message.chat.id}"))
+    data = await state.get_data()
+    files = data.get("files", [])
 
-    for file in files:
-        if file.startswith("id_"):
-            chosen_file = file
-            # the chosen file at this point should have a name like:
-            # id_03_coolname.pdf
-            # so the original position of where that file lied is 03
-            from_position = int(file[3:5])
-            break
+    # the index of the file that is being moved (starts from 0)
+    from_position = data.get("moving")
 
     # getting the position by slicing out and removing the "pos_"
-    to_position = int(call.data[4:])
+    # (positions shown to the user start from 1)
+    to_position = int(call.data[4:]) - 1
+
+    # the buttons are from an old message
+    if from_position is None or from_position >= len(files):
+        return await call.answer("This list is outdated.")
 
     # example: user chose to move file at position 03 to position 03
     if from_position == to_position:
-        rename(
-            f"{input_path}/{call.message.chat.id}/{chosen_file}",
-            f"{input_path}/{call.message.chat.id}/{chosen_file[3:]}",
-        )
-
         await call.message.answer(
             "I don't see any point in doing that.\n"
             "But hey, since that's what you want to do..."
         )
-    # example: user chose to move file at position at 5 to position 2
-    elif from_position > to_position:
-        for file in files[to_position - 1 : from_position - 1]:
-            file_num = int(file[:2]) + 1
-
-            file_num = f"0{file_num}" if file_num < 10 else str(file_num)
-            rename(
-                f"{input_path}/{call.message.chat.id}/{file}",
-                f"{input_path}/{call.message.chat.id}/{file_num}{file[2:]}",
-            )
-
-        position = f"0{to_position}" if to_position < 10 else str(to_position)
-        rename(
-            f"{input_path}/{call.message.chat.id}/{chosen_file}",
-            f"{input_path}/{call.message.chat.id}/{position}{chosen_file[5:]}",
-        )
-    # example: user chose to move file at position 2 to position 5
     else:
-        for file in files[from_position - 1 : to_position - 1]:
-            file_num = int(file[:2]) - 1
-
-            file_num = f"0{file_num}" if file_num < 10 else str(file_num)
-            rename(
-                f"{input_path}/{call.message.chat.id}/{file}",
-                f"{input_path}/{call.message.chat.id}/{file_num}{file[2:]}",
-            )
+        files.insert(to_position, files.pop(from_position))
 
-        position = f"0{to_position}" if to_position < 10 else str(to_position)
-        rename(
-            f"{input_path}/{call.message.chat.id}/{chosen_file}",
-            f"{input_path}/{call.message.chat.id}/{position}{chosen_file[5:]}",
-        )
+    await state.update_data(files=files, moving=None)
 
     # once the arrangement is over, get the confirmation again
-    files = sorted(listdir(f"{input_path}/{call.message.chat.id}"))
-
-    file_list = [f"{index}. {value[3:]}" for index, value in enumerate(files, start=1)]
-    file_list = "\n".join(file_list)
-
-    keyboard = types.InlineKeyboardMarkup()
-    buttons = [
-        types.InlineKeyboardButton(text="Yes", callback_data="ask_for_name"),
-        types.InlineKeyboardButton(text="No", callback_data="modify_files"),
-    ]
-    keyboard.add(*buttons)
-
     await call.message.edit_text(
-        ("<b><u>Are these the files that you want to merge?</u></b>\n\n" + file_list),
-        reply_markup=keyboard,
+        "<b><u>Are these the files that you want to merge?</u></b>\n\n"
+        + format_file_list(files),
+        reply_markup=confirmation_keyboard(),
     )
 
     await call.answer()
 
 
 @dp.callback_query_handler(text_startswith="rm_")
-async def delete_file(call: types.CallbackQuery):
+async def delete_file(call: types.CallbackQuery, state: FSMContext):
     """
     This handler will be called once user chooses the file they want to delete
     from the list of files. Deletes that file from the list and gets
     confirmation on the file list.
     """
-    # sorted is called since the file names have corresponding file counts
-    # this is done to maintain the order of the files
-    # (the files will be merged in the order that the user sends the files in)
-    files = sorted(listdir(f"{input_path}/{call.message.chat.id}"))
+    files = await get_files(state)
+
+    # the call.data should look like "rm_" + the index of the file
+    # so the index starts right after rm_ (at 3rd index location)
+    index = int(call.data[3:])
+
+    # the buttons are from an old message
+    if index >= len(files):
+        return await call.answer("This list is outdated.")
 
     if len(files) == 1:
         await call.message.answer(
             "Can't let you do that. There will be nothing left for me to work with."
         )
     else:
-        # the call.data should look like "rm_" + file name
-        # so the file name starts right after rm_ (at 3rd index location)
-        file_name = call.data[3:]
-
-        unlink(f"{input_path}/{call.message.chat.id}/{file_name}")
+        # the file stays on the disk (the same file may be in the list twice),
+        # it's deleted along with all the other files once merging is over
+        del files[index]
+        await state.update_data(files=files)
         logging.info("Removed a specific PDF")
 
-        # once that file is deleted, we fix up the file counts
-        del_file_num = int(file_name[:2])
-
-        if del_file_num < len(files):
-            for file in files[del_file_num:]:
-                file_num = int(file[:2]) - 1
-
-                file_num = f"0{file_num}" if file_num < 10 else str(file_num)
-                rename(
-                    f"{input_path}/{call.message.chat.id}/{file}",
-                    f"{input_path}/{call.message.chat.id}/{file_num}{file[2:]}",
-                )
-
     # once the deletion is over, get the confirmation again
-    files = sorted(listdir(f"{input_path}/{call.message.chat.id}"))
-
-    file_list = [f"{index}. {value[3:]}" for index, value in enumerate(files, start=1)]
-    file_list = "\n".join(file_list)
-
-    keyboard = types.InlineKeyboardMarkup()
-    buttons = [
-        types.InlineKeyboardButton(text="Yes", callback_data="ask_for_name"),
-        types.InlineKeyboardButton(text="No", callback_data="modify_files"),
-    ]
-    keyboard.add(*buttons)
-
     await call.message.edit_text(
-        f"<b><u>Are these the files that you want to merge?</u></b>\n\n{file_list}",
-        reply_markup=keyboard,
+        "<b><u>Are these the files that you want to merge?</u></b>\n\n"
+        + format_file_list(files),
+        reply_markup=confirmation_keyboard(),
     )
 
     await call.answer()
 
 
 @dp.callback_query_handler(text="add")
-async def ask_position(call: types.CallbackQuery):
+async def ask_position(call: types.CallbackQuery, state: FSMContext):
     """
     This handler will be called when user indicates that they want to
     add a file.
     Asks the user where they want to add the new file.
     """
-
-    files_num = len(listdir(f"{input_path}/{call.message.chat.id}"))
+    files = await get_files(state)
 
     keyboard = types.InlineKeyboardMarkup()
 
     buttons = []
 
-    for i in range(1, files_num + 2):
+    for i in range(1, len(files) + 2):
         buttons.append(
             types.InlineKeyboardButton(
                 text=str(i),
@@ -320,7 +256,7 @@ async def ask_position(call: types.CallbackQuery):
 
     await call.message.edit_text(
         "<b><u>Choose where you want to add the new file</u></b>\n\n"
-        + call.message.text[call.message.text.index("1.") :],
+        + format_file_list(files),
         reply_markup=keyboard,
     )
 
@@ -338,18 +274,6 @@ async def prepare_for_addition(call: types.CallbackQuery, state: FSMContext):
     # location number is indicated right after the loc_ prefix (at index 4)
     location = int(call.data[4:])
 
-    files = sorted(listdir(f"{input_path}/{call.message.chat.id}"))
-
-    if location <= len(files):
-        for file in files[location - 1 :]:
-            file_num = int(file[:2]) + 1
-
-            file_num = f"0{file_num}" if file_num < 10 else str(file_num)
-            rename(
-                f"{input_path}/{call.message.chat.id}/{file}",
-                f"{input_path}/{call.message.chat.id}/{file_num}{file[2:]}",
-            )
-
     # storing the desired position in the state
     await state.update_data(num=location)
 
@@ -362,7 +286,7 @@ async def prepare_for_addition(call: types.CallbackQuery, state: FSMContext):
 
 
 @dp.callback_query_handler(text="no_cancel")
-async def just_cancel(call: types.CallbackQuery):
+async def just_cancel(call: types.CallbackQuery, state: FSMContext):
     """
     This handler will be called when user aborts merging
     from the inline keyboard.
@@ -372,6 +296,10 @@ async def just_cancel(call: types.CallbackQuery):
     # delete the inline keyboard
     await call.message.delete_reply_markup()
 
+    # forget the list of files
+    await state.reset_data()
+    speculative_merge.forget(call.message.chat.id)
+
     files = listdir(f"{input_path}/{call.message.chat.id}/")
 
     if files:
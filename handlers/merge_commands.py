@@ -4,15 +4,29 @@ The part that deals with merging PDF files into one.
 """
 
 import logging
-from os import listdir
 from typing import List
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from loader import bot, dp, input_path, output_path
-from PyPDF2 import PdfFileMerger
+from loader import dp
 from states.all_states import MergingStates
+from utils.admission import admit
+from utils.blob_store import blob_store
 from utils.clean_up import reset
+from utils.convert_file_size import convert_bytes
+from utils.job_queue import Job, job_queue
+from utils.merge_manifest import (
+    add_files,
+    confirmation_keyboard,
+    file_path,
+    format_file_list,
+    get_files,
+    new_entry,
+)
+from utils import speculative_merge
+from utils.pdf_engine import compact_output, run_pdf_job
+from utils.pdf_ops import MergeJob
+from utils.throttling import rate_limit
 
 
 @dp.message_handler(commands="done", state=MergingStates.waiting_for_files_to_merge)
@@ -21,12 +35,11 @@ async def get_confirmation(message: types.Message, state: FSMContext):
     This handler will be called when user sends `/done` command.
     Gets confirmation on the files that need to be merged.
     """
-    await state.finish()
+    # the state is reset, but the list of files (in the state data) is kept
+    await state.reset_state(with_data=False)
 
-    # sorted is called since the file names have corresponding file counts
-    # this is done to maintain the order of the files
-    # (the files will be merged in the order that the user sends the files in)
-    files = sorted(listdir(f"{input_path}/{message.chat.id}"))
+    # the files are listed in the order in which they will be merged
+    files = await get_files(state)
 
     if not files:
         await message.reply("You didn't send any PDF files.")
@@ -35,28 +48,12 @@ async def get_confirmation(message: types.Message, state: FSMContext):
             "You sent only one file. What am I supposed to merge it with?"
         )
     else:
-        # since file names are in this format: number_name ("01_cool.pdf")
-        # to provide a list of pdfs for the user, we make the list with a
-        # list comprehension, not displaing the number part of the file
-        # ("01_" in case of "01_cool.pdf")
-        file_list = [
-            f"{index}. {value[3:]}" for index, value in enumerate(files, start=1)
-        ]
-        file_list = "\n".join(file_list)
-
-        keyboard = types.InlineKeyboardMarkup()
-        buttons = [
-            types.InlineKeyboardButton(text="Yes", callback_data="ask_for_name"),
-            types.InlineKeyboardButton(text="No", callback_data="modify_files"),
-        ]
-        keyboard.add(*buttons)
-
         await message.reply(
             (
                 "<b><u>Are these the files that you want to merge?</u></b>\n\n"
-                + file_list
+                + format_file_list(files)
             ),
-            reply_markup=keyboard,
+            reply_markup=confirmation_keyboard(),
         )
 
 
@@ -65,42 +62,42 @@ async def get_confirmation(message: types.Message, state: FSMContext):
     content_types=types.ContentType.DOCUMENT,
     state=MergingStates.waiting_for_files_to_merge,
 )
-async def handle_albums(message: types.Message, album: List[types.Message]):
+@rate_limit(3, "merge")
+async def handle_albums(
+    message: types.Message, album: List[types.Message], state: FSMContext
+):
     """
     This handler will be called when user sends a group of files
     as an album for merging. Checks if the files are PDF files and asks
     if there are any more files that need to be merged.
     """
-    await message.answer("Downloading files, please wait")
-
+    # checking all the files before downloading any of them
     for obj in album:
-        name = obj.document.file_name
+        if not obj.document.file_name.lower().endswith(".pdf"):
+            return await message.answer("That's not a PDF file.")
 
-        # replacing empty spaces in the file name with underscores
-        # if there are spaces in the file name, some of the code does not work
-        # there definitely should be a better way of doing this, but i'm dumb
-        if " " in name:
-            name = name.replace(" ", "_")
+    # checking the files before downloading them
+    if not await admit(message, [obj.document for obj in album]):
+        return
 
-        if not name.lower().endswith(".pdf"):
-            return await message.answer("That's not a PDF file.")
+    await message.answer("Downloading files, please wait")
 
-        # initially there should be no files in this directory,
-        # so to start with "1" for the first file, we add 1
-        # the whole reason why we have the file count is so that the order
-        # of files is maintained and can be changed around later.
-        file_count = len(listdir(f"{input_path}/{message.chat.id}")) + 1
+    # the files are downloaded at the same time, their order is kept in
+    # the list of files
+    entries = [new_entry(obj) for obj in album]
 
-        # to have file counts like "01", "02", etc so that the order is still
-        # maintained if the user sends more than 9 files
-        if file_count < 10:
-            file_count = "0" + str(file_count)
+    await blob_store.fetch_many(
+        [
+            (obj.document, file_path(message.chat.id, entry))
+            for obj, entry in zip(album, entries)
+        ]
+    )
+    logging.info("Files downloaded.")
 
-        await bot.download_file_by_id(
-            obj.document.file_id,
-            destination=f"{input_path}/{message.chat.id}/{file_count}_{name}",
-        )
-        logging.info("File downloaded.")
+    await add_files(state, message.chat.id, entries)
+
+    # the files are checked (and merged) while the user sends the rest
+    speculative_merge.check_files(state, message.chat.id, entries)
 
     await message.answer(
         "Great, if you have any more PDF files you want to merge, "
@@ -113,7 +110,8 @@ async def handle_albums(message: types.Message, album: List[types.Message]):
     content_types=types.message.ContentType.DOCUMENT,
     state=MergingStates.waiting_for_files_to_merge,
 )
-async def merge_file_received(message: types.Message):
+@rate_limit(2, "merge")
+async def merge_file_received(message: types.Message, state: FSMContext):
     """
     This handler will be called when user provides a file for merging.
     Checks if the file is a PDF and asks if there are any more files
@@ -121,31 +119,25 @@ async def merge_file_received(message: types.Message):
     """
     name = message.document.file_name
     if name.endswith(".pdf"):
-        # replacing empty spaces in the file name with underscores
-        # if there are spaces in the file name, some of the code does not work
-        # there definitely should be a better way of doing this, but i'm dumb
-        if " " in name:
-            name = name.replace(" ", "_")
-
-        # initially there should be no files in this directory,
-        # so to start with "1" for the first file, we add 1
-        # the whole reason why we have the file count is so that the order
-        # of files is maintained and can be changed around later.
-        file_count = len(listdir(f"{input_path}/{message.chat.id}")) + 1
-
-        # to have file counts like "01", "02", etc so that the order is still
-        # maintained if the user sends more than 9 files
-        if file_count < 10:
-            file_count = "0" + str(file_count)
+        # checking the file before downloading it
+        if not await admit(message, [message.document]):
+            return
 
         await message.answer("Downloading the file, please wait")
 
-        await bot.download_file_by_id(
-            message.document.file_id,
-            destination=f"{input_path}/{message.chat.id}/{file_count}_{name}",
+        entry = new_entry(message)
+
+        await blob_store.fetch(
+            message.document, destination=file_path(message.chat.id, entry)
         )
         logging.info("File downloaded")
 
+        # the files are kept in the order in which they were sent
+        await add_files(state, message.chat.id, [entry])
+
+        # the file is checked (and merged) while the user sends the rest
+        speculative_merge.check_files(state, message.chat.id, [entry])
+
         await message.reply(
             "Great, if you have any more PDF files you want to merge, "
             "send them now. Once you are done, send /done"
@@ -161,13 +153,13 @@ async def merge_file_received(message: types.Message):
     content_types=types.message.ContentType.DOCUMENT,
     state=MergingStates.waiting_for_specific_file,
 )
+@rate_limit(2, "merge")
 async def specific_file_received(message: types.Message, state: FSMContext):
     """
     This handler will be called when user sends a file of type `Document`
     that has to be added to a certain position in the list of files (Merging).
     Checks if the file is a PDF and adds it to the desired position in the
-    list of files. This is done by naming the file with the appropriate
-    file count number.
+    list of files.
     After the file is added, triggers the get confirmation function to
     confirm the new list of files.
     """
@@ -175,30 +167,26 @@ async def specific_file_received(message: types.Message, state: FSMContext):
     if name.endswith(".pdf"):
         logging.info("Adding a file")
 
-        # replacing empty spaces in the file name with underscores
-        # if there are spaces in the file name, some of the code does not work
-        # there definitely should be a better way of doing this, but i'm dumb
-        if " " in name:
-            name = name.replace(" ", "_")
-
         # the desired position of the file will be stored in the state
-        file_count = await state.get_data()
-        file_count = file_count["num"]
+        data = await state.get_data()
+        position = data["num"]
 
-        # to have file counts like "01", "02", etc so that the order is still
-        # maintained if the user sends more than 9 files
-        if file_count < 10:
-            file_count = "0" + str(file_count)
+        # checking the file before downloading it
+        if not await admit(message, [message.document]):
+            return
 
         await message.answer("Downloading the file, please wait")
 
-        await bot.download_file_by_id(
-            message.document.file_id,
-            destination=f"{input_path}/{message.chat.id}/{file_count}_{name}",
+        entry = new_entry(message)
+
+        await blob_store.fetch(
+            message.document, destination=file_path(message.chat.id, entry)
         )
         logging.info("File downloaded")
 
-        await state.finish()
+        # positions shown to the user start from 1
+        await add_files(state, message.chat.id, [entry], position=position - 1)
+        speculative_merge.check_files(state, message.chat.id, [entry])
 
         # getting confirmation on the new list of files
         await get_confirmation(message, state)
@@ -209,6 +197,7 @@ async def specific_file_received(message: types.Message, state: FSMContext):
 
 
 @dp.message_handler(state=MergingStates.waiting_for_a_name)
+@rate_limit(5, "merge")
 async def merge_files(message: types.Message, state: FSMContext):
     """
     This handler will be called when user provides a name for the merged PDF.
@@ -216,17 +205,8 @@ async def merge_files(message: types.Message, state: FSMContext):
     """
     await message.answer("Working on it")
 
-    # sorted is called since the file names have corresponding file counts
-    # this is done to maintain the order of the files
-    # (the files will be merged in the order that the user sends the files in)
-    files = sorted(listdir(f"{input_path}/{message.chat.id}"))
-
-    logging.info("Merging started")
-
-    merger = PdfFileMerger(strict=False)
-
-    for file in files:
-        merger.append(f"{input_path}/{message.chat.id}/{file}")
+    # the files are merged in the order of the list of files
+    files = await get_files(state)
 
     # replace the white space with underscores if there are spaces
     # otherwise some stuff doesn't work, im too dumb to figure out why for now
@@ -235,14 +215,60 @@ async def merge_files(message: types.Message, state: FSMContext):
     if not message.text.lower().endswith(".pdf"):
         merged_pdf_name = merged_pdf_name + ".pdf"
 
-    output = f"{output_path}/{message.chat.id}/{merged_pdf_name}"
+    # the files may have been merged in the background already,
+    # then the job only has to send the result
+    premerged = await speculative_merge.merged(message.chat.id, files)
+
+    # the merging itself is done once it's this user's turn in the queue
+    # (the files are kept by the job, so the user's files can be cleaned up)
+    if premerged is not None:
+        path, saved = premerged
+        await job_queue.submit(
+            "merge",
+            message,
+            inputs=[path],
+            name=merged_pdf_name,
+            premerged=True,
+            saved=saved,
+        )
+    else:
+        await job_queue.submit(
+            "merge",
+            message,
+            inputs=[file_path(message.chat.id, file) for file in files],
+            name=merged_pdf_name,
+        )
 
-    merger.write(output)
-    merger.close()
+    await reset(message, state)
 
-    with open(output, "rb") as result:
-        await message.answer_chat_action(action="upload_document")
-        await message.reply_document(result, caption="Here you go")
-        logging.info("Sent the document")
 
-    await reset(message, state)
+@job_queue.runner("merge", tool="pdf")
+async def run_merging(job: Job):
+    """
+    Merges the files of the job (in the order of the list) and sends
+    the result to the user.
+    """
+    if job.params.get("premerged"):
+        # merged in the background already (utils/speculative_merge.py)
+        output = types.InputFile(job.inputs[0], filename=job.params["name"])
+        saved = job.params["saved"]
+    else:
+        logging.info("Merging started")
+
+        output = job.output(job.params["name"])
+
+        # the merging itself is done in a separate process
+        saved = await run_pdf_job(
+            MergeJob(
+                inputs=job.inputs, output=output, compact=compact_output(*job.inputs)
+            )
+        )
+        output = types.InputFile(output)
+
+    caption = "Here you go"
+    if saved:
+        # the files had fonts or images in common
+        caption += f"\n(the shared fonts and images saved {convert_bytes(saved)})"
+
+    await job.reply_document(output, caption=caption)
+    logging.info("Sent the document")
@@ -1,17 +1,91 @@
 """
 The part that deals with splitting PDF files.
-(Extracting specific pages from a PDF and saving them to a separate file)
+(Extracting specific pages from a PDF and saving them to a separate file,
+or splitting it into many files at once)
 """
 
 import logging
+import re
 from os import listdir
+from os.path import basename, splitext
+from typing import List, Optional, Tuple, Union
 
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from loader import bot, dp, input_path, output_path
-from PyPDF2 import PdfFileReader, PdfFileWriter
+from loader import dp, input_path
 from states.all_states import SplittingStates
+from utils.admission import admit
+from utils.blob_store import blob_store
 from utils.clean_up import reset
+from utils.job_queue import Job, job_queue
+from utils.pdf_engine import compact_output, run_pdf_job
+from utils.pdf_ops import BurstJob, ExtractJob, PageRangeError, Pages, PdfJobError
+from utils.result_cache import result_cache, send_cached_result
+from utils.throttling import rate_limit
+
+
+USAGE = (
+    "<i><b>Examples of Usage:</b></i>\n"
+    "<b>3-5</b> ➝ <i>pages 3, 4 and 5</i>\n"
+    "<b>7</b> ➝ <i>just the 7th page</i>\n\n"
+    "<b>Note:</b> You can also use combinations by just using "
+    "<b>a comma and a space</b> like so:\n"
+    "<b>3-5, 7</b> ➝ <i>pages 3, 4, 5 and 7</i>\n\n"
+    "<i><b>Or split it into many files at once (you'll get a ZIP):</b></i>\n"
+    "<b>every 10</b> ➝ <i>a file for every 10 pages</i>\n"
+    "<b>4 parts</b> ➝ <i>4 files with the same number of pages</i>\n"
+    "<b>1-3; 4-10, 12</b> ➝ <i>a file for each group of pages</i>\n"
+    "<b>chapters</b> ➝ <i>a file for every chapter (bookmark)</i>"
+)
+
+
+def parse_pages(text: str) -> Pages:
+    """
+    Turns "3-5, 7" into [(3, 5), 7].
+    Raises ValueError if the pages are not in the right format.
+    """
+    # since we ask the users to provide the desired pages in a format like:
+    # 3-5, 7, 10-11 (pages 3, 4, 5, 7, 10 and 11)
+    # first we split on the comma and space to get ["3-5", "7", "10-11"]
+    pages = text.split(", ")
+    # then we split on the dash if it's there, to get:
+    # [["3", "5"], "7", ["10", "11"]]
+    pages = [page.split("-") if "-" in page else page for page in pages]
+
+    # converting all of the numbers to integers type
+    # (ranges become tuples like (3, 5))
+    return [
+        tuple(map(int, page[:2])) if type(page) == list else int(page)
+        for page in pages
+    ]
+
+
+def parse_burst(text: str) -> Optional[Tuple[str, Union[int, List[Pages], None]]]:
+    """
+    Returns the mode and the value of the BurstJob if the user wants
+    many files, None if it's just pages.
+    Raises ValueError if the groups of pages are not in the right format.
+    """
+    text = text.strip().lower()
+
+    if text in ("chapters", "each chapter", "every chapter"):
+        return "chapters", None
+
+    every = re.fullmatch(r"every (\d+)( pages?)?", text)
+    if every:
+        return "every", int(every.group(1))
+
+    parts = re.fullmatch(r"(\d+) (parts|files)", text)
+    if parts:
+        return "parts", int(parts.group(1))
+
+    # the groups are separated by semicolons: 1-3; 4-10, 12
+    if ";" in text:
+        return "groups", [
+            parse_pages(group.strip()) for group in text.split(";") if group.strip()
+        ]
+
+    return None
 
 
 @dp.message_handler(
@@ -19,13 +93,18 @@ from utils.clean_up import reset
     content_types=types.message.ContentType.DOCUMENT,
     state=SplittingStates.waiting_for_files_to_split,
 )
-async def extract_file_received(message: types.Message):
+@rate_limit(2, "split")
+async def extract_file_received(message: types.Message, state: FSMContext):
     """
     This handler will be called when user provides a file to split.
     Checks if a file is a PDF and asks to input the desired pages
     """
     name = message.document.file_name
     if name.endswith(".pdf"):
+        # checking the file before downloading it
+        if not await admit(message, [message.document]):
+            return
+
         await message.answer("Downloading the file, please wait")
 
         # replacing empty spaces in the file name with underscores
@@ -34,21 +113,19 @@ async def extract_file_received(message: types.Message):
         if " " in name:
             name = name.replace(" ", "_")
 
-        await bot.download_file_by_id(
-            message.document.file_id,
+        await blob_store.fetch(
+            message.document,
             destination=f"{input_path}/{message.chat.id}/{name}",
             timeout=90,
         )
         logging.info(f"File (to be extracted) downloaded")
 
+        # the unique id of the file is used to look up cached results
+        await state.update_data(unique_id=message.document.file_unique_id)
+
         await message.reply(
             "Great, indicate the pages that you want your new PDF to have.\n\n"
-            "<i><b>Examples of Usage:</b></i>\n"
-            "<b>3-5</b> ➝ <i>pages 3, 4 and 5</i>\n"
-            "<b>7</b> ➝ <i>just the 7th page</i>\n\n"
-            "<b>Note:</b> You can also use combinations by just using "
-            "<b>a comma and a space</b> like so:\n"
-            "<b>3-5, 7</b> ➝ <i>pages 3, 4, 5 and 7</i>"
+            + USAGE
         )
 
         # the next state is waiting for desired pages
@@ -60,6 +137,7 @@ async def extract_file_received(message: types.Message):
 
 
 @dp.message_handler(state=SplittingStates.waiting_for_pages)
+@rate_limit(3, "split")
 async def extract_pages(message: types.Message, state: FSMContext):
     """
     This handler will be called when user provides the pages that they want
@@ -73,83 +151,136 @@ async def extract_pages(message: types.Message, state: FSMContext):
     files = listdir(f"{input_path}/{message.chat.id}")
 
     input_file = f"{input_path}/{message.chat.id}/{files[0]}"
-    output_file = f"{output_path}/{message.chat.id}/Split_{files[0]}"
-
-    with open(input_file, "rb") as file:
-        reader = PdfFileReader(file)
-        writer = PdfFileWriter()
-
-        page_count = reader.getNumPages()
-
-        # since we ask the users to provide the desired pages in a format like:
-        # 3-5, 7, 10-11 (pages 3, 4, 5, 7, 10 and 11)
-        # first we split on the comma and space to get ["3-5", "7", "10-11"]
-        pages = message.text.split(", ")
-        # then we split on the dash if it's there, to get:
-        # [["3", "5"], "7", ["10", "11"]]
-        pages = [page.split("-") if "-" in page else page for page in pages]
-
-        try:
-            # converting all of the numbers to integers type
-            pages = [
-                list(map(int, page)) if type(page) == list else int(page)
-                for page in pages
-            ]
-        except ValueError:
-            # await SplittingStates.waiting_for_pages.set()
-            await message.reply(
-                "You typed in the wrong format. Try again.\n\n"
-                "<i><b>Examples of Usage:</b></i>\n"
-                "<b>3-5</b> ➝ <i>pages 3, 4 and 5</i>\n"
-                "<b>7</b> ➝ <i>just the 7th page</i>\n\n"
-                "<b>Note:</b> You can also use combinations by just using "
-                "<b>a comma and a space</b> like so:\n"
-                "<b>3-5, 7</b> ➝ <i>pages 3, 4, 5 and 7</i>"
+
+    try:
+        burst = parse_burst(message.text)
+        pages = None if burst else parse_pages(message.text)
+    except ValueError:
+        await message.reply("You typed in the wrong format. Try again.\n\n" + USAGE)
+        return
+
+    if burst:
+        return await burst_pages(message, state, input_file, files[0], *burst)
+
+    # if the same pages were already extracted from this file,
+    # just send the document that was sent back then
+    data = await state.get_data()
+    cache_key = result_cache.make_key(
+        "split", [data.get("unique_id")], pages=pages, name=files[0]
+    )
+
+    if await send_cached_result(message, cache_key):
+        return await reset(message, state)
+
+    # the pages are extracted once it's this file's turn in the queue
+    # (the file is kept by the job, so the user's files can be cleaned up)
+    await job_queue.submit(
+        "split",
+        message,
+        inputs=[input_file],
+        pages=pages,
+        cache_key=cache_key,
+        unique_id=data.get("unique_id"),
+        user_id=message.from_user.id,
+    )
+
+    await reset(message, state)
+
+
+@job_queue.runner("split", tool="pdf")
+async def run_extraction(job: Job):
+    """
+    Extracts the pages of the job from the PDF and sends them back
+    to the user. If the pages are invalid, the user is asked to try again.
+    """
+    logging.info("Extracting pages started")
+
+    input_file = job.inputs[0]
+    output_file = job.output(f"Split_{basename(input_file)}")
+
+    # the pages are checked and extracted in a separate process
+    try:
+        await run_pdf_job(
+            ExtractJob(
+                input=input_file,
+                pages=job.params["pages"],
+                output=output_file,
+                compact=compact_output(input_file),
             )
-            return
+        )
+    except PageRangeError as err:
+        await job.reply(str(err))
+        return await job.ask_again(
+            SplittingStates.waiting_for_pages, unique_id=job.params["unique_id"]
+        )
+
+    sent = await job.reply_document(types.InputFile(output_file))
+
+    result_cache.put(job.params["cache_key"], sent.document.file_id)
 
-        for page in pages:
-            # user typed in a range
-            if type(page) == list:
-                start = page[0]
-                end = page[1]
-
-                # checking for invalid input
-                if start > end:
-                    await message.reply("Invalid pages indicated. Try again.")
-                    return
-                elif start == 0 or end == 0:
-                    await message.reply("Zero is not a valid page number. Try again.")
-                    return
-                elif start > page_count or end > page_count:
-                    await message.reply(
-                        "Your PDF doesn't have that many pages. Try again."
-                    )
-                    return
-
-                # page numbers start from zero in pypdf2, so we subtract 1
-                for i in range(start - 1, end):
-                    writer.addPage(reader.getPage(i))
-            # user typed in a number
-            else:
-                # checking for invalid input
-                if page == 0:
-                    await message.reply("Zero is not a valid page number. Try again.")
-                    return
-                elif page > page_count:
-                    await message.reply(
-                        "Your PDF doesn't have that many pages. Try again."
-                    )
-                    return
-
-                # page numbers start from zero in pypdf2, so we subtract 1
-                writer.addPage(reader.getPage(page - 1))
-
-        with open(output_file, "wb") as result:
-            writer.write(result)
-
-        with open(output_file, "rb") as result:
-            await message.answer_chat_action(action="upload_document")
-            await message.reply_document(result, caption="Here you go")
+
+async def burst_pages(
+    message: types.Message,
+    state: FSMContext,
+    input_file: str,
+    name: str,
+    mode: str,
+    value: Union[int, List[Pages], None],
+):
+    """
+    Splits the PDF into many files in one go (parsing it only once)
+    and sends them back in a single ZIP.
+    """
+    data = await state.get_data()
+    cache_key = result_cache.make_key(
+        "split", [data.get("unique_id")], burst=[mode, value], name=name
+    )
+
+    if await send_cached_result(message, cache_key):
+        return await reset(message, state)
+
+    await job_queue.submit(
+        "burst",
+        message,
+        inputs=[input_file],
+        mode=mode,
+        value=value,
+        cache_key=cache_key,
+        unique_id=data.get("unique_id"),
+        user_id=message.from_user.id,
+    )
 
     await reset(message, state)
+
+
+@job_queue.runner("burst", tool="pdf")
+async def run_burst(job: Job):
+    """
+    Splits the PDF of the job into many files and sends them back in a ZIP.
+    If the pages don't work out, the user is asked to try again.
+    """
+    logging.info("Splitting into many files started")
+
+    input_file = job.inputs[0]
+    output_file = job.output(f"Split_{splitext(basename(input_file))[0]}.zip")
+
+    try:
+        count = await run_pdf_job(
+            BurstJob(
+                input=input_file,
+                mode=job.params["mode"],
+                value=job.params["value"],
+                output=output_file,
+            )
+        )
+    except PdfJobError as err:
+        await job.reply(str(err))
+        return await job.ask_again(
+            SplittingStates.waiting_for_pages, unique_id=job.params["unique_id"]
+        )
+
+    sent = await job.reply_document(
+        types.InputFile(output_file), caption=f"Here you go, {count} files"
+    )
+
+    result_cache.put(job.params["cache_key"], sent.document.file_id)
@@ -2,17 +2,45 @@ import logging
 import os
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 
 from data import config
+from utils.fsm_storage import RedisStorage, SQLiteStorage
 
 # these paths will be used in the handlers files
 cwd = os.getcwd()
 input_path = os.path.join(cwd, "user_files", "input")
 output_path = os.path.join(cwd, "user_files", "output")
 
-bot = Bot(token=config.BOT_TOKEN, parse_mode=types.ParseMode.HTML)
-storage = MemoryStorage()
+# the bot talks to api.telegram.org, unless another Bot API server is set
+if config.TELEGRAM_API_URL:
+    server = TelegramAPIServer.from_base(config.TELEGRAM_API_URL)
+else:
+    server = TELEGRAM_PRODUCTION
+
+bot = Bot(token=config.BOT_TOKEN, parse_mode=types.ParseMode.HTML, server=server)
+
+# the states of the users are kept in the storage chosen in the config
+storage_options = dict(
+    flush_interval=config.FSM_FLUSH_INTERVAL_MS / 1000,
+    cache_size=config.FSM_CACHE_SIZE,
+)
+if config.FSM_STORAGE == "redis":
+    storage = RedisStorage(
+        host=config.REDIS_HOST,
+        port=config.REDIS_PORT,
+        db=config.REDIS_DB,
+        password=config.REDIS_PASSWORD,
+        **storage_options,
+    )
+elif config.FSM_STORAGE == "sqlite":
+    storage = SQLiteStorage(
+        os.path.join(cwd, "user_files", "fsm.sqlite3"), **storage_options
+    )
+else:
+    storage = MemoryStorage()
+
 dp = Dispatcher(bot, storage=storage)
 
 logging.basicConfig(
@@ -0,0 +1,344 @@
+"""
+A stand-in for the Telegram Bot API, so the bot can be run under load
+without talking to telegram. Point the bot at it with TELEGRAM_API_URL.
+
+It implements the methods the bot (and aiogram) uses (getUpdates, getFile and the file
+downloads, sendMessage, sendDocument, sendMediaGroup, editMessageText and
+a few smaller ones), keeps the files in memory and puts everything the bot
+sends into the inbox of the chat it was sent to. The simulated users
+(loadtest/run.py) send their messages and press buttons through it as well:
+
+    api = FakeBotAPI(token)
+    await api.start("127.0.0.1", 8081)
+
+    api.send_message(chat_id, text="/merge")
+    event = await api.inbox(chat_id).get()
+"""
+import asyncio
+import itertools
+import json
+import logging
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+
+class BadRequest(Exception):
+    pass
+
+
+class FakeBotAPI:
+    def __init__(self, token: str):
+        self.token = token
+        self.me = {
+            "id": int(token.split(":")[0]),
+            "is_bot": True,
+            "first_name": "Vivy",
+            "username": "vivy_loadtest_bot",
+        }
+
+        self.updates: List[dict] = []
+        self._update_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        # set once the bot asks for the updates for the first time
+        self.polling = asyncio.Event()
+
+        # file_id -> {"file_unique_id", "file_name", "data"}
+        self.files: Dict[str, dict] = {}
+        self._message_ids = itertools.count(1)
+        # callback query id -> chat id (for the answers to the callbacks)
+        self._callbacks: Dict[str, int] = {}
+        self._inboxes: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+
+        # how many times every method was called
+        self.calls: Counter = Counter()
+
+        self._runner: Optional[web.AppRunner] = None
+
+    # the bot's side
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Starts the server and returns its address (port 0 picks a free one)."""
+        app = web.Application(client_max_size=100 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/bot{token}/{method}", self._handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._download)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        if request.match_info["token"] != self.token:
+            return web.json_response(
+                {"ok": False, "error_code": 401, "description": "Unauthorized"},
+                status=401,
+            )
+
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+
+        handler = getattr(self, f"_{method}", None)
+        if handler is None:
+            logging.warning(f"The fake Bot API doesn't know {method}")
+            return web.json_response(
+                {"ok": False, "error_code": 404, "description": "Not Found"},
+                status=404,
+            )
+
+        params = dict(await request.post())
+
+        try:
+            result = await handler(params)
+        except BadRequest as err:
+            self.calls["errors"] += 1
+            return web.json_response(
+                {"ok": False, "error_code": 400, "description": f"Bad Request: {err}"},
+                status=400,
+            )
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def _download(self, request: web.Request) -> web.Response:
+        self.calls["download"] += 1
+
+        file = self.files.get(request.match_info["path"].split("/")[-1])
+        if request.match_info["token"] != self.token or file is None:
+            return web.Response(status=404)
+
+        return web.Response(body=file["data"])
+
+    async def _getme(self, params):
+        return self.me
+
+    async def _getupdates(self, params):
+        self.polling.set()
+
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        timeout = float(params.get("timeout", 0))
+
+        # the updates below the offset were received by the bot
+        self.updates = [
+            update for update in self.updates if update["update_id"] >= offset
+        ]
+
+        if not self.updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        return self.updates[:limit]
+
+    async def _deletewebhook(self, params):
+        return True
+
+    async def _setwebhook(self, params):
+        return True
+
+    async def _getwebhookinfo(self, params):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+
+    async def _setmycommands(self, params):
+        return True
+
+    async def _sendchataction(self, params):
+        return True
+
+    async def _deletemessage(self, params):
+        return True
+
+    async def _editmessagereplymarkup(self, params):
+        return True
+
+    async def _answercallbackquery(self, params):
+        chat_id = self._callbacks.pop(params["callback_query_id"], None)
+
+        if chat_id is not None and params.get("text"):
+            self._deliver(chat_id, "callback_answer", {"text": params["text"]})
+
+        return True
+
+    async def _getfile(self, params):
+        file = self.files.get(params.get("file_id"))
+        if file is None:
+            raise BadRequest("invalid file_id")
+
+        return {
+            "file_id": params["file_id"],
+            "file_unique_id": file["file_unique_id"],
+            "file_size": len(file["data"]),
+            "file_path": f"documents/{params['file_id']}",
+        }
+
+    async def _sendmessage(self, params):
+        message = self._bot_message(params, text=params["text"])
+        self._deliver(message["chat"]["id"], "message", message)
+        return message
+
+    async def _editmessagetext(self, params):
+        message = self._bot_message(params, text=params["text"])
+        message["message_id"] = int(params["message_id"])
+        message["edit_date"] = message["date"]
+
+        self._deliver(message["chat"]["id"], "edit", message)
+        return message
+
+    async def _senddocument(self, params):
+        message = self._bot_message(
+            params,
+            document=self._received_file(params["document"]),
+            caption=params.get("caption"),
+        )
+        self._deliver(message["chat"]["id"], "message", message)
+        return message
+
+    async def _sendmediagroup(self, params):
+        media_group_id = uuid.uuid4().hex
+        messages = []
+
+        for item in json.loads(params["media"]):
+            media = item["media"]
+
+            # attached files are sent as other parts of the request
+            if media.startswith("attach://"):
+                media = params[media[len("attach://"):]]
+
+            message = self._bot_message(
+                params,
+                document=self._received_file(media),
+                caption=item.get("caption"),
+                media_group_id=media_group_id,
+            )
+            messages.append(message)
+            self._deliver(message["chat"]["id"], "message", message)
+
+        return messages
+
+    def _received_file(self, file) -> dict:
+        """Stores an uploaded file (or looks up a file_id) for the message."""
+        if isinstance(file, str):
+            if file not in self.files:
+                raise BadRequest("wrong file identifier/HTTP URL specified")
+            return self.document(file)
+
+        return self.add_file(file.file.read(), file.filename)
+
+    def _bot_message(self, params, **content) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": self.me,
+            **{key: value for key, value in content.items() if value is not None},
+        }
+
+        if params.get("reply_markup"):
+            markup = json.loads(params["reply_markup"])
+            if "inline_keyboard" in markup:
+                message["reply_markup"] = markup
+
+        return message
+
+    def _deliver(self, chat_id: int, kind: str, message: dict):
+        self._inboxes[chat_id].put_nowait({"kind": kind, "message": message})
+
+    # the users' side
+
+    def inbox(self, chat_id: int) -> asyncio.Queue:
+        """
+        Everything the bot sends to the chat, as {"kind", "message"}, where
+        kind is "message", "edit" or "callback_answer".
+        """
+        return self._inboxes[chat_id]
+
+    def add_file(self, data: bytes, name: str) -> dict:
+        """Stores a file and returns it as a Document."""
+        file_id = uuid.uuid4().hex
+        # every upload is a new file to the bot (the same as on telegram,
+        # unless the user forwards a file)
+        self.files[file_id] = {
+            "file_unique_id": uuid.uuid4().hex[:16],
+            "file_name": name,
+            "data": data,
+        }
+        return self.document(file_id)
+
+    def document(self, file_id: str) -> dict:
+        file = self.files[file_id]
+        return {
+            "file_id": file_id,
+            "file_unique_id": file["file_unique_id"],
+            "file_name": file["file_name"],
+            "file_size": len(file["data"]),
+        }
+
+    def _push(self, update: dict):
+        update["update_id"] = next(self._update_ids)
+        self.updates.append(update)
+        self._new_updates.set()
+
+    def send_message(self, chat_id: int, **content) -> dict:
+        """
+        Sends a message from the user to the bot,
+        e.g. send_message(chat_id, text="/start").
+        """
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}"},
+            **content,
+        }
+
+        if message.get("text", "").startswith("/"):
+            command = message["text"].split()[0]
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(command)}
+            ]
+
+        self._push({"message": message})
+        return message
+
+    def send_photo(self, chat_id: int, data: bytes, width: int, height: int) -> dict:
+        photo = self.add_file(data, "photo.jpg")
+        del photo["file_name"]
+
+        return self.send_message(
+            chat_id, photo=[{**photo, "width": width, "height": height}]
+        )
+
+    def press(self, chat_id: int, message: dict, data: str):
+        """Presses an inline button (with this callback_data) under the message."""
+        query_id = uuid.uuid4().hex
+        self._callbacks[query_id] = chat_id
+
+        self._push(
+            {
+                "callback_query": {
+                    "id": query_id,
+                    "from": {
+                        "id": chat_id,
+                        "is_bot": False,
+                        "first_name": f"User {chat_id}",
+                    },
+                    "message": message,
+                    "chat_instance": str(chat_id),
+                    "data": data,
+                }
+            }
+        )
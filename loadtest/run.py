@@ -0,0 +1,450 @@
+"""
+Drives the bot with simulated users, through the fake Bot API
+(loadtest/fake_api.py), and reports how it held up.
+
+    python -m loadtest.run --users 20 --rounds 3 --pages 10
+
+Starts the fake API and the bot (app.py, in a scratch directory, with
+TELEGRAM_API_URL pointing at the fake API), then every user goes through
+the scenarios (merge, compress, split, encrypt + decrypt, convert images)
+the way a person would: sending the command and the files, pressing the
+buttons and waiting for the replies. Reported are the throughput, the
+p50/p95/p99 of the time from the first message to the result, and the
+error rates (replies like "Sorry, ..." or "Too many requests", and timeouts).
+
+The rest of the bot's settings come from the environment and the .env file
+as usual, e.g. WORKERS=4 to run it sharded. With --no-bot the bot isn't
+started, start it yourself with TELEGRAM_API_URL set to the printed address.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Optional, Union
+
+from PIL import Image, ImageDraw
+
+repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_path)
+
+from benchmarks.corpus import write_pdf  # noqa: E402
+from loadtest.fake_api import FakeBotAPI  # noqa: E402
+
+TOKEN = "123456:loadtest"
+ADMIN = 1
+FIRST_CHAT_ID = 10000
+
+# replies that mean the scenario didn't work out
+FAILURES = (
+    "Sorry",
+    "overloaded",
+    "Too many requests",
+    "Try again",
+    "That's not a PDF",
+)
+
+
+class ScenarioError(Exception):
+    pass
+
+
+class User:
+    def __init__(self, api: FakeBotAPI, chat_id: int, timeout: float, think: float):
+        self.api = api
+        self.chat_id = chat_id
+        self.timeout = timeout
+        self.inbox = api.inbox(chat_id)
+
+        # how long the user takes to react to a reply, this time isn't
+        # counted in the latency
+        self.think = think
+        self.thinking = 0.0
+
+        self.pdfs: List[dict] = []
+        self.photo: Optional[bytes] = None
+        self.photo_size = (0, 0)
+
+    def say(self, text: str):
+        self.api.send_message(self.chat_id, text=text)
+
+    def send_document(self, document: dict):
+        self.api.send_message(self.chat_id, document=document)
+
+    def send_photo(self):
+        self.api.send_photo(self.chat_id, self.photo, *self.photo_size)
+
+    def press(self, message: dict, data: str):
+        self.api.press(self.chat_id, message, data)
+
+    async def expect(self, what: Union[str, Callable[[dict], bool]]) -> dict:
+        """
+        Waits for the bot to send a message containing `what` (or a message
+        `what` returns True for), the messages in between are skipped.
+        """
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            try:
+                event = await asyncio.wait_for(
+                    self.inbox.get(), deadline - time.monotonic()
+                )
+            except asyncio.TimeoutError:
+                name = what if isinstance(what, str) else what.__doc__
+                raise ScenarioError(f"timed out waiting for {name!r}") from None
+
+            message = event["message"]
+            text = message.get("text") or message.get("caption") or ""
+
+            for failure in FAILURES:
+                if failure in text:
+                    raise ScenarioError(text.split("\n")[0][:80])
+
+            # the position in the job queue is edited into a message
+            if event["kind"] != "message":
+                continue
+
+            if what(message) if callable(what) else what in text:
+                await asyncio.sleep(self.think)
+                self.thinking += self.think
+                return message
+
+    async def expect_document(self) -> dict:
+        def has_document(message):
+            """a document"""
+            return "document" in message
+
+        return await self.expect(has_document)
+
+
+async def merge(user: User):
+    user.say("/merge")
+    await user.expect("send me the files that you want merged")
+
+    for document in user.pdfs:
+        user.send_document(document)
+        await user.expect("Once you are done, send /done")
+
+    user.say("/done")
+    confirmation = await user.expect("Are these the files that you want to merge?")
+
+    user.press(confirmation, "ask_for_name")
+    await user.expect("What should the merged file be called?")
+
+    user.say("merged")
+    await user.expect_document()
+
+
+async def compress(user: User):
+    user.say("/compress")
+    await user.expect("send me the PDF that you want compressed")
+
+    user.send_document(user.pdfs[0])
+    question = await user.expect("What should the compressed file be called?")
+
+    # "or use the original file name"
+    button = question["reply_markup"]["inline_keyboard"][0][0]
+    user.press(question, button["callback_data"])
+    await user.expect_document()
+
+
+async def split(user: User):
+    user.say("/split")
+    await user.expect("send me the PDF that you want to split")
+
+    user.send_document(user.pdfs[0])
+    await user.expect("indicate the pages")
+
+    user.say("1-2, 1")
+    await user.expect_document()
+
+
+async def crypt(user: User):
+    user.say("/encrypt")
+    await user.expect("send me the PDF that you want to encrypt")
+
+    user.send_document(user.pdfs[0])
+    await user.expect("type the password")
+
+    user.say("loadtest")
+    encrypted = await user.expect_document()
+
+    # and decrypting the file the bot has just sent
+    user.say("/decrypt")
+    await user.expect("send me the PDF that you want to decrypt")
+
+    user.send_document(encrypted["document"])
+    await user.expect("type the password")
+
+    user.say("loadtest")
+    await user.expect_document()
+
+
+async def convert(user: User):
+    user.say("/convert")
+    await user.expect("Please choose one of the options for conversion")
+
+    user.say("Image(s) to PDF")
+    await user.expect("send me the images")
+
+    user.send_photo()
+    await user.expect("What should the PDF be called?")
+
+    user.say("converted")
+    await user.expect_document()
+
+
+SCENARIOS: Dict[str, Callable[[User], asyncio.Future]] = {
+    "merge": merge,
+    "compress": compress,
+    "split": split,
+    "crypt": crypt,
+    "convert": convert,
+}
+
+
+def make_pdf(pages: int, images: bool, seed: int) -> bytes:
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as file:
+        write_pdf(file.name, pages, images=images, seed=seed)
+        return file.read()
+
+
+def make_photo(size: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    image = Image.new("RGB", (size, size), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+
+    for _ in range(40):
+        x, y = rng.randrange(size), rng.randrange(size)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + size // 4, y + size // 4), fill=color)
+
+    data = io.BytesIO()
+    image.save(data, "JPEG", quality=90)
+    return data.getvalue()
+
+
+async def run_user(user: User, scenarios: List[str], rounds: int, results: list):
+    user.say("/start")
+    await user.expect("Hello, I'm Vivy")
+
+    order = [name for _ in range(rounds) for name in scenarios]
+    random.Random(user.chat_id).shuffle(order)
+
+    for name in order:
+        start = time.monotonic()
+        user.thinking = 0.0
+        error = None
+
+        try:
+            await SCENARIOS[name](user)
+        except ScenarioError as err:
+            error = str(err)
+
+        seconds = time.monotonic() - start - user.thinking
+        results.append({"scenario": name, "seconds": seconds, "error": error})
+
+        if error is not None:
+            # the next scenario starts from a clean state
+            await asyncio.sleep(user.think)
+            user.say("/cancel")
+            try:
+                await user.expect("Operation cancelled")
+            except ScenarioError:
+                pass
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(results: List[dict], seconds: float, calls: Counter) -> dict:
+    summary = {"seconds": seconds, "scenarios": {}, "errors": {}, "api_calls": calls}
+
+    by_scenario = defaultdict(list)
+    for result in results:
+        by_scenario[result["scenario"]].append(result)
+
+    print(f"\n{'scenario':<10} {'runs':>6} {'errors':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+
+    for name, runs in [*sorted(by_scenario.items()), ("all", results)]:
+        ok = [run["seconds"] for run in runs if run["error"] is None]
+        errors = len(runs) - len(ok)
+
+        stats = {"runs": len(runs), "error_rate": errors / len(runs) if runs else 0}
+        if ok:
+            stats.update(
+                p50=percentile(ok, 0.5), p95=percentile(ok, 0.95), p99=percentile(ok, 0.99)
+            )
+        summary["scenarios"][name] = stats
+
+        latencies = (
+            f"{stats['p50']:7.2f}s {stats['p95']:7.2f}s {stats['p99']:7.2f}s"
+            if ok
+            else f"{'-':>8} {'-':>8} {'-':>8}"
+        )
+        print(f"{name:<10} {len(runs):>6} {stats['error_rate']:>7.1%} {latencies}")
+
+    completed = sum(1 for result in results if result["error"] is None)
+    summary["throughput"] = completed / seconds
+
+    print(
+        f"\n{completed} scenarios completed in {seconds:.1f}s "
+        f"({summary['throughput']:.2f}/s)"
+    )
+
+    errors = Counter(
+        f"{result['scenario']}: {result['error']}" for result in results if result["error"]
+    )
+    if errors:
+        print("\nErrors:")
+        for error, count in errors.most_common():
+            print(f"{count:>6}  {error}")
+    summary["errors"] = dict(errors)
+
+    print("\nBot API calls: " + ", ".join(f"{k}={v}" for k, v in sorted(calls.items())))
+
+    return summary
+
+
+def start_bot(url: str, workdir: str) -> subprocess.Popen:
+    """Runs app.py the usual way, only in another directory and with the fake API."""
+    for directory in ("input", "output"):
+        os.makedirs(os.path.join(workdir, "user_files", directory), exist_ok=True)
+
+    env = {
+        **os.environ,
+        "TELEGRAM_API_URL": url,
+        "BOT_TOKEN": TOKEN,
+        "ADMIN": str(ADMIN),
+        "ip": os.environ.get("ip", "127.0.0.1"),
+        "MODE": "polling",
+    }
+
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    return subprocess.Popen(
+        [sys.executable, os.path.join(repo_path, "app.py")],
+        cwd=workdir,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def stop_bot(process: subprocess.Popen):
+    # the same as ctrl+c, so the bot shuts down properly
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def main(args):
+    api = FakeBotAPI(TOKEN)
+    url = await api.start(args.host, args.port)
+    print(f"Fake Bot API listening on {url}")
+
+    bot = None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="loadtest-")
+
+    if not args.no_bot:
+        bot = start_bot(url, workdir)
+        print(f"Bot started in {workdir} (see bot.log there)")
+
+    try:
+        # waiting for the bot to start polling
+        polling = asyncio.ensure_future(api.polling.wait())
+        started = time.monotonic()
+        while not polling.done():
+            await asyncio.wait([polling], timeout=1)
+
+            if bot is not None and bot.poll() is not None:
+                sys.exit(f"The bot exited, see {workdir}/bot.log")
+            if bot is not None and time.monotonic() - started > 120:
+                sys.exit(f"The bot didn't start polling, see {workdir}/bot.log")
+
+        print(f"Generating the files of {args.users} users")
+
+        users = []
+        for index in range(args.users):
+            user = User(api, FIRST_CHAT_ID + index, args.timeout, args.think)
+            seed = user.chat_id
+
+            user.pdfs = [
+                api.add_file(
+                    make_pdf(args.pages, args.images, seed + n), f"file {n + 1}.pdf"
+                )
+                for n in range(args.files)
+            ]
+            user.photo = make_photo(args.photo_size, seed)
+            user.photo_size = (args.photo_size, args.photo_size)
+            users.append(user)
+
+        print(f"Running {', '.join(args.scenarios)} x {args.rounds}")
+
+        results = []
+        start = time.monotonic()
+        await asyncio.gather(
+            *(run_user(user, args.scenarios, args.rounds, results) for user in users),
+            return_exceptions=False,
+        )
+        summary = report(results, time.monotonic() - start, api.calls)
+
+        if args.out:
+            with open(args.out, "w") as file:
+                json.dump({"args": vars(args), **summary}, file, indent=2)
+    finally:
+        if bot is not None:
+            stop_bot(bot)
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10, help="concurrent users")
+    parser.add_argument(
+        "--rounds", type=int, default=1, help="how many times every user does every scenario"
+    )
+    parser.add_argument(
+        "--scenarios",
+        type=lambda value: value.split(","),
+        default=list(SCENARIOS),
+        help="comma separated: " + ",".join(SCENARIOS),
+    )
+    parser.add_argument("--pages", type=int, default=10, help="pages of every PDF")
+    parser.add_argument(
+        "--images", action="store_true", help="a big image on every page of the PDFs"
+    )
+    parser.add_argument("--files", type=int, default=2, help="PDFs every user merges")
+    parser.add_argument("--photo-size", type=int, default=1000, help="in pixels")
+    parser.add_argument(
+        "--think",
+        type=float,
+        default=1,
+        help="seconds a user takes to react to a reply (throttling kicks in without it)",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=120, help="seconds to wait for every reply"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="of the fake API")
+    parser.add_argument("--workdir", help="where the bot keeps its files")
+    parser.add_argument("--no-bot", action="store_true", help="don't start the bot")
+    parser.add_argument("--out", help="save the results as JSON")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    asyncio.run(main(args))
@@ -1,5 +1,15 @@
+from data import config
 from loader import dp
 from .album_handler import AlbumMiddleware
+from .metrics import MetricsMiddleware
+from .throttling import ThrottlingMiddleware
 
 if __name__ == "middlewares":
-    dp.middleware.setup(AlbumMiddleware())
\ No newline at end of file
+    dp.middleware.setup(
+        AlbumMiddleware(
+            quiet=config.ALBUM_QUIET_MS / 1000,
+            max_wait=config.ALBUM_MAX_WAIT_MS / 1000,
+        )
+    )
+    dp.middleware.setup(ThrottlingMiddleware())
+    dp.middleware.setup(MetricsMiddleware())
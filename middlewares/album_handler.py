@@ -1,44 +1,116 @@
 """
 For dealing with files sent as an album.
-Source: https://github.com/WhiteMemory99/aiogram_album_handler/blob/master/example/album.py
+Based on: https://github.com/WhiteMemory99/aiogram_album_handler/blob/master/example/album.py
+
+Telegram sends every file of an album as a separate message (with the same
+media_group_id), one right after another, but under load they can arrive
+quite a bit apart. The first message of an album waits until no new part
+has arrived for a moment (or for too long in total), then its handler gets
+all the parts in `album`. The handlers of the other parts are cancelled.
 """
 
 import asyncio
-from typing import Union
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List
 
 from aiogram import types
 from aiogram.dispatcher.handler import CancelHandler
 from aiogram.dispatcher.middlewares import BaseMiddleware
+from utils.metrics import album_late_parts, album_timeouts, albums_collected
+
+
+class _Album:
+    def __init__(self, first: types.Message):
+        self.parts: List[types.Message] = [first]
+        # set whenever another part arrives
+        self.arrived = asyncio.Event()
 
 
 class AlbumMiddleware(BaseMiddleware):
     """This middleware is for capturing media groups."""
 
-    album_data: dict = {}
-
-    def __init__(self, latency: Union[int, float] = 0.01):
+    def __init__(
+        self, quiet: float = 0.25, max_wait: float = 3, closed_ttl: float = 60
+    ):
         """
-        You can provide custom latency to make sure
-        albums are handled properly in highload.
+        quiet: the album is complete once no part arrived for this long
+        max_wait: the album is handed over after this long in any case
+        closed_ttl: for how long the albums are remembered after they were
+        handed over, to recognize the parts that arrive too late
         """
-        self.latency = latency
+        self.quiet = quiet
+        self.max_wait = max_wait
+        self.closed_ttl = closed_ttl
+
+        # media_group_id -> the album that is being collected
+        self._albums: Dict[str, _Album] = {}
+        # media_group_id -> when the album was handed over (oldest first)
+        self._closed: "OrderedDict[str, float]" = OrderedDict()
+
         super().__init__()
 
+    def _forget_closed(self, now: float):
+        while self._closed:
+            group, closed_at = next(iter(self._closed.items()))
+            if now - closed_at < self.closed_ttl:
+                break
+            del self._closed[group]
+
+    async def _collect(self, album: _Album):
+        """Waits for the rest of the parts."""
+        deadline = time.monotonic() + self.max_wait
+
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                album_timeouts.inc()
+                logging.warning(
+                    f"Album still growing after {self.max_wait}s, "
+                    f"handling the {len(album.parts)} parts that arrived"
+                )
+                return
+
+            album.arrived.clear()
+            try:
+                await asyncio.wait_for(album.arrived.wait(), min(self.quiet, left))
+            except asyncio.TimeoutError:
+                if left > self.quiet:
+                    # nothing new for a while, that's all of it
+                    return
+
     async def on_process_message(self, message: types.Message, data: dict):
-        if not message.media_group_id:
+        group = message.media_group_id
+        if not group:
             return
 
+        self._forget_closed(time.monotonic())
+
+        if group in self._closed:
+            # the album was already handled without this part
+            album_late_parts.inc()
+            logging.warning("A part of an album arrived too late, dropping it")
+            raise CancelHandler()
+
+        album = self._albums.get(group)
+        if album is not None:
+            album.parts.append(message)
+            album.arrived.set()
+            # the first part of the album handles this one
+            raise CancelHandler()
+
+        album = self._albums[group] = _Album(message)
         try:
-            self.album_data[message.media_group_id].append(message)
-            raise CancelHandler()  # Tell aiogram to cancel handler for this group element
-        except KeyError:
-            self.album_data[message.media_group_id] = [message]
-            await asyncio.sleep(self.latency)
-
-            message.conf["is_last"] = True
-            data["album"] = self.album_data[message.media_group_id]
-
-    async def on_post_process_message(self, message: types.Message, result: dict, data: dict):
-        """Clean up after handling our album."""
-        if message.media_group_id and message.conf.get("is_last"):
-            del self.album_data[message.media_group_id]
+            await self._collect(album)
+        finally:
+            # forgotten here, not after the handler, so nothing is left
+            # behind if the handler (or another middleware) fails
+            del self._albums[group]
+            self._closed[group] = time.monotonic()
+
+        albums_collected.inc()
+
+        # the parts of an album may arrive out of order, so they are
+        # sorted by their position in the chat
+        data["album"] = sorted(album.parts, key=lambda part: part.message_id)
@@ -0,0 +1,45 @@
+"""
+Times every handler (see utils/metrics.py).
+It's registered after the other middlewares, so the time spent waiting
+for the rest of an album or in the throttling is not counted.
+"""
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from utils.metrics import handler_seconds
+
+
+class MetricsMiddleware(BaseMiddleware):
+    @staticmethod
+    def start(data: dict):
+        data["metrics_handler"] = current_handler.get().__name__
+        data["metrics_start"] = time.perf_counter()
+
+    @staticmethod
+    def stop(data: dict):
+        # the handler didn't run (no handler matched or it was cancelled)
+        if "metrics_start" not in data:
+            return
+
+        handler_seconds.observe(
+            time.perf_counter() - data["metrics_start"],
+            handler=data["metrics_handler"],
+        )
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self.start(data)
+
+    async def on_post_process_message(
+        self, message: types.Message, results: list, data: dict
+    ):
+        self.stop(data)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        self.start(data)
+
+    async def on_post_process_callback_query(
+        self, call: types.CallbackQuery, results: list, data: dict
+    ):
+        self.stop(data)
@@ -0,0 +1,151 @@
+"""
+Limits how much work a single chat can ask for, so that one user firing
+/compress and files in a loop doesn't take Ghostscript and LibreOffice away
+from everybody else. Uses token buckets: one per chat and one per
+(chat, operation), see utils/throttling.py for how the costs are set.
+"""
+import logging
+import time
+from collections import OrderedDict
+from typing import Tuple, Union
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.markdown import quote_html
+from data import config
+from utils.metrics import throttled
+
+
+class TokenBuckets:
+    """
+    Token buckets that are created when they're first used. A bucket that's
+    been idle long enough to fill up again is the same as a new one, so
+    those are dropped (the least recently used buckets are at the front).
+    """
+
+    def __init__(self, rate: float, capacity: float, max_size: int = 100000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+
+        # key -> [tokens, time of the last update]
+        self._buckets: "OrderedDict[object, list]" = OrderedDict()
+
+    def tokens(self, key, now: float) -> float:
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            return self.capacity
+
+        tokens, updated = bucket
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def take(self, key, amount: float, now: float):
+        self._buckets[key] = [self.tokens(key, now) - amount, now]
+        self._buckets.move_to_end(key)
+        self._evict(now)
+
+    def wait_time(self, key, amount: float, now: float) -> float:
+        """Seconds until the bucket has `amount` tokens."""
+        missing = amount - self.tokens(key, now)
+        return max(0.0, missing / self.rate)
+
+    def _evict(self, now: float):
+        full_after = self.capacity / self.rate
+
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+
+            if now - updated < full_after and len(self._buckets) <= self.max_size:
+                break
+
+            del self._buckets[key]
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Answers the throttled users (once in a while, so that the replies don't
+    add to the flood) and skips their handlers.
+    """
+
+    def __init__(self):
+        self.chat_buckets = TokenBuckets(
+            config.THROTTLE_CHAT_RATE, config.THROTTLE_CHAT_BURST
+        )
+        self.operation_buckets = TokenBuckets(
+            config.THROTTLE_OPERATION_RATE, config.THROTTLE_OPERATION_BURST
+        )
+        # one warning per THROTTLE_WARN_INTERVAL, the buckets of the chats
+        # that stopped sending are dropped like the ones above
+        self.warnings = TokenBuckets(1 / config.THROTTLE_WARN_INTERVAL, 1)
+
+        super().__init__()
+
+    def check(self, chat_id: int) -> Tuple[bool, float]:
+        """
+        Takes the tokens for the current handler if the chat has enough of them.
+        Returns whether the handler may run and how long to wait otherwise.
+        """
+        handler = current_handler.get()
+
+        cost = getattr(handler, "throttling_cost", 1)
+        operation = getattr(handler, "throttling_operation", handler.__name__)
+
+        now = time.monotonic()
+        # costs bigger than a bucket would never get through
+        chat_cost = min(cost, self.chat_buckets.capacity)
+        operation_cost = min(cost, self.operation_buckets.capacity)
+
+        wait = max(
+            self.chat_buckets.wait_time(chat_id, chat_cost, now),
+            self.operation_buckets.wait_time((chat_id, operation), operation_cost, now),
+        )
+
+        if wait > 0:
+            return False, wait
+
+        self.chat_buckets.take(chat_id, chat_cost, now)
+        self.operation_buckets.take((chat_id, operation), operation_cost, now)
+
+        return True, 0
+
+    async def throttle(
+        self, event: Union[types.Message, types.CallbackQuery], chat_id: int
+    ):
+        allowed, wait = self.check(chat_id)
+
+        if allowed:
+            return
+
+        logging.info(f"Throttled chat {chat_id}")
+        throttled.inc()
+
+        now = time.monotonic()
+
+        if self.warnings.wait_time(chat_id, 1, now) == 0:
+            self.warnings.take(chat_id, 1, now)
+
+            text = f"Too many requests, please wait {round(wait) or 1} seconds."
+
+            # otherwise the file is just missing from the list later on
+            if isinstance(event, types.Message) and event.document:
+                name = quote_html(event.document.file_name or "The file")
+                text += f"\n{name} was ignored, please send it again."
+
+            if isinstance(event, types.CallbackQuery):
+                await event.answer(text, show_alert=True)
+            else:
+                await event.reply(text)
+        elif isinstance(event, types.CallbackQuery):
+            # the button keeps spinning otherwise
+            await event.answer()
+
+        raise CancelHandler()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        await self.throttle(message, message.chat.id)
+
+    async def on_process_callback_query(self, call: types.CallbackQuery, data: dict):
+        chat_id = call.message.chat.id if call.message else call.from_user.id
+        await self.throttle(call, chat_id)
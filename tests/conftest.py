@@ -0,0 +1,12 @@
+"""
+The tests import the same modules the bot runs, so data/config.py needs
+the required settings even without a .env file.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("ADMIN", "1")
+os.environ.setdefault("ip", "127.0.0.1")
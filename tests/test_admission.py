@@ -0,0 +1,15 @@
+from types import SimpleNamespace
+
+from data import config
+from utils import admission
+
+
+def test_the_memory_is_only_checked_if_there_is_a_limit(monkeypatch):
+    def bot_rss():
+        raise AssertionError("bot_rss() shouldn't be called")
+
+    monkeypatch.setattr(admission, "bot_rss", bot_rss)
+    monkeypatch.setattr(config, "MAX_RSS_MB", 0)
+
+    file = SimpleNamespace(file_unique_id="new", file_size=1)
+    assert admission.check([file]) is None
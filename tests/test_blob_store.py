@@ -0,0 +1,65 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from utils import blob_store as module
+from utils.blob_store import BlobStore
+
+
+@pytest.fixture
+def downloads(monkeypatch):
+    """The file ids that were downloaded (the files are 100 bytes each)."""
+    downloaded = []
+
+    async def download_file_by_id(file_id, destination, timeout):
+        downloaded.append(file_id)
+        with open(destination, "wb") as file:
+            file.write(file_id.encode().ljust(100, b"."))
+
+    monkeypatch.setattr(module.bot, "download_file_by_id", download_file_by_id)
+    return downloaded
+
+
+def _file(name: str) -> SimpleNamespace:
+    return SimpleNamespace(file_id=name, file_unique_id=name)
+
+
+def test_a_file_is_downloaded_once(tmp_path, downloads):
+    store = BlobStore(str(tmp_path / "blobs"), 1000)
+
+    for destination in ("a.pdf", "b.pdf"):
+        asyncio.run(store.fetch(_file("one"), str(tmp_path / destination)))
+
+    assert downloads == ["one"]
+    assert (tmp_path / "b.pdf").read_bytes().startswith(b"one")
+
+
+def test_a_file_evicted_by_another_worker_is_downloaded_again(tmp_path, downloads):
+    # the workers of the sharded mode share the directory
+    first = BlobStore(str(tmp_path / "blobs"), 1000)
+    second = BlobStore(str(tmp_path / "blobs"), 1000)
+
+    asyncio.run(first.fetch(_file("one"), str(tmp_path / "a.pdf")))
+    assert "one" in second
+
+    os.unlink(tmp_path / "blobs" / "one")
+    asyncio.run(first.fetch(_file("one"), str(tmp_path / "b.pdf")))
+
+    assert downloads == ["one", "one"]
+    assert (tmp_path / "b.pdf").read_bytes().startswith(b"one")
+
+
+def test_the_limit_counts_the_files_of_every_worker(tmp_path, downloads):
+    first = BlobStore(str(tmp_path / "blobs"), 250)
+    second = BlobStore(str(tmp_path / "blobs"), 250)
+
+    for index, store in enumerate((first, second, first, second)):
+        asyncio.run(store.fetch(_file(f"file_{index}"), str(tmp_path / f"{index}.pdf")))
+        # the files are used one after another
+        os.utime(tmp_path / "blobs" / f"file_{index}", (index, index))
+
+    assert sorted(os.listdir(tmp_path / "blobs")) == ["file_2", "file_3"]
+    # the users still have their files
+    assert (tmp_path / "0.pdf").exists()
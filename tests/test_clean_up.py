@@ -0,0 +1,29 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher import FSMContext
+
+from utils import clean_up, speculative_merge
+
+
+def test_reset_drops_the_speculative_merge(tmp_path, monkeypatch):
+    monkeypatch.setattr(clean_up, "input_path", str(tmp_path / "input"))
+    monkeypatch.setattr(clean_up, "output_path", str(tmp_path / "output"))
+    (tmp_path / "input").mkdir()
+    (tmp_path / "output").mkdir()
+
+    async def main():
+        # a merge that's still waiting for a slot of the PDF engine
+        merge = speculative_merge._Merge(("a", "b"), str(tmp_path / "merged.pdf"))
+        merge.task = asyncio.ensure_future(asyncio.sleep(10))
+        speculative_merge._merges[1] = merge
+
+        state = FSMContext(MemoryStorage(), chat=1, user=1)
+        await clean_up.reset(SimpleNamespace(chat=SimpleNamespace(id=1)), state)
+        await asyncio.sleep(0)
+
+        assert 1 not in speculative_merge._merges
+        assert merge.task.cancelled()
+
+    asyncio.run(main())
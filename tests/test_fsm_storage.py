@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from utils.fsm_storage import CachedStorage, RedisError, RedisStorage
+
+
+async def _stub_redis(replies: dict):
+    """A server that answers each command with replies[command name]."""
+
+    async def serve(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            args = []
+            for _ in range(int(line[1:])):
+                length = int((await reader.readline())[1:])
+                args.append((await reader.readexactly(length + 2))[:-2].decode())
+
+            writer.write(replies[args[0]])
+            await writer.drain()
+
+    return await asyncio.start_server(serve, "127.0.0.1", 0)
+
+
+def test_an_error_reply_doesnt_shift_the_next_replies():
+    async def main():
+        server = await _stub_redis({"SET": b"-ERR nope\r\n", "GET": b"$-1\r\n"})
+        storage = RedisStorage(port=server.sockets[0].getsockname()[1])
+
+        with pytest.raises(RedisError):
+            await storage.execute(("SET", "a", "1"), ("SET", "b", "2"))
+        assert await storage.execute(("GET", "x")) == [None]
+
+        await storage.close()
+        server.close()
+
+    asyncio.run(main())
+
+
+def test_a_failed_select_drops_the_connection():
+    async def main():
+        server = await _stub_redis({"SELECT": b"-ERR DB index is out of range\r\n"})
+        storage = RedisStorage(port=server.sockets[0].getsockname()[1], db=99)
+
+        with pytest.raises(RedisError):
+            await storage.execute(("GET", "x"))
+        assert storage._writer is None
+
+        await storage.close()
+        server.close()
+
+    asyncio.run(main())
+
+
+class SlowStorage(CachedStorage):
+    def __init__(self):
+        super().__init__(flush_interval=0)
+        self.written = {}
+
+    async def _load(self, key):
+        return None
+
+    async def _write(self, records):
+        await asyncio.sleep(0.05)
+        self.written.update(records)
+
+
+def test_closing_waits_for_the_running_write():
+    async def main():
+        storage = SlowStorage()
+        await storage.set_state(chat=1, user=1, state="merging")
+        # the flush has taken the batch and is writing it
+        await asyncio.sleep(0.01)
+        assert not storage._dirty
+
+        await storage.close()
+        assert storage.written["1:1"] is not None
+
+    asyncio.run(main())
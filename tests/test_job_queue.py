@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+from states.all_states import SplittingStates
+from utils import job_queue as module
+from utils.job_queue import JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(module, "jobs_path", str(tmp_path / "jobs"))
+    monkeypatch.setitem(module.limits, "pdf", 1)
+
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    # nobody to tell their place in the queue
+    monkeypatch.setattr(queue, "_update_positions", lambda tool: None)
+    return queue
+
+
+def _message(chat_id: int) -> SimpleNamespace:
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=1)
+
+
+def test_background_work_makes_room_for_the_jobs(queue):
+    events = []
+
+    @queue.runner("merge", tool="pdf")
+    async def run(job):
+        events.append("job")
+
+    async def main():
+        await queue.start()
+
+        async with queue.background_slot("pdf") as stop:
+            assert queue.running["pdf"] == 1
+
+            await queue.submit("merge", _message(1), inputs=[])
+            # the job waits for the slot, the background work is asked to stop
+            assert stop.is_set()
+            await asyncio.sleep(0.01)
+            events.append("background done")
+
+        await asyncio.sleep(0.01)
+        await queue.close()
+
+    asyncio.run(main())
+    assert events == ["background done", "job"]
+
+
+def test_background_work_waits_for_the_jobs(queue):
+    events = []
+    job_started = None
+
+    @queue.runner("merge", tool="pdf")
+    async def run(job):
+        job_started.set()
+        await asyncio.sleep(0.05)
+        events.append("job")
+
+    async def background():
+        async with queue.background_slot("pdf"):
+            events.append("background")
+
+    async def main():
+        nonlocal job_started
+        job_started = asyncio.Event()
+
+        await queue.start()
+        await queue.submit("merge", _message(1), inputs=[])
+        await job_started.wait()
+
+        await asyncio.wait_for(background(), 1)
+        assert queue.running["pdf"] == 0
+        await queue.close()
+
+    asyncio.run(main())
+    assert events == ["job", "background"]
+
+
+def test_a_job_can_ask_the_user_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(module, "input_path", str(tmp_path / "input"))
+    monkeypatch.setattr(module.dp, "storage", MemoryStorage())
+    (tmp_path / "input" / "1").mkdir(parents=True)
+
+    file = tmp_path / "doc.pdf"
+    file.write_bytes(b"%PDF")
+    job = module.Job(1, "split", 1, 1, {"user_id": 1}, [str(file)])
+
+    async def main():
+        await job.ask_again(SplittingStates.waiting_for_pages, unique_id="x")
+        state = module.dp.current_state(chat=1, user=1)
+        return await state.get_state(), await state.get_data()
+
+    assert asyncio.run(main()) == (SplittingStates.waiting_for_pages.state, {"unique_id": "x"})
+    assert (tmp_path / "input" / "1" / "doc.pdf").read_bytes() == b"%PDF"
@@ -0,0 +1,147 @@
+import pytest
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import (
+    ArrayObject,
+    DictionaryObject,
+    NameObject,
+    NumberObject,
+    TextStringObject,
+)
+
+from utils.pdf_ops import JobStoppedError, MergeJob
+
+
+def _link(**entries) -> DictionaryObject:
+    link = DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Annot"),
+            NameObject("/Subtype"): NameObject("/Link"),
+            NameObject("/Rect"): ArrayObject([NumberObject(0)] * 4),
+        }
+    )
+    link.update({NameObject(key): value for key, value in entries.items()})
+    return link
+
+
+def _write_input(path: str):
+    """
+    3 pages, a bookmark (with a child) for every page and links on the
+    first page to the named destinations on the last one.
+    """
+    writer = PdfFileWriter()
+    for _ in range(3):
+        writer.addBlankPage(100, 100)
+
+    chapter = writer.addBookmark("Chapter", 0)
+    writer.addBookmark("Section", 1, parent=chapter)
+    writer.addBookmark("End", 2)
+
+    # one of them is in the name tree, the other one in /Dests
+    page = writer.getObject(writer._pages)["/Kids"][2]
+    last = ArrayObject([page, NameObject("/Fit")])
+    writer._root_object[NameObject("/Names")] = DictionaryObject(
+        {
+            NameObject("/Dests"): DictionaryObject(
+                {NameObject("/Names"): ArrayObject([TextStringObject("last"), last])}
+            )
+        }
+    )
+    writer._root_object[NameObject("/Dests")] = writer._addObject(
+        DictionaryObject({NameObject("/end"): last})
+    )
+
+    writer.getPage(0)[NameObject("/Annots")] = ArrayObject(
+        [
+            writer._addObject(
+                _link(
+                    **{
+                        "/A": DictionaryObject(
+                            {
+                                NameObject("/S"): NameObject("/GoTo"),
+                                NameObject("/D"): TextStringObject("last"),
+                            }
+                        )
+                    }
+                )
+            ),
+            writer._addObject(_link(**{"/Dest": NameObject("/end")})),
+        ]
+    )
+
+    with open(path, "wb") as file:
+        writer.write(file)
+
+
+def _destination_page(reader: PdfFileReader, destination) -> int:
+    # the merged page tree is flat
+    kids = reader.trailer["/Root"]["/Pages"]["/Kids"]
+    return [kid.idnum for kid in kids].index(destination.getObject()[0].idnum)
+
+
+def test_merging_keeps_the_bookmarks_and_links(tmp_path):
+    # the named destinations of both inputs have the same names
+    first, second = str(tmp_path / "first.pdf"), str(tmp_path / "second.pdf")
+    _write_input(first)
+    _write_input(second)
+
+    output = str(tmp_path / "merged.pdf")
+    MergeJob([first, second], output).run()
+
+    reader = PdfFileReader(output)
+    assert reader.getNumPages() == 6
+
+    outline = reader.getOutlines()
+    titles = [item.title if not isinstance(item, list) else None for item in outline]
+    assert titles == ["Chapter", None, "End", "Chapter", None, "End"]
+    assert [reader.getDestinationPageNumber(item) for item in outline[::3]] == [0, 3]
+    assert reader.getDestinationPageNumber(outline[4][0]) == 4
+    assert reader.trailer["/Root"]["/Outlines"]["/Count"] == 6
+
+    # the links of every input go to the last page of that input
+    for start, last in ((0, 2), (3, 5)):
+        goto, dest = reader.getPage(start)["/Annots"]
+        assert _destination_page(reader, goto.getObject()["/A"]["/D"]) == last
+        assert _destination_page(reader, dest.getObject()["/Dest"]) == last
+
+
+def test_compact_merging_keeps_the_bookmarks(tmp_path):
+    path = str(tmp_path / "input.pdf")
+    _write_input(path)
+
+    output = str(tmp_path / "merged.pdf")
+    MergeJob([path, path], output, compact=True).run()
+
+    reader = PdfFileReader(output)
+    assert len(reader.getOutlines()) == 6
+
+
+def test_a_merge_stops_once_the_stop_file_exists(tmp_path):
+    path = str(tmp_path / "input.pdf")
+    _write_input(path)
+
+    stop_file = tmp_path / "stop"
+    stop_file.touch()
+
+    with pytest.raises(JobStoppedError):
+        MergeJob(
+            [path, path], str(tmp_path / "merged.pdf"), stop_file=str(stop_file)
+        ).run()
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_a_broken_outline_is_left_out(tmp_path, compact):
+    writer = PdfFileWriter()
+    writer.addBlankPage(100, 100)
+    bookmark = writer.addBookmark("Broken", 0)
+    bookmark.getObject()[NameObject("/Count")] = NameObject("/Oops")
+
+    path = str(tmp_path / "input.pdf")
+    with open(path, "wb") as file:
+        writer.write(file)
+
+    output = str(tmp_path / "merged.pdf")
+    MergeJob([path, path], output, compact=compact).run()
+
+    reader = PdfFileReader(output)
+    assert reader.getNumPages() == 2
+    assert reader.getOutlines() == []
@@ -0,0 +1,26 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.utils.exceptions import WrongFileIdentifier
+
+from utils import result_cache as module
+from utils.result_cache import ResultCache, send_cached_result
+
+
+def test_a_file_id_telegram_doesnt_take_is_dropped(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache.sqlite3"), max_entries=10, ttl=60)
+    monkeypatch.setattr(module, "result_cache", cache)
+    cache.put("key", "stale")
+
+    async def answer_chat_action(action):
+        pass
+
+    async def reply_document(document, caption):
+        raise WrongFileIdentifier("Wrong file identifier/http url specified")
+
+    message = SimpleNamespace(
+        answer_chat_action=answer_chat_action, reply_document=reply_document
+    )
+
+    assert asyncio.run(send_cached_result(message, "key")) is False
+    assert cache.get("key") is None
@@ -0,0 +1,32 @@
+import asyncio
+import re
+import sys
+
+from utils import metrics
+from utils.runner import run_tool
+
+
+def _false_count() -> int:
+    """How many times the "false" stage was timed, as /metrics shows it."""
+    found = re.search(
+        r'^bot_stage_seconds_count\{stage="false"\} (\d+)$', metrics.render(), re.M
+    )
+    return int(found.group(1)) if found else 0
+
+
+def test_run_tool_returns_the_exit_code_and_stderr():
+    code, stderr = asyncio.run(
+        run_tool(sys.executable, ["-c", "import sys; sys.stderr.write('oops')"])
+    )
+
+    assert code == 0
+    assert stderr == b"oops"
+
+
+def test_run_tool_times_the_stage():
+    before = _false_count()
+
+    code, _ = asyncio.run(run_tool("false", []))
+
+    assert code != 0
+    assert _false_count() == before + 1
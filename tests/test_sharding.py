@@ -0,0 +1,36 @@
+import asyncio
+
+import aiohttp
+
+from loader import dp
+from utils import sharding
+
+
+class Queue(list):
+    put = list.append
+
+
+def test_the_webhook_updates_go_to_the_worker_of_the_chat():
+    queues = [Queue(), Queue()]
+
+    async def main():
+        started = asyncio.Event()
+
+        async def on_startup(_):
+            started.set()
+
+        server = asyncio.ensure_future(
+            sharding._listen(dp, queues, on_startup, "/webhook", "127.0.0.1", 48213)
+        )
+        await started.wait()
+
+        update = {"update_id": 1, "message": {"chat": {"id": 3}}}
+        async with aiohttp.ClientSession() as session:
+            async with session.post("http://127.0.0.1:48213/webhook", json=update) as response:
+                assert response.status == 200
+
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+
+    asyncio.run(main())
+    assert queues == [[], [{"update_id": 1, "message": {"chat": {"id": 3}}}]]
@@ -0,0 +1,50 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from data import config
+from utils.soffice_pool import SofficePool, _session_rss
+
+
+def test_a_missing_soffice_only_fails_the_conversion(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "SOFFICE_BINARY", str(tmp_path / "no_soffice"))
+    pool = SofficePool(1)
+
+    async def convert():
+        # the instances are started in the background, failing to start
+        # doesn't take the bot down
+        pool.start()
+        await asyncio.sleep(0.1)
+        assert pool.instances[0].office is None
+
+        result = await pool.convert(str(tmp_path / "doc.docx"), str(tmp_path))
+        await pool.close()
+        return result
+
+    assert asyncio.run(convert()) is None
+
+
+def test_the_memory_of_the_session_is_counted():
+    # a python with a child python, like soffice and soffice.bin
+    code = (
+        "import subprocess, sys; "
+        "subprocess.run([sys.executable, '-c', 'import time; time.sleep(30)'])"
+    )
+    process = subprocess.Popen([sys.executable, "-c", code], start_new_session=True)
+
+    try:
+        # the child needs a moment to start
+        for _ in range(50):
+            rss = _session_rss(process.pid)
+            if rss > 15:
+                break
+            time.sleep(0.1)
+
+        # more than the first python alone
+        assert rss > 15
+    finally:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+
+from data import config
+from middlewares.throttling import ThrottlingMiddleware
+
+
+async def handler(message):
+    pass
+
+
+def _document(name: str) -> types.Message:
+    return types.Message.to_object(
+        {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "document": {"file_id": "x", "file_unique_id": "x", "file_name": name},
+        }
+    )
+
+
+def test_dropped_files_are_pointed_out_once_in_a_while(monkeypatch):
+    monkeypatch.setattr(config, "THROTTLE_CHAT_BURST", 1)
+    monkeypatch.setattr(config, "THROTTLE_CHAT_RATE", 0.001)
+    monkeypatch.setattr(config, "THROTTLE_WARN_INTERVAL", 10)
+
+    replies = []
+
+    async def reply(self, text, *args, **kwargs):
+        replies.append(text)
+
+    monkeypatch.setattr(types.Message, "reply", reply)
+
+    async def main():
+        middleware = ThrottlingMiddleware()
+        current_handler.set(handler)
+
+        await middleware.on_process_message(_document("a.pdf"), {})
+        for name in ("b.pdf", "c.pdf"):
+            with pytest.raises(CancelHandler):
+                await middleware.on_process_message(_document(name), {})
+
+        return middleware
+
+    middleware = asyncio.run(main())
+
+    assert len(replies) == 1
+    assert "b.pdf was ignored" in replies[0]
+    assert len(middleware.warnings._buckets) == 1
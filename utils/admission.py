@@ -0,0 +1,115 @@
+"""
+Decides whether the bot takes on a file before downloading it.
+Telegram tells us the size of a file up front, so files that are too big
+are rejected right away, and if the bot is overloaded (too many jobs in the
+queue, the disk is almost full or the bot takes up too much memory), the
+user is asked to send the file again later, the state stays as it is.
+"""
+import logging
+import os
+import shutil
+from typing import List, Optional, Union
+
+from aiogram import types
+from data import config
+from utils.blob_store import blob_store
+from utils.job_queue import job_queue
+
+# where the downloaded files end up
+user_files_path = os.path.join(os.getcwd(), "user_files")
+
+MB = 1024 * 1024
+
+
+def _rss(pid: Union[int, str]) -> int:
+    """Resident memory of a process in bytes (0 if it's gone)."""
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def bot_rss() -> int:
+    """
+    Memory taken up by the bot and its child processes (the PDF engine
+    workers, Ghostscript). The LibreOffice instances look after themselves.
+    """
+    if not os.path.isdir("/proc"):
+        return 0
+
+    pid = os.getpid()
+    total = _rss(pid)
+
+    for child in os.listdir("/proc"):
+        if not child.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{child}/stat") as stat:
+                # the process name is in brackets and may contain spaces
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+
+        if ppid == pid:
+            total += _rss(child)
+
+    return total
+
+
+def check(files: List[Union[types.Document, types.PhotoSize]]) -> Optional[str]:
+    """
+    Returns the reason for not taking the files (a message for the user)
+    or None if they can be downloaded.
+    """
+    # files that are already in the blob store don't need to be downloaded
+    new_files = [file for file in files if file.file_unique_id not in blob_store]
+    size = sum(file.file_size or 0 for file in new_files)
+
+    for file in new_files:
+        if (file.file_size or 0) > config.MAX_FILE_MB * MB:
+            return (
+                "Sorry, this file is too big. "
+                f"I can only work with files up to {config.MAX_FILE_MB} MB."
+            )
+
+    busy = (
+        "I'm a bit overloaded right now, "
+        "please send the file again in a few minutes."
+    )
+
+    depth = job_queue.depth()
+    if depth >= config.MAX_QUEUE_DEPTH:
+        logging.warning(f"Not taking a file, {depth} jobs in the queue")
+        return busy
+
+    free = shutil.disk_usage(user_files_path).free
+    if free - size < config.MIN_FREE_DISK_MB * MB:
+        logging.warning(f"Not taking a file, {free // MB} MB of disk left")
+        return busy
+
+    # bot_rss() goes through all of /proc, so only if there is a limit
+    if config.MAX_RSS_MB:
+        rss = bot_rss()
+        if rss > config.MAX_RSS_MB * MB:
+            logging.warning(f"Not taking a file, the bot takes up {rss // MB} MB")
+            return busy
+
+    return None
+
+
+async def admit(
+    message: types.Message, files: List[Union[types.Document, types.PhotoSize]]
+) -> bool:
+    """
+    Checks the files before they're downloaded.
+    If they can't be taken, tells the user why and returns False.
+    """
+    reason = check(files)
+
+    if reason is not None:
+        await message.reply(reason)
+        return False
+
+    return True
@@ -0,0 +1,184 @@
+"""
+A shared store for the files that users send to the bot.
+Every file is downloaded from Telegram only once and kept under
+user_files/blobs, named by its `file_unique_id`. The users' directories
+just get hard links to those files, so doing /split and then /compress on
+the same document (or cancelling and trying again) doesn't download it again.
+When the store grows bigger than the limit, the least recently used files
+are deleted (the links in the users' directories keep working until the
+operation is over).
+"""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Tuple, Union
+
+from aiogram import types
+from data import config
+from loader import bot
+from utils.metrics import input_bytes, stage_seconds
+
+blobs_path = os.path.join(os.getcwd(), "user_files", "blobs")
+
+# downloads that haven't been touched for this long were interrupted
+# (the ones that are still going belong to the other workers)
+STALE_PART_SECONDS = 60 * 60
+
+
+class BlobStore:
+    """
+    The workers of the sharded mode share the directory, so nothing about
+    it is kept in memory: the files in there are the index, and their
+    modification times tell which ones were used last.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+        os.makedirs(path, exist_ok=True)
+
+    def __contains__(self, unique_id: str) -> bool:
+        return os.path.exists(os.path.join(self.path, unique_id))
+
+    def _evict(self, keep: str):
+        """
+        Deletes the least recently used files until the store fits
+        (whichever worker put them there).
+        """
+        blobs = []
+        total = 0
+
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # deleted by another worker in the meantime
+                    continue
+
+                if entry.name.endswith(".part"):
+                    # leftovers of downloads that were interrupted
+                    if time.time() - stat.st_mtime > STALE_PART_SECONDS:
+                        self._unlink(entry.path)
+                    continue
+
+                total += stat.st_size
+                if entry.name != keep:
+                    blobs.append((stat.st_mtime, entry.path, stat.st_size))
+
+        blobs.sort()
+        for _, blob, size in blobs:
+            if total <= self.max_bytes:
+                break
+
+            self._unlink(blob)
+            total -= size
+            logging.info("Evicted a file from the blob store")
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _place(self, blob: str, destination: str) -> bool:
+        """
+        Links the blob to `destination`, returns False if the blob is gone
+        (another worker might have evicted it just now).
+        """
+        try:
+            # the modification time keeps track of which files were used last
+            os.utime(blob)
+            self._link(blob, destination)
+        except FileNotFoundError:
+            return False
+
+        return True
+
+    @staticmethod
+    def _link(source: str, destination: str):
+        if os.path.exists(destination):
+            os.unlink(destination)
+
+        try:
+            os.link(source, destination)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # hard links don't work across file systems
+            shutil.copyfile(source, destination)
+
+    async def fetch(
+        self,
+        file: Union[types.Document, types.PhotoSize],
+        destination: str,
+        timeout: int = 30,
+    ):
+        """
+        Puts the file (a document or a photo) at `destination`, downloading it
+        from Telegram only if it's not in the store already.
+        """
+        unique_id = file.file_unique_id
+        blob = os.path.join(self.path, unique_id)
+
+        lock = self._locks.setdefault(unique_id, asyncio.Lock())
+
+        try:
+            async with lock:
+                if self._place(blob, destination):
+                    logging.info("File found in the blob store")
+                    input_bytes.inc(os.path.getsize(destination), source="blob_store")
+                    return
+
+                fd, part = tempfile.mkstemp(dir=self.path, suffix=".part")
+                os.close(fd)
+
+                try:
+                    with stage_seconds.time(stage="download"):
+                        await bot.download_file_by_id(
+                            file.file_id, destination=part, timeout=timeout
+                        )
+                    # the destination gets its link before the file is in
+                    # the store, so it can't be evicted before that
+                    self._link(part, destination)
+                    # (another worker might have downloaded it in the meantime)
+                    os.replace(part, blob)
+                except BaseException:
+                    self._unlink(part)
+                    raise
+
+                input_bytes.inc(os.path.getsize(destination), source="download")
+                self._evict(keep=unique_id)
+        finally:
+            if not lock.locked():
+                self._locks.pop(unique_id, None)
+
+    async def fetch_many(
+        self,
+        files: List[Tuple[Union[types.Document, types.PhotoSize], str]],
+        timeout: int = 30,
+    ):
+        """
+        Fetches several (file, destination) pairs at the same time, but no
+        more than DOWNLOAD_CONCURRENCY at once. Used for albums, so that an
+        album takes about as long as its biggest file.
+        """
+        semaphore = asyncio.Semaphore(config.DOWNLOAD_CONCURRENCY)
+
+        async def fetch_one(file, destination):
+            async with semaphore:
+                await self.fetch(file, destination, timeout=timeout)
+
+        await asyncio.gather(
+            *(fetch_one(file, destination) for file, destination in files)
+        )
+
+
+blob_store = BlobStore(blobs_path, config.BLOB_STORE_MAX_MB * 1024 * 1024)
@@ -10,6 +10,7 @@ from os import listdir, unlink, mkdir
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 from loader import input_path, output_path
+from utils import speculative_merge
 
 
 async def reset(message: types.Message, state: FSMContext):
@@ -20,6 +21,9 @@ async def reset(message: types.Message, state: FSMContext):
     logging.info("Resetting the state and deleting all the files")
 
     await state.finish()
+    # otherwise a merge that's still waiting for a slot could start
+    # on the files that are deleted (or already replaced) below
+    speculative_merge.forget(message.chat.id)
 
     if str(message.chat.id) in listdir(input_path):
         files = listdir(f"{input_path}/{message.chat.id}")
@@ -0,0 +1,325 @@
+"""
+Storages for the FSM (states and state data of the users), so that
+merging sessions, password prompts, etc. survive restarts and can be shared
+between several bot processes.
+
+Both storages keep the records they've read in memory (so reading the state
+of an active user doesn't touch the database) and write the changes in
+batches, a moment after they happen.
+
+SQLiteStorage keeps everything in a local SQLite database (in WAL mode).
+RedisStorage talks to anything that speaks the Redis protocol. It has its own
+tiny client, because aiogram's RedisStorage needs an old version of aioredis.
+
+Which one is used is set with FSM_STORAGE in the config (see loader.py).
+"""
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
+
+from aiogram.dispatcher.storage import BaseStorage
+
+
+def _empty_record() -> dict:
+    return {"state": None, "data": {}, "bucket": {}}
+
+
+class CachedStorage(BaseStorage):
+    """
+    The caching and batching part shared by the storages.
+    Subclasses only have to load a single record and write a batch of them.
+    """
+
+    def __init__(self, flush_interval: float = 0.05, cache_size: int = 10000):
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+
+        # "chat:user" -> record, the least recently used records come first
+        self._cache: "OrderedDict[str, dict]" = OrderedDict()
+        # records that have changed since the last write
+        self._dirty: Dict[str, dict] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _load(self, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def _write(self, records: Dict[str, Optional[str]]):
+        """Writes the serialized records, None means the record is deleted."""
+        raise NotImplementedError
+
+    async def _record(self, chat, user) -> (str, dict):
+        chat, user = self.check_address(chat=chat, user=user)
+        key = f"{chat}:{user}"
+
+        if key not in self._cache:
+            loaded = await self._load(key) or _empty_record()
+            # another coroutine may have loaded (and changed) it in the meantime
+            self._cache.setdefault(key, loaded)
+
+        self._cache.move_to_end(key)
+        self._evict(keep=key)
+        return key, self._cache[key]
+
+    def _evict(self, keep: str):
+        """Forgets the least recently used records that are already written."""
+        while len(self._cache) > self.cache_size:
+            for key in self._cache:
+                if key != keep and key not in self._dirty:
+                    del self._cache[key]
+                    break
+            else:
+                break
+
+    def _changed(self, key: str, record: dict):
+        self._dirty[key] = record
+
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+
+        batch, self._dirty = self._dirty, {}
+
+        records = {
+            key: None if record == _empty_record() else json.dumps(record)
+            for key, record in batch.items()
+        }
+
+        try:
+            await self._write(records)
+        except Exception:
+            logging.exception("Failed to write the FSM records, will try again")
+            # newer changes (if there are any) win
+            self._dirty = {**batch, **self._dirty}
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def close(self):
+        # a flush that's running has its batch out of _dirty already,
+        # so it's waited for instead of cancelled
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+
+        # if that failed too, the retry is given up
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return record["state"] or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record["data"])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, record = await self._record(chat, user)
+        record["state"] = self.resolve_state(state)
+        self._changed(key, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key, record = await self._record(chat, user)
+        record["data"] = copy.deepcopy(data or {})
+        self._changed(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key, record = await self._record(chat, user)
+        record["data"].update(copy.deepcopy(data or {}), **kwargs)
+        self._changed(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        _, record = await self._record(chat, user)
+        return copy.deepcopy(record["bucket"])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key, record = await self._record(chat, user)
+        record["bucket"] = copy.deepcopy(bucket or {})
+        self._changed(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key, record = await self._record(chat, user)
+        record["bucket"].update(copy.deepcopy(bucket or {}), **kwargs)
+        self._changed(key, record)
+
+
+class SQLiteStorage(CachedStorage):
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+
+        # WAL lets several processes read while one of them is writing
+        self.db = sqlite3.connect(path, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, record TEXT NOT NULL)"
+        )
+        self.db.commit()
+
+    async def _load(self, key):
+        row = self.db.execute("SELECT record FROM fsm WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def _write(self, records):
+        # the whole batch is written in one transaction
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO fsm VALUES (?, ?)",
+                [(key, record) for key, record in records.items() if record],
+            )
+            self.db.executemany(
+                "DELETE FROM fsm WHERE key = ?",
+                [(key,) for key, record in records.items() if not record],
+            )
+
+    async def close(self):
+        await super().close()
+        self.db.close()
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisStorage(CachedStorage):
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        db: int = 0,
+        password: Optional[str] = None,
+        prefix: str = "fsm",
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        # one command (or pipeline) at a time, otherwise the replies mix up
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(*args: Union[str, int]) -> bytes:
+        command = [f"*{len(args)}\r\n".encode()]
+
+        for arg in args:
+            arg = str(arg).encode()
+            command.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+
+        return b"".join(command)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis closed the connection")
+
+        kind, rest = line[:1], line[1:-2]
+
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            # returned, not raised, so that the replies after it are still read
+            return RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length == -1:
+                return None
+            value = await self._reader.readexactly(length + 2)
+            return value[:-2].decode()
+        if kind == b"*":
+            return [await self._read_reply() for _ in range(int(rest))]
+
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+
+        if setup:
+            # raises inside execute(), so a connection with the wrong
+            # password or db isn't kept
+            self._raise_errors(await self._pipeline(setup))
+
+    async def _pipeline(self, commands: List[tuple]) -> list:
+        self._writer.write(b"".join(self._encode(*command) for command in commands))
+        await self._writer.drain()
+        # all the replies are read even if some of them are errors,
+        # otherwise the next command would get the reply of this one
+        return [await self._read_reply() for _ in commands]
+
+    @staticmethod
+    def _raise_errors(replies: list):
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+
+    def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def execute(self, *commands: tuple) -> list:
+        """
+        Sends all the commands at once and returns their replies.
+        Reconnects if the connection is gone.
+        Raises the first error reply, after all of them are read.
+        """
+        async with self._lock:
+            try:
+                if self._writer is None or self._writer.is_closing():
+                    await self._connect()
+
+                replies = await self._pipeline(list(commands))
+            except BaseException:
+                # whatever broke (or got cancelled) halfway, the replies
+                # that weren't read yet would go to the next commands
+                self._disconnect()
+                raise
+
+        self._raise_errors(replies)
+        return replies
+
+    async def _load(self, key):
+        (record,) = await self.execute(("GET", f"{self.prefix}:{key}"))
+        return json.loads(record) if record else None
+
+    async def _write(self, records):
+        await self.execute(
+            *(
+                ("SET", f"{self.prefix}:{key}", record)
+                if record
+                else ("DEL", f"{self.prefix}:{key}")
+                for key, record in records.items()
+            )
+        )
+
+    async def close(self):
+        await super().close()
+        self._disconnect()
@@ -0,0 +1,19 @@
+"""
+Builds the Ghostscript command lines. They're kept apart from the handlers
+(and the config), so that the benchmarks run exactly the same commands.
+"""
+from typing import List
+
+
+def compress_args(input: str, output: str, profile: str = "/screen") -> List[str]:
+    """Arguments for `gs` that compress `input` into `output`."""
+    return [
+        "-sDEVICE=pdfwrite",
+        "-dNOPAUSE",
+        "-dQUIET",
+        "-dBATCH",
+        f"-dPDFSETTINGS={profile}",
+        "-dCompatibilityLevel=1.4",
+        f"-sOutputFile={output}",
+        input,
+    ]
@@ -0,0 +1,634 @@
+"""
+A queue for the heavy operations (compressing, merging, converting,
+splitting, encrypting).
+Instead of starting the work right away, the handlers submit a job and
+reset the state, the job runs once a slot for its tool (Ghostscript,
+LibreOffice, the PDF engine) is free.
+
+The jobs are kept in an SQLite database and their input files are linked
+into user_files/jobs/<job id>/, so the jobs survive restarts (the ones that
+were running get started again).
+Slots are handed out round-robin between the chats, so a user with 30 jobs
+in the queue doesn't make everybody else wait for all of them.
+While a job waits, the user has a "You are #N in line" message that gets
+edited as the queue moves.
+
+The work itself is done by runners, registered for every kind of job:
+
+    @job_queue.runner("compress", tool="gs")
+    async def run_compression(job: Job):
+        ...
+
+Work that nobody is waiting for yet (the speculative merges) can borrow a
+slot that no job needs, it's asked to stop as soon as a job does:
+
+    async with job_queue.background_slot("pdf") as stop:
+        ...
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from aiogram import types
+from aiogram.dispatcher.filters.state import State
+from aiogram.utils.exceptions import TelegramAPIError
+from data import config
+from loader import bot, dp, input_path
+from utils import pdf_engine
+from utils.metrics import Gauge, output_bytes, stage_seconds
+
+jobs_path = os.path.join(os.getcwd(), "user_files", "jobs")
+
+# how many jobs of each tool may run at the same time
+limits = {
+    "gs": config.GS_WORKERS,
+    "soffice": config.SOFFICE_POOL_SIZE,
+    "pdf": pdf_engine.workers,
+}
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    chat_id: int
+    reply_to: Optional[int]
+    params: dict
+    # paths of the input files (in the directory of the job)
+    inputs: List[str]
+
+    @property
+    def dir(self) -> str:
+        return os.path.join(jobs_path, str(self.id))
+
+    @property
+    def output_dir(self) -> str:
+        out_dir = os.path.join(self.dir, "out")
+        os.makedirs(out_dir, exist_ok=True)
+        return out_dir
+
+    def output(self, name: str) -> str:
+        """Path for an output file of the job."""
+        return os.path.join(self.output_dir, name)
+
+    async def answer(self, text: str) -> types.Message:
+        return await bot.send_message(self.chat_id, text)
+
+    async def reply(self, text: str) -> types.Message:
+        # the message might have been deleted while the job was waiting
+        return await bot.send_message(
+            self.chat_id,
+            text,
+            reply_to_message_id=self.reply_to,
+            allow_sending_without_reply=True,
+        )
+
+    async def reply_document(
+        self, document: Union[types.InputFile, str], caption: str = "Here you go"
+    ) -> types.Message:
+        """Sends a file (or a file_id of a document that was sent before)."""
+        await bot.send_chat_action(self.chat_id, "upload_document")
+
+        if isinstance(document, types.InputFile):
+            output_bytes.inc(os.fstat(document.file.fileno()).st_size)
+
+        with stage_seconds.time(stage="upload"):
+            return await bot.send_document(
+                self.chat_id,
+                document,
+                caption=caption,
+                reply_to_message_id=self.reply_to,
+                allow_sending_without_reply=True,
+            )
+
+    async def reply_media_group(self, media: types.MediaGroup) -> List[types.Message]:
+        await bot.send_chat_action(self.chat_id, "upload_document")
+
+        for item in media.media:
+            # the documents that are uploaded (not sent by file_id)
+            if getattr(item, "file", None) is not None:
+                output_bytes.inc(os.fstat(item.file.file.fileno()).st_size)
+
+        with stage_seconds.time(stage="upload"):
+            return await bot.send_media_group(
+                self.chat_id,
+                media,
+                reply_to_message_id=self.reply_to,
+                allow_sending_without_reply=True,
+            )
+
+    async def ask_again(self, state: State, **data):
+        """
+        Puts the input file back into the user's directory and the user back
+        into `state`, so they can fix what they typed (pages that don't
+        exist, a wrong password) without sending the file again.
+        Does nothing if the user started something else in the meantime.
+        """
+        context = dp.current_state(chat=self.chat_id, user=self.params["user_id"])
+        if await context.get_state() is not None:
+            return
+
+        destination = os.path.join(
+            input_path, str(self.chat_id), os.path.basename(self.inputs[0])
+        )
+        try:
+            os.link(self.inputs[0], destination)
+        except OSError:
+            shutil.copyfile(self.inputs[0], destination)
+
+        await context.set_state(state)
+        await context.update_data(**data)
+
+
+Runner = Callable[[Job], Awaitable[None]]
+
+
+class JobQueue:
+    def __init__(self, path: str, shard: int = 0):
+        # in the sharded mode every worker process runs the jobs of its own
+        # chats (the database is shared)
+        self.shard = shard
+
+        self.db = sqlite3.connect(path, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL, "
+            "tool TEXT NOT NULL, kind TEXT NOT NULL, chat_id INTEGER NOT NULL, "
+            "reply_to INTEGER, params TEXT NOT NULL, inputs TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "position INTEGER, position_message INTEGER, created REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (shard, tool, status)"
+        )
+        self.db.commit()
+
+        # kind -> (tool, runner)
+        self.runners: Dict[str, Tuple[str, Runner]] = {}
+        # number of running jobs of every tool (and of the background work)
+        self.running: Dict[str, int] = defaultdict(int)
+
+        # tool -> the stop events of the background work holding its slots
+        self._background: Dict[str, Set[asyncio.Event]] = defaultdict(set)
+        # tool -> the background work waiting for a slot
+        self._background_waiters: Dict[str, List[asyncio.Future]] = defaultdict(list)
+
+        # (tool, chat id) -> the turn in which the chat last got a slot,
+        # the chat that waited the longest gets the next one
+        self._turns: Dict[Tuple[str, int], int] = {}
+        self._turn = 0
+
+        self._tasks = set()
+        self._position_tasks: Dict[str, asyncio.Task] = {}
+        self._positions_outdated = set()
+        self._started = False
+
+    def runner(self, kind: str, tool: str):
+        """Registers the function that does the jobs of this kind."""
+
+        def register(func: Runner) -> Runner:
+            self.runners[kind] = (tool, func)
+            return func
+
+        return register
+
+    def counts(self) -> Dict[Tuple[str, str], int]:
+        """(tool, status) -> number of jobs, for the metrics."""
+        return {
+            (tool, status): count
+            for tool, status, count in self.db.execute(
+                "SELECT tool, status, COUNT(*) FROM jobs WHERE shard = ? "
+                "GROUP BY tool, status",
+                (self.shard,),
+            )
+        }
+
+    def depth(self, tool: Optional[str] = None) -> int:
+        """Number of jobs that are waiting or running."""
+        query = "SELECT COUNT(*) FROM jobs WHERE shard = ?"
+        args = [self.shard]
+
+        if tool is not None:
+            query += " AND tool = ?"
+            args.append(tool)
+
+        return self.db.execute(query, args).fetchone()[0]
+
+    async def submit(
+        self, kind: str, message: types.Message, inputs: List[str], **params
+    ) -> int:
+        """
+        Queues a job that replies to the message once it's done.
+        The input files are linked into the directory of the job, so the user's
+        directory can be cleaned up right away. Returns the id of the job.
+        """
+        tool, _ = self.runners[kind]
+
+        cursor = self.db.execute(
+            "INSERT INTO jobs (shard, tool, kind, chat_id, reply_to, params, "
+            "inputs, status, created) VALUES (?, ?, ?, ?, ?, ?, '[]', 'queued', ?)",
+            (
+                self.shard,
+                tool,
+                kind,
+                message.chat.id,
+                message.message_id,
+                json.dumps(params),
+                time.time(),
+            ),
+        )
+        job_id = cursor.lastrowid
+
+        in_dir = os.path.join(jobs_path, str(job_id), "in")
+        os.makedirs(in_dir, exist_ok=True)
+
+        job_inputs = []
+        for file in inputs:
+            destination = os.path.join(in_dir, os.path.basename(file))
+
+            # the same file can be in the list twice (when merging)
+            if os.path.exists(destination):
+                job_inputs.append(destination)
+                continue
+
+            try:
+                os.link(file, destination)
+            except OSError:
+                shutil.copyfile(file, destination)
+
+            job_inputs.append(destination)
+
+        self.db.execute(
+            "UPDATE jobs SET inputs = ? WHERE id = ?", (json.dumps(job_inputs), job_id)
+        )
+        self.db.commit()
+
+        logging.info(f"Job {job_id} ({kind}) queued")
+
+        if self._started:
+            self._pump(tool)
+            self._update_positions(tool)
+
+        return job_id
+
+    async def start(self):
+        """
+        Starts the jobs that were left over from before the restart.
+        The ones that were running start from scratch, unless they
+        already failed too many times (and probably crashed the bot).
+        """
+        leftovers = self.db.execute(
+            "SELECT id, chat_id, reply_to FROM jobs "
+            "WHERE shard = ? AND status = 'running' AND attempts >= ?",
+            (self.shard, config.JOB_MAX_ATTEMPTS),
+        ).fetchall()
+
+        for job_id, chat_id, reply_to in leftovers:
+            logging.warning(f"Job {job_id} failed too many times, dropping it")
+            self._finish(job_id)
+
+            try:
+                await bot.send_message(
+                    chat_id,
+                    "Sorry, I couldn't finish this one.",
+                    reply_to_message_id=reply_to,
+                    allow_sending_without_reply=True,
+                )
+            except TelegramAPIError:
+                pass
+
+        self.db.execute(
+            "UPDATE jobs SET status = 'queued' WHERE shard = ? AND status = 'running'",
+            (self.shard,),
+        )
+        self.db.commit()
+
+        self._remove_orphans()
+        self._started = True
+
+        tools = [
+            tool
+            for (tool,) in self.db.execute(
+                "SELECT DISTINCT tool FROM jobs WHERE shard = ?", (self.shard,)
+            )
+        ]
+        for tool in tools:
+            self._pump(tool)
+            self._update_positions(tool)
+        for tool in list(self._background_waiters):
+            self._pump(tool)
+
+        logging.info(f"Job queue started, {self.depth()} jobs left over")
+
+    async def close(self):
+        """
+        Stops the running jobs, they stay in the database and
+        start again after the restart.
+        """
+        self._started = False
+
+        for task in [*self._tasks, *self._position_tasks.values()]:
+            task.cancel()
+
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    def _remove_orphans(self):
+        """Deletes the directories of the jobs that didn't make it to the queue."""
+        if not os.path.isdir(jobs_path):
+            return
+
+        known = {
+            str(job_id) for (job_id,) in self.db.execute("SELECT id FROM jobs")
+        }
+
+        for name in os.listdir(jobs_path):
+            if name not in known:
+                shutil.rmtree(os.path.join(jobs_path, name), ignore_errors=True)
+
+    def _load(self, job_id: int) -> Job:
+        kind, chat_id, reply_to, params, inputs = self.db.execute(
+            "SELECT kind, chat_id, reply_to, params, inputs FROM jobs WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+
+        return Job(
+            id=job_id,
+            kind=kind,
+            chat_id=chat_id,
+            reply_to=reply_to,
+            params=json.loads(params),
+            inputs=json.loads(inputs),
+        )
+
+    def _queued(self, tool: str) -> "OrderedDict[int, deque]":
+        """Waiting jobs of every chat (in the order they were submitted)."""
+        chats = OrderedDict()
+
+        for job_id, chat_id in self.db.execute(
+            "SELECT id, chat_id FROM jobs "
+            "WHERE shard = ? AND tool = ? AND status = 'queued' ORDER BY id",
+            (self.shard, tool),
+        ):
+            chats.setdefault(chat_id, deque()).append(job_id)
+
+        return chats
+
+    def _order(self, tool: str) -> List[int]:
+        """The order in which the waiting jobs will get the slots."""
+        chats = self._queued(tool)
+        turns = dict(self._turns)
+        turn = self._turn
+
+        order = []
+        while chats:
+            chat_id = min(
+                chats, key=lambda chat: (turns.get((tool, chat), 0), chats[chat][0])
+            )
+            order.append(chats[chat_id].popleft())
+
+            turn += 1
+            turns[tool, chat_id] = turn
+
+            if not chats[chat_id]:
+                del chats[chat_id]
+
+        return order
+
+    def _is_queued(self, job_id: int) -> bool:
+        return (
+            self.db.execute(
+                "SELECT 1 FROM jobs WHERE id = ? AND status = 'queued'", (job_id,)
+            ).fetchone()
+            is not None
+        )
+
+    def _has_queued(self, tool: str) -> bool:
+        return (
+            self.db.execute(
+                "SELECT 1 FROM jobs WHERE shard = ? AND tool = ? "
+                "AND status = 'queued' LIMIT 1",
+                (self.shard, tool),
+            ).fetchone()
+            is not None
+        )
+
+    def _pump(self, tool: str):
+        """
+        Starts as many waiting jobs as there are free slots, then gives the
+        slots that are left to the background work (or asks the background
+        work to make room, if there are jobs waiting).
+        """
+        while self._started and self.running[tool] < limits.get(tool, 1):
+            order = self._order(tool)
+            if not order:
+                break
+
+            job = self._load(order[0])
+
+            self._turn += 1
+            self._turns[tool, job.chat_id] = self._turn
+
+            self.db.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1 "
+                "WHERE id = ?",
+                (job.id,),
+            )
+            self.db.commit()
+
+            self.running[tool] += 1
+
+            task = asyncio.ensure_future(self._run(tool, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        if not self._background[tool] and not self._background_waiters[tool]:
+            return
+
+        if self._has_queued(tool):
+            for stop in self._background[tool]:
+                stop.set()
+        else:
+            # they check for a free slot themselves once they're woken up
+            for waiter in self._background_waiters.pop(tool, []):
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    @asynccontextmanager
+    async def background_slot(self, tool: str) -> AsyncIterator[asyncio.Event]:
+        """
+        Waits for a slot of the tool that no job needs, and holds it for work
+        nobody is waiting for yet. The event it gives is set as soon as a job
+        of the queue needs the slot, the work should stop then.
+        """
+        while (
+            not self._started
+            or self.running[tool] >= limits.get(tool, 1)
+            or self._has_queued(tool)
+        ):
+            waiter = asyncio.get_event_loop().create_future()
+            self._background_waiters[tool].append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._background_waiters[tool]:
+                    self._background_waiters[tool].remove(waiter)
+
+        stop = asyncio.Event()
+        self._background[tool].add(stop)
+        self.running[tool] += 1
+
+        try:
+            yield stop
+        finally:
+            self._background[tool].discard(stop)
+            self.running[tool] -= 1
+
+            if self._started:
+                self._pump(tool)
+
+    async def _run(self, tool: str, job: Job):
+        _, runner = self.runners[job.kind]
+
+        logging.info(f"Job {job.id} ({job.kind}) started")
+
+        (position_message,) = self.db.execute(
+            "SELECT position_message FROM jobs WHERE id = ?", (job.id,)
+        ).fetchone()
+
+        try:
+            if position_message is not None:
+                await self._edit(
+                    job.chat_id, position_message, "It's your turn, working on it."
+                )
+
+            try:
+                await runner(job)
+            except asyncio.CancelledError:
+                # the bot is shutting down, the job will run again after the restart
+                raise
+            except Exception:
+                logging.exception(f"Job {job.id} ({job.kind}) failed")
+
+                try:
+                    await job.reply("Sorry, something went wrong.")
+                except TelegramAPIError:
+                    pass
+            else:
+                logging.info(f"Job {job.id} ({job.kind}) done")
+
+            self._finish(job.id)
+        finally:
+            self.running[tool] -= 1
+
+            if self._started:
+                self._pump(tool)
+                self._update_positions(tool)
+
+    def _finish(self, job_id: int):
+        self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self.db.commit()
+
+        shutil.rmtree(os.path.join(jobs_path, str(job_id)), ignore_errors=True)
+
+    def _update_positions(self, tool: str):
+        """
+        Lets the waiting users know where they are in the queue.
+        The messages are updated in the background, one tool at a time,
+        and if the queue moves in the meantime, they're updated once again.
+        """
+        self._positions_outdated.add(tool)
+
+        task = self._position_tasks.get(tool)
+        if task is None or task.done():
+            self._position_tasks[tool] = asyncio.ensure_future(
+                self._send_positions(tool)
+            )
+
+    async def _send_positions(self, tool: str):
+        while tool in self._positions_outdated:
+            self._positions_outdated.discard(tool)
+
+            for position, job_id in enumerate(self._order(tool), start=1):
+                row = self.db.execute(
+                    "SELECT chat_id, reply_to, position, position_message "
+                    "FROM jobs WHERE id = ? AND status = 'queued'",
+                    (job_id,),
+                ).fetchone()
+
+                # the job started in the meantime
+                if row is None:
+                    continue
+
+                chat_id, reply_to, old_position, position_message = row
+
+                if position == old_position:
+                    continue
+
+                text = f"You are #{position} in line, I'll start once it's your turn."
+
+                if position_message is None:
+                    try:
+                        sent = await bot.send_message(
+                            chat_id,
+                            text,
+                            reply_to_message_id=reply_to,
+                            allow_sending_without_reply=True,
+                        )
+                    except TelegramAPIError:
+                        logging.exception("Failed to send the position in the queue")
+                        continue
+
+                    position_message = sent.message_id
+
+                    # the job started while the message was being sent
+                    if not self._is_queued(job_id):
+                        await self._edit(
+                            chat_id, position_message, "It's your turn, working on it."
+                        )
+                        continue
+                else:
+                    await self._edit(chat_id, position_message, text)
+
+                self.db.execute(
+                    "UPDATE jobs SET position = ?, position_message = ? WHERE id = ?",
+                    (position, position_message, job_id),
+                )
+                self.db.commit()
+
+    @staticmethod
+    async def _edit(chat_id: int, message_id: int, text: str):
+        try:
+            await bot.edit_message_text(text, chat_id, message_id)
+        except TelegramAPIError:
+            # the message was deleted or already says the same thing
+            pass
+
+
+job_queue = JobQueue(os.path.join(os.getcwd(), "user_files", "jobs.sqlite3"), config.SHARD)
+
+queue_depth = Gauge(
+    "bot_job_queue_depth",
+    "Jobs in the queue",
+    ("tool", "status"),
+    function=job_queue.counts,
+)
@@ -0,0 +1,108 @@
+"""
+Keeps an eye on the event loop. Anything that blocks the loop (a
+synchronous file write, PyPDF2 or PIL work done in a handler) freezes the
+bot for everybody, and this is how we find out where it happens.
+
+A coroutine wakes up every LOOP_LAG_INTERVAL_MS and measures how late it
+was woken up, the lag goes into the metrics. A separate thread checks that
+the coroutine keeps waking up, and if the loop has been stuck for longer
+than LOOP_LAG_THRESHOLD_MS, it logs what the loop is doing right now:
+the handler (the innermost frame from the handlers package) and the stack.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from data import config
+from utils.metrics import loop_lag_seconds
+
+
+def _blocking_handler(frame) -> Optional[str]:
+    """The innermost function of the handlers package in the stack."""
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+
+        if module.startswith("handlers."):
+            return f"{module}.{frame.f_code.co_name} (line {frame.f_lineno})"
+
+        frame = frame.f_back
+
+    return None
+
+
+class LoopMonitor:
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+
+        self._last_tick = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._sampler: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._sampler is not None:
+            return
+
+        self._loop_thread = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stopped.clear()
+
+        self._sampler = asyncio.ensure_future(self._sample())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+        logging.info("Event loop monitor started")
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._sampler is not None:
+            self._sampler.cancel()
+            self._sampler = None
+
+    async def _sample(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+
+            loop_lag_seconds.observe(max(0.0, loop.time() - start - self.interval))
+            self._last_tick = time.monotonic()
+
+    def _watch(self):
+        # the tick of the stall that was already reported
+        reported = None
+
+        while not self._stopped.wait(self.interval):
+            tick = self._last_tick
+            stalled = time.monotonic() - tick - self.interval
+
+            if stalled < self.threshold or tick == reported:
+                continue
+
+            reported = tick
+
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+
+            handler = _blocking_handler(frame) or "no handler"
+            stack = "".join(traceback.format_stack(frame))
+
+            logging.warning(
+                f"Event loop blocked for {stalled:.2f}s in {handler}\n{stack}"
+            )
+
+
+loop_monitor = LoopMonitor(
+    config.LOOP_LAG_INTERVAL_MS / 1000, config.LOOP_LAG_THRESHOLD_MS / 1000
+)
@@ -0,0 +1,135 @@
+"""
+Keeps track of the files that a user wants to merge.
+The list of files (in the order they'll be merged) is stored in the state
+data under "files", every file looks like:
+    {"id": file_unique_id, "name": original file name, "msg": message_id}
+and gets "pages" (the number of pages) once it was checked in the
+background (see utils/speculative_merge.py).
+The files themselves are stored as <file_unique_id>.pdf in the user's input
+directory and are never renamed, moving or deleting a file from the list
+only changes the list.
+The images that are put into a PDF (handlers/convert.py) are kept in order
+the same way, under "images".
+"""
+import asyncio
+from bisect import bisect
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+from aiogram import types
+from aiogram.dispatcher import FSMContext
+from aiogram.utils.markdown import quote_html
+from loader import input_path
+
+# the handlers of a user may run at the same time (when several files are
+# sent one after another), so changes to the list are done one at a time
+_locks: Dict[int, asyncio.Lock] = {}
+
+
+def file_path(chat_id: int, file: dict) -> str:
+    return f"{input_path}/{chat_id}/{file['id']}.pdf"
+
+
+def new_entry(message: types.Message) -> dict:
+    return {
+        "id": message.document.file_unique_id,
+        "name": message.document.file_name,
+        "msg": message.message_id,
+    }
+
+
+async def get_files(state: FSMContext, key: str = "files") -> List[dict]:
+    data = await state.get_data()
+    return data.get(key, [])
+
+
+@asynccontextmanager
+async def _locked(chat_id: int):
+    lock = _locks.setdefault(chat_id, asyncio.Lock())
+
+    try:
+        async with lock:
+            yield
+    finally:
+        if not lock.locked():
+            _locks.pop(chat_id, None)
+
+
+async def add_files(
+    state: FSMContext,
+    chat_id: int,
+    entries: List[dict],
+    position: Optional[int] = None,
+    key: str = "files",
+) -> List[dict]:
+    """
+    Adds the files to the list and returns the new list.
+    If the position (starting from 0) is not given, the files are placed
+    according to the order in which they were sent.
+    """
+    async with _locked(chat_id):
+        files = await get_files(state, key)
+
+        if position is None:
+            for entry in entries:
+                index = bisect([file["msg"] for file in files], entry["msg"])
+                files.insert(index, entry)
+        else:
+            files[position:position] = entries
+
+        await state.update_data({key: files})
+
+    return files
+
+
+async def set_pages(
+    state: FSMContext, chat_id: int, file_id: str, pages: Optional[int]
+) -> Optional[List[dict]]:
+    """
+    Records the number of pages of the file, None removes the file from the
+    list (it can't be merged). Returns the new list, or None if the file
+    isn't in the list (anymore).
+    """
+    async with _locked(chat_id):
+        files = await get_files(state)
+
+        if not any(file["id"] == file_id for file in files):
+            return None
+
+        if pages is None:
+            files = [file for file in files if file["id"] != file_id]
+        else:
+            for file in files:
+                if file["id"] == file_id:
+                    file["pages"] = pages
+
+        await state.update_data(files=files)
+
+    return files
+
+
+def _format_pages(file: dict) -> str:
+    # the files are counted in the background, some may not be done yet
+    if "pages" not in file:
+        return ""
+    return f" ({file['pages']} page{'' if file['pages'] == 1 else 's'})"
+
+
+def format_file_list(files: List[dict]) -> str:
+    """Makes a numbered list of the file names to show to the user."""
+    return "\n".join(
+        f"{index}. {quote_html(file['name'])}{_format_pages(file)}"
+        for index, file in enumerate(files, start=1)
+    )
+
+
+def confirmation_keyboard() -> types.InlineKeyboardMarkup:
+    """The Yes/No keyboard shown under the list of files."""
+    keyboard = types.InlineKeyboardMarkup()
+    buttons = [
+        types.InlineKeyboardButton(text="Yes", callback_data="ask_for_name"),
+        types.InlineKeyboardButton(text="No", callback_data="modify_files"),
+    ]
+    keyboard.add(*buttons)
+
+    return keyboard
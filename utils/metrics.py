@@ -0,0 +1,281 @@
+"""
+Metrics of the bot (how long the handlers and the stages of the operations
+take, how many bytes go in and out, how long the job queue is), exposed
+in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+
+The metrics are just numbers in dicts, so updating them is cheap enough
+to leave it on all the time. Usage:
+
+    with stage_seconds.time(stage="gs"):
+        ...
+    input_bytes.inc(size, source="download")
+"""
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+
+    if not pairs:
+        return ""
+
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+        registry.append(self)
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(),
+        ]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {value}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Instead of setting it, a function can be
+    given that's called when the metrics are collected.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        *args,
+        function: Optional[Callable[[], Dict[LabelValues, float]]] = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        values = self.function() if self.function else self._values
+
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {value}"
+            for key, value in values.items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    default_buckets = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+    )
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = default_buckets, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+        # labels -> [count of every bucket (not cumulative), sum, count]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][index] += 1
+                break
+
+        data[1] += value
+        data[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the block took (also if it raised)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        lines = []
+
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, le=bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = _format_labels(self.labels, key, le="+Inf")
+            lines.append(f"{self.name}_bucket{labels} {count}")
+
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+
+        return lines
+
+
+class Summary(Metric):
+    """
+    Quantiles of the last `window` observations (and the sum and count
+    of all of them).
+    """
+
+    type = "summary"
+
+    def __init__(
+        self,
+        *args,
+        quantiles: Tuple[float, ...] = (0.5, 0.9, 0.99),
+        window: int = 1000,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.quantiles = quantiles
+        self.window = window
+
+        # labels -> [last observations, sum, count]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [deque(maxlen=self.window), 0.0, 0]
+
+        data[0].append(value)
+        data[1] += value
+        data[2] += 1
+
+    def samples(self):
+        lines = []
+
+        for key, (observations, total, count) in self._values.items():
+            ordered = sorted(observations)
+
+            for quantile in self.quantiles:
+                value = ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+                labels = _format_labels(self.labels, key, quantile=quantile)
+                lines.append(f"{self.name}{labels} {value}")
+
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+
+        return lines
+
+
+registry: List[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+handler_seconds = Histogram(
+    "bot_handler_seconds", "Time spent in the handlers", ("handler",)
+)
+stage_seconds = Histogram(
+    "bot_stage_seconds",
+    "Time spent in the stages of the operations "
+    "(download, gs, soffice, the PDF engine jobs, upload)",
+    ("stage",),
+)
+input_bytes = Counter(
+    "bot_input_bytes_total", "Bytes of the files that users sent", ("source",)
+)
+output_bytes = Counter("bot_output_bytes_total", "Bytes of the files sent back")
+throttled = Counter("bot_throttled_total", "Updates dropped by the throttling")
+albums_collected = Counter("bot_albums_total", "Albums put together from their parts")
+album_late_parts = Counter(
+    "bot_album_late_parts_total",
+    "Parts of albums that arrived after the album was handled (dropped)",
+)
+album_timeouts = Counter(
+    "bot_album_timeouts_total",
+    "Albums handled before they stopped growing (they took too long to arrive)",
+)
+loop_lag_seconds = Summary(
+    "bot_loop_lag_seconds", "How late the event loop runs the scheduled callbacks"
+)
+
+_runner: Optional[web.AppRunner] = None
+
+
+async def _handle(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host: str, port: int):
+    """Starts the HTTP endpoint (port 0 means the metrics are not exposed)."""
+    global _runner
+
+    if not port or _runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get("/metrics", _handle)
+
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+
+    logging.info(f"Metrics exposed on http://{host}:{port}/metrics")
+
+
+async def stop_server():
+    global _runner
+
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,75 @@
+"""
+Runs the PDF operations from utils/pdf_ops.py in a pool of worker processes.
+PyPDF2 is pure Python, so parsing and writing big files on the event loop
+would freeze the bot for everybody. Handlers just await `run_pdf_job(job)`.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from data import config
+from utils import pdf_ops
+from utils.metrics import stage_seconds
+
+# defaults to the number of cores
+workers = config.PDF_WORKERS or os.cpu_count() or 1
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=pdf_ops.init_worker
+        )
+    return _executor
+
+
+async def start():
+    """
+    Starts all the worker processes right away (by giving each of them
+    something to do), instead of starting them on the first jobs.
+    """
+    loop = asyncio.get_event_loop()
+    executor = _get_executor()
+
+    await asyncio.gather(
+        *(loop.run_in_executor(executor, pdf_ops.init_worker) for _ in range(workers))
+    )
+    logging.info(f"PDF engine started with {workers} workers")
+
+
+def compact_output(*inputs: str) -> bool:
+    """
+    Whether the result of a job should be written compactly (see
+    utils/pdf_stream.py). It takes longer, so it's only done for big files.
+    """
+    if config.COMPACT_OUTPUT_KB < 0:
+        return False
+
+    size = sum(os.path.getsize(file) for file in inputs)
+    return size >= config.COMPACT_OUTPUT_KB * 1024
+
+
+def shutdown():
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+async def run_pdf_job(job):
+    """
+    Runs the job in one of the worker processes and returns its result.
+    Exceptions raised by the job are raised here as well.
+    """
+    loop = asyncio.get_event_loop()
+
+    # the stage is named after the job (MergeJob, ImagesJob, ...)
+    with stage_seconds.time(stage=type(job).__name__):
+        return await loop.run_in_executor(_get_executor(), pdf_ops.run_job, job)
@@ -0,0 +1,381 @@
+"""
+The actual PDF operations (merging, extracting pages, splitting into many
+files, encrypting and decrypting) done with PyPDF2, and putting images into
+a PDF with img2pdf.
+These are plain, blocking functions that run inside the worker processes of
+the PDF engine (utils/pdf_engine.py), so they must not import anything that
+belongs to the bot itself. Every operation is described by a small job object
+that can be pickled and sent to a worker.
+"""
+import re
+import zipfile
+from dataclasses import dataclass
+from os.path import basename, exists, splitext
+from typing import List, Optional, Sequence, Tuple, Union
+
+import img2pdf
+from PIL import Image
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import IndirectObject
+from utils.pdf_stream import StreamWriter, page_tree
+
+# a page is either a single page number or a (start, end) range,
+# page numbers start from 1 (the way users type them in)
+Pages = List[Union[int, Tuple[int, int]]]
+
+# the most files a PDF is split into at once
+MAX_BURST_FILES = 200
+
+
+class PdfJobError(Exception):
+    """
+    Raised when a job can't be done because of the user's input.
+    The message is meant to be shown to the user.
+    """
+
+
+class PageRangeError(PdfJobError):
+    pass
+
+
+class NotEncryptedError(PdfJobError):
+    pass
+
+
+class WrongPasswordError(PdfJobError):
+    pass
+
+
+class NoOutlineError(PdfJobError):
+    pass
+
+
+class PasswordProtectedError(PdfJobError):
+    pass
+
+
+class JobStoppedError(Exception):
+    """Raised when a job is given up halfway (see MergeJob.stop_file)."""
+
+
+def init_worker():
+    """
+    Runs once in every worker process when it starts.
+    Imports the PDF libraries up front, so the first job doesn't pay for it.
+    """
+    import PyPDF2.pdf  # noqa: F401
+    import PyPDF2.generic  # noqa: F401
+
+
+def run_job(job):
+    """Entry point for the worker processes."""
+    return job.run()
+
+
+@dataclass
+class MergeJob:
+    inputs: List[str]
+    output: str
+    # see utils/pdf_stream.py
+    compact: bool = False
+    # the merge is given up (JobStoppedError) once this file exists,
+    # it's checked before every input (the job runs in another process)
+    stop_file: Optional[str] = None
+
+    def run(self) -> int:
+        """
+        Returns how many bytes were saved by writing the objects the inputs
+        have in common (fonts, images) only once.
+        """
+        # the inputs are copied one at a time (see utils/pdf_stream.py),
+        # so merging a lot of files doesn't take a lot of memory
+        with open(self.output, "wb") as result:
+            writer = StreamWriter(result, compact=self.compact)
+
+            for file in self.inputs:
+                if self.stop_file is not None and exists(self.stop_file):
+                    raise JobStoppedError()
+                writer.append(file)
+
+            writer.close()
+
+        return writer.saved
+
+
+@dataclass
+class CountPagesJob:
+    input: str
+
+    def run(self) -> int:
+        """
+        Returns the number of pages, which also makes sure the PDF can be
+        read. Raises PasswordProtectedError if it can't be opened without one.
+        """
+        with open(self.input, "rb") as file:
+            reader = PdfFileReader(file, strict=False)
+
+            # the same as when merging (see StreamWriter.append)
+            if reader.isEncrypted and reader.decrypt("") == 0:
+                raise PasswordProtectedError(
+                    "is protected with a password, you can remove it with /decrypt"
+                )
+
+            return len(page_tree(reader))
+
+
+@dataclass
+class ExtractJob:
+    input: str
+    pages: Pages
+    output: str
+    compact: bool = False
+
+    def run(self):
+        with open(self.input, "rb") as file:
+            reader = PdfFileReader(file)
+            indexes = _page_indexes(self.pages, reader.getNumPages())
+
+            with open(self.output, "wb") as result:
+                writer = StreamWriter(result, compact=self.compact)
+                # only the fonts and images these pages use go along
+                writer.copy_pages(reader, indexes, prune=True)
+                writer.close()
+
+
+def _page_indexes(pages: Pages, page_count: int) -> List[int]:
+    """
+    Turns the pages the user typed in into page indexes (starting from 0).
+    Raises PageRangeError if some of them don't exist.
+    """
+    indexes = []
+
+    for page in pages:
+        # user typed in a range
+        # (a list once it's been through the job queue, which keeps JSON)
+        if isinstance(page, (tuple, list)):
+            start, end = page
+
+            # checking for invalid input
+            if start > end:
+                raise PageRangeError("Invalid pages indicated. Try again.")
+            elif start == 0 or end == 0:
+                raise PageRangeError("Zero is not a valid page number. Try again.")
+            elif start > page_count or end > page_count:
+                raise PageRangeError(
+                    "Your PDF doesn't have that many pages. Try again."
+                )
+
+            # page numbers start from zero in pypdf2, so we subtract 1
+            indexes.extend(range(start - 1, end))
+        # user typed in a number
+        else:
+            # checking for invalid input
+            if page == 0:
+                raise PageRangeError("Zero is not a valid page number. Try again.")
+            elif page > page_count:
+                raise PageRangeError(
+                    "Your PDF doesn't have that many pages. Try again."
+                )
+
+            # page numbers start from zero in pypdf2, so we subtract 1
+            indexes.append(page - 1)
+
+    return indexes
+
+
+@dataclass
+class BurstJob:
+    """
+    Splits the PDF into many files in one go and puts them into a ZIP.
+    The modes are:
+    "every" - a file for every `value` pages
+    "parts" - `value` files of (about) the same number of pages
+    "groups" - a file for every list of pages in `value`
+    "chapters" - a file for every top level entry of the outline (bookmarks)
+    """
+
+    input: str
+    mode: str
+    value: Union[int, List[Pages], None]
+    output: str
+
+    def _chapters(
+        self, reader: PdfFileReader, pages: list
+    ) -> List[Tuple[str, range]]:
+        numbers = {reference.idnum: index for index, (reference, _) in enumerate(pages)}
+
+        starts = []
+        for entry in reader.getOutlines():
+            # the nested lists are the subchapters
+            if isinstance(entry, list) or not isinstance(entry.page, IndirectObject):
+                continue
+
+            index = numbers.get(entry.page.idnum)
+            if index is not None:
+                starts.append((index, entry.title))
+
+        starts.sort(key=lambda start: start[0])
+        # chapters that start on the same page as the next one would be empty
+        starts = [
+            start
+            for start, following in zip(starts, starts[1:] + [(None, None)])
+            if start[0] != following[0]
+        ]
+
+        if not starts:
+            raise NoOutlineError(
+                "Your PDF doesn't have any chapters (bookmarks) I could go by."
+            )
+
+        chapters = []
+        for number, (start, title) in enumerate(starts):
+            # the pages before the first chapter go along with it
+            if number == 0:
+                start = 0
+            end = starts[number + 1][0] if number + 1 < len(starts) else len(pages)
+
+            title = re.sub(r"[^\w\- ]+", "", str(title)).strip().replace(" ", "_")
+            name = f"{number + 1:02d}_{title[:50] or 'chapter'}.pdf"
+            chapters.append((name, range(start, end)))
+
+        return chapters
+
+    def _groups(
+        self, reader: PdfFileReader, pages: list
+    ) -> List[Tuple[str, Sequence[int]]]:
+        """The names of the files and the page indexes that go into them."""
+        page_count = len(pages)
+        stem = splitext(basename(self.input))[0]
+
+        if self.mode == "chapters":
+            return self._chapters(reader, pages)
+
+        if self.mode == "groups":
+            return [
+                (f"{stem}_part_{number:02d}.pdf", _page_indexes(group, page_count))
+                for number, group in enumerate(self.value, start=1)
+            ]
+
+        if self.value < 1:
+            raise PageRangeError("Zero is not a valid number. Try again.")
+
+        if self.mode == "every":
+            ranges = [
+                range(start, min(start + self.value, page_count))
+                for start in range(0, page_count, self.value)
+            ]
+        else:
+            if self.value > page_count:
+                raise PageRangeError("Your PDF doesn't have that many pages. Try again.")
+
+            size, extra = divmod(page_count, self.value)
+            ranges, start = [], 0
+            for part in range(self.value):
+                end = start + size + (part < extra)
+                ranges.append(range(start, end))
+                start = end
+
+        return [
+            (f"{stem}_pages_{pages.start + 1}-{pages.stop}.pdf", pages)
+            for pages in ranges
+        ]
+
+    def run(self) -> int:
+        """Returns the number of files in the ZIP."""
+        with open(self.input, "rb") as file:
+            reader = PdfFileReader(file)
+            pages = page_tree(reader)
+
+            groups = self._groups(reader, pages)
+            if len(groups) > MAX_BURST_FILES:
+                raise PageRangeError(
+                    f"That would be {len(groups)} files, I can only make "
+                    f"{MAX_BURST_FILES} at a time. Try again."
+                )
+
+            with zipfile.ZipFile(self.output, "w", zipfile.ZIP_DEFLATED) as archive:
+                for name, indexes in groups:
+                    # written straight into the ZIP, a page at a time
+                    with archive.open(name, "w") as entry:
+                        writer = StreamWriter(entry)
+                        writer.copy_pages(reader, indexes, prune=True, pages=pages)
+                        writer.close()
+
+        return len(groups)
+
+
+@dataclass
+class EncryptJob:
+    input: str
+    password: str
+    output: str
+    compact: bool = False
+
+    def run(self):
+        with open(self.input, "rb") as file:
+            input_pdf = PdfFileReader(file)
+
+            with open(self.output, "wb") as result:
+                output_pdf = StreamWriter(
+                    result, compact=self.compact, password=self.password
+                )
+                output_pdf.copy_pages(input_pdf)
+                output_pdf.close()
+
+
+@dataclass
+class DecryptJob:
+    input: str
+    password: str
+    output: str
+    compact: bool = False
+
+    def run(self):
+        """
+        Raises NotEncryptedError, WrongPasswordError or NotImplementedError
+        (if the file uses an encryption method PyPDF2 doesn't support).
+        """
+        with open(self.input, "rb") as file:
+            input_pdf = PdfFileReader(file)
+
+            if not input_pdf.isEncrypted:
+                raise NotEncryptedError("PDF is not encrypted.")
+
+            if input_pdf.decrypt(self.password) == 0:
+                raise WrongPasswordError(
+                    "Are you sure you typed the password correctly?\nTry again."
+                )
+
+            with open(self.output, "wb") as result:
+                output_pdf = StreamWriter(result, compact=self.compact)
+                output_pdf.copy_pages(input_pdf)
+                output_pdf.close()
+
+
+@dataclass
+class ImagesJob:
+    images: List[str]
+    output: str
+
+    def run(self):
+        """
+        Puts the images into the PDF, one per page, in the given order.
+        """
+        images = []
+
+        for image in self.images:
+            # removing the alpha channel (img2pdf doesn't accept it),
+            # the image is put on a white background and saved as a jpg
+            if image.endswith(".png"):
+                png = Image.open(image).convert("RGBA")
+                background = Image.new("RGBA", png.size, (255, 255, 255))
+
+                alpha_composite = Image.alpha_composite(background, png)
+
+                image = splitext(image)[0] + "_flattened.jpg"
+                alpha_composite.convert("RGB").save(image, "JPEG", quality=80)
+
+            images.append(image)
+
+        with open(self.output, "wb") as result:
+            result.write(img2pdf.convert(images))
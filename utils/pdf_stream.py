@@ -0,0 +1,958 @@
+"""
+Writes a PDF out of the pages of other PDFs, one input file at a time.
+
+PdfFileMerger keeps every input open and parsed until the very end.
+StreamWriter copies the pages of an input (and everything they use) into
+the output right away, then closes the input and forgets about it, so the
+memory it takes doesn't grow with the number of files:
+
+    with open(output, "wb") as result:
+        writer = StreamWriter(result)
+        for file in files:
+            writer.append(file)
+        writer.close()
+
+The objects of the inputs get new numbers in the output. All the pages
+are put under one page tree (the attributes they inherited from their old
+page trees are copied into them). When all the pages of an input are
+copied, its outline (bookmarks) goes along, after the ones of the inputs
+before it. The links and bookmarks that go to named destinations get the
+explicit destinations instead (the names of different inputs can clash,
+and the pages they point to get new numbers anyway). The rest of the
+document catalogs of the inputs is not copied.
+
+The identical fonts, images, color profiles and such of different inputs
+(e.g. the logo on every monthly statement) are written only once, the
+number of bytes that saved is in `saved`.
+
+When only some of the pages are copied, their resources can be pruned:
+a lot of PDFs have one resource dictionary (with every font and image in
+the document) shared by all the pages, and a page that is copied on its
+own would bring everything along.
+
+With compact=True the small objects are packed into compressed object
+streams, the xref table is a compressed stream as well, and the streams
+that aren't compressed (usually the text of the pages) get compressed.
+That takes longer to write, but the files are a lot smaller. With a
+password the output is encrypted the same way PdfFileWriter.encrypt does it.
+
+Like pdf_ops, this runs inside the PDF engine workers, so it must not
+import anything that belongs to the bot.
+"""
+import hashlib
+import logging
+import os
+import re
+import struct
+import zlib
+from functools import partial
+from io import BytesIO
+from typing import (
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import (
+    ArrayObject,
+    ByteStringObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+)
+from PyPDF2.pdf import _alg33, _alg35
+
+# the attributes a page takes from the page tree if it doesn't have them
+INHERITED_ATTRIBUTES = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+# the dictionaries (besides streams and arrays) that can be shared by the inputs
+SHARED_TYPES = ("/Font", "/FontDescriptor", "/Encoding", "/ExtGState")
+
+# the catalog and the page tree are written last, but their numbers are known
+CATALOG = 1
+PAGES = 2
+
+# the entries of an outline item that link it to the others (and to the
+# structure tree, which isn't copied)
+OUTLINE_LINKS = ("/Parent", "/Prev", "/Next", "/First", "/Last", "/Count", "/SE")
+
+# the xref entry of a number that was given out but never written
+# (e.g. to a bookmark of an outline that turned out to be broken)
+FREE = (0, 0, 0)
+
+# how many objects are packed into one object stream (in compact mode)
+OBJECTS_PER_STREAM = 200
+
+# the kinds of resources the page contents refer to by name
+NAMED_RESOURCES = (
+    "/Font",
+    "/XObject",
+    "/ExtGState",
+    "/ColorSpace",
+    "/Pattern",
+    "/Shading",
+    "/Properties",
+)
+
+# anything that looks like a name in the page contents (names in strings
+# and images count as well, but keeping too much doesn't break anything)
+NAME = re.compile(rb"/([^\s/\[\]()<>{}%]*)")
+ESCAPED = re.compile(rb"#([0-9a-fA-F]{2})")
+
+
+class CountingWriter:
+    """
+    Keeps track of how many bytes were written, for the xref table
+    (files inside a ZIP, for example, can't tell() where they are).
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.position = 0
+
+    def write(self, data: bytes):
+        self.file.write(data)
+        self.position += len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+
+def page_tree(reader: PdfFileReader) -> List[Tuple[IndirectObject, dict]]:
+    """
+    The reference of every page (in order) and the attributes it inherits
+    from the page tree, without keeping the pages themselves around.
+    """
+    pages = []
+
+    def walk(reference, inherited: dict):
+        node = reference.getObject()
+        inherited = {
+            **inherited,
+            **{
+                attribute: dict.__getitem__(node, attribute)
+                for attribute in INHERITED_ATTRIBUTES
+                if attribute in node
+            },
+        }
+
+        if "/Kids" in node:
+            for kid in node["/Kids"]:
+                walk(kid, inherited)
+        else:
+            pages.append((reference, inherited))
+
+    walk(dict.__getitem__(reader.trailer["/Root"], "/Pages"), {})
+    return pages
+
+
+def _references(value) -> Iterator[IndirectObject]:
+    """The references in the object (not in the objects it references)."""
+    if isinstance(value, IndirectObject):
+        yield value
+    elif isinstance(value, DictionaryObject):
+        for key, item in value.items():
+            # the length is written along with the data
+            if key != "/Length" or not isinstance(value, StreamObject):
+                yield from _references(item)
+    elif isinstance(value, ArrayObject):
+        for item in value:
+            yield from _references(item)
+
+
+def _destination_name(value) -> Optional[str]:
+    """
+    The name of a named destination, or None if it's an explicit one.
+    The names of /Dests are names and the ones of the name tree are
+    strings, but nobody mixes them up on purpose.
+    """
+    if isinstance(value, NameObject):
+        return value[1:]
+    if isinstance(value, bytes):
+        return value.decode("latin-1")
+    if isinstance(value, str):
+        return value
+    return None
+
+
+def _named_destinations(reader: PdfFileReader) -> Dict[str, ArrayObject]:
+    """
+    The named destinations of the PDF (from /Dests and the /Dests name
+    tree), as the explicit [page /XYZ ...] destinations they stand for.
+    """
+    destinations: Dict[str, ArrayObject] = {}
+
+    def add(name, value):
+        value = value.getObject()
+        # the value can also be a dictionary with the destination in /D
+        if isinstance(value, DictionaryObject):
+            value = value.get("/D")
+            value = value and value.getObject()
+        if isinstance(value, ArrayObject) and _destination_name(name) is not None:
+            destinations.setdefault(_destination_name(name), value)
+
+    def walk(node, seen: Set[int]):
+        node = node.getObject()
+        # the trees of broken PDFs can go in circles
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+
+        names = node.get("/Names")
+        if names is not None:
+            names = names.getObject()
+            for index in range(0, len(names) - 1, 2):
+                add(names[index], names[index + 1])
+
+        for kid in node.get("/Kids", ()):
+            walk(kid, seen)
+
+    # a broken tree only takes the named destinations with it
+    try:
+        catalog = reader.trailer["/Root"]
+
+        dests = catalog.get("/Dests")
+        if dests is not None:
+            for name, value in dests.getObject().items():
+                add(name, value)
+
+        names = catalog.get("/Names")
+        tree = names and names.getObject().get("/Dests")
+        if tree is not None:
+            walk(tree, set())
+    except Exception:
+        pass
+
+    return destinations
+
+
+def _is_named_destination(value: DictionaryObject, key: str, item) -> bool:
+    """Whether the entry of a link (or a bookmark) is a named destination."""
+    if key == "/D":
+        if value.get("/S") != "/GoTo":
+            return False
+    elif key != "/Dest":
+        return False
+
+    return _destination_name(item) is not None
+
+
+def _renumber(
+    value,
+    number_of: Callable[[IndirectObject], Optional[int]],
+    destinations: Optional[Dict[str, ArrayObject]] = None,
+):
+    """
+    Copies the object, with the references pointing to the new numbers
+    (and the named destinations replaced with the explicit ones).
+    """
+    renumber = partial(_renumber, number_of=number_of, destinations=destinations)
+
+    if isinstance(value, IndirectObject):
+        number = number_of(value)
+        # it points to something that isn't copied (e.g. a page that was left out)
+        if number is None:
+            return NullObject()
+        return IndirectObject(number, 0, None)
+
+    if isinstance(value, StreamObject):
+        copy = StreamObject()
+        copy._data = value._data
+        for key, item in value.items():
+            # the length is written along with the data
+            if key != "/Length":
+                copy[key] = renumber(item)
+        return copy
+
+    if isinstance(value, DictionaryObject):
+        copy = DictionaryObject()
+        for key, item in value.items():
+            # the names that aren't known stay as they are
+            if destinations and _is_named_destination(value, key, item):
+                item = destinations.get(_destination_name(item), item)
+            copy[key] = renumber(item)
+        return copy
+
+    if isinstance(value, ArrayObject):
+        return ArrayObject(renumber(item) for item in value)
+
+    return value
+
+
+def _serialize(value, key: Optional[bytes] = None) -> bytes:
+    """The object the way it's written in a file (encrypted if there's a key)."""
+    if value is None:
+        # a reference to an object that doesn't exist
+        return b"null"
+
+    data = BytesIO()
+    value.writeToStream(data, key)
+    return data.getvalue()
+
+
+def _used_names(page: DictionaryObject) -> Set[bytes]:
+    """The names in the contents of the page."""
+    contents = page.get("/Contents")
+    if contents is None:
+        return set()
+
+    contents = contents.getObject()
+    if isinstance(contents, ArrayObject):
+        streams = [stream.getObject() for stream in contents]
+    else:
+        streams = [contents]
+
+    names = set()
+    for stream in streams:
+        for name in NAME.findall(stream.getData()):
+            names.add(name)
+            # the names may have escaped characters (#20 is a space)
+            names.add(ESCAPED.sub(lambda code: bytes.fromhex(code[1].decode()), name))
+
+    return names
+
+
+def _needs_page_resources(value) -> bool:
+    """
+    Form XObjects, Type3 fonts and tiling patterns that don't have their own
+    resources use the ones of the page, which can't be pruned then.
+    """
+    return (
+        isinstance(value, DictionaryObject)
+        and "/Resources" not in value
+        and (
+            value.get("/Subtype") in ("/Form", "/Type3")
+            or value.get("/PatternType") == 1
+        )
+    )
+
+
+def _pruned_resources(page: DictionaryObject) -> Optional[DictionaryObject]:
+    """
+    The resources of the page without the ones its contents don't use,
+    or None if that can't be figured out.
+    """
+    try:
+        used = _used_names(page)
+        resources = page["/Resources"]
+
+        pruned = DictionaryObject()
+        for kind, entries in resources.items():
+            if kind not in NAMED_RESOURCES or not isinstance(
+                entries.getObject(), DictionaryObject
+            ):
+                pruned[kind] = entries
+                continue
+
+            kept = DictionaryObject()
+            for name, value in entries.getObject().items():
+                if name[1:].encode("utf-8") not in used:
+                    continue
+                if _needs_page_resources(value.getObject()):
+                    return None
+                kept[name] = value
+
+            pruned[kind] = kept
+    # whatever went wrong (e.g. a filter PyPDF2 doesn't know),
+    # the resources are copied as they are
+    except Exception:
+        return None
+
+    return pruned
+
+
+def _compress(value):
+    """Compresses the stream (the copy of it) if it isn't compressed yet."""
+    if (
+        not isinstance(value, StreamObject)
+        or "/Filter" in value
+        or "/DecodeParms" in value
+    ):
+        return value
+
+    data = zlib.compress(value._data)
+    # random data (and tiny streams) only get bigger
+    if len(data) < len(value._data):
+        value._data = data
+        value[NameObject("/Filter")] = NameObject("/FlateDecode")
+
+    return value
+
+
+def _shareable(value) -> bool:
+    """
+    Whether the object is just data, so the identical objects of different
+    inputs can be written once (annotations, for example, are not).
+    """
+    if isinstance(value, (StreamObject, ArrayObject)):
+        return True
+
+    return (
+        isinstance(value, DictionaryObject)
+        and value.get("/Type") in SHARED_TYPES
+    )
+
+
+class _Encryption:
+    """
+    The standard security handler with a 128 bit RC4 key, everything allowed
+    (the same as PdfFileWriter.encrypt(password)).
+    """
+
+    revision = 3
+    key_length = 16
+
+    def __init__(self, password: str):
+        permissions = -1
+
+        owner_entry = ByteStringObject(
+            _alg33(password, password, self.revision, self.key_length)
+        )
+        self.id = ByteStringObject(os.urandom(16))
+        user_entry, self._key = _alg35(
+            password,
+            self.revision,
+            self.key_length,
+            owner_entry,
+            permissions,
+            self.id,
+            False,
+        )
+
+        self.dictionary = DictionaryObject(
+            {
+                NameObject("/Filter"): NameObject("/Standard"),
+                NameObject("/V"): NumberObject(2),
+                NameObject("/Length"): NumberObject(self.key_length * 8),
+                NameObject("/R"): NumberObject(self.revision),
+                NameObject("/O"): owner_entry,
+                NameObject("/U"): ByteStringObject(user_entry),
+                NameObject("/P"): NumberObject(permissions),
+            }
+        )
+
+    def key(self, number: int) -> bytes:
+        """Every object is encrypted with its own key."""
+        key = self._key + struct.pack("<i", number)[:3] + struct.pack("<i", 0)[:2]
+        return hashlib.md5(key).digest()[: min(16, len(self._key) + 5)]
+
+
+class _Input:
+    """What is known about the PDF that is being copied."""
+
+    def __init__(self):
+        # (number, generation) in the input -> number in the output
+        # (None for the pages that are left out)
+        self.numbers: Dict[Tuple[int, int], Optional[int]] = {}
+        # the objects that don't have to be copied anymore
+        self.done: Set[Tuple[int, int]] = set()
+        # the objects that wait for the objects they reference to be copied
+        self.waiting: Set[Tuple[int, int]] = set()
+        # the named destinations, see _named_destinations()
+        self.destinations: Dict[str, ArrayObject] = {}
+
+
+def _read_outline(
+    reference, seen: Set[int]
+) -> List[Tuple[DictionaryObject, bool, list]]:
+    """
+    The outline item and the ones after it, as (the title, the destination
+    and such, whether it's open, the children). Raises if it's broken.
+    """
+    outline = []
+
+    while reference is not None:
+        item = reference.getObject()
+        # the outlines of broken PDFs can go in circles
+        if id(item) in seen:
+            break
+        seen.add(id(item))
+
+        count = item.get("/Count")
+        count = 0 if count is None else count.getObject()
+        if not isinstance(count, int):
+            raise ValueError(f"the /Count of an outline item is {count!r}")
+
+        outline.append(
+            (
+                DictionaryObject(
+                    (key, value)
+                    for key, value in item.items()
+                    if key not in OUTLINE_LINKS
+                ),
+                # the children of the closed items are hidden
+                count >= 0,
+                _read_outline(item.get("/First"), seen),
+            )
+        )
+
+        reference = item.get("/Next")
+
+    return outline
+
+
+class _Bookmark:
+    """An outline item, kept until the whole outline is written."""
+
+    def __init__(self, number: int, item: DictionaryObject, is_open: bool):
+        self.number = number
+        # the title, the destination and such (already renumbered)
+        self.item = item
+        self.is_open = is_open
+        self.children: List["_Bookmark"] = []
+
+
+class StreamWriter:
+    def __init__(
+        self, output: BinaryIO, compact: bool = False, password: Optional[str] = None
+    ):
+        self.output = CountingWriter(output)
+        self.compact = compact
+        self._encryption = _Encryption(password) if password is not None else None
+        self._encryption_number: Optional[int] = None
+
+        # new object number -> (1, where it starts in the output) or
+        # (2, the number of the object stream it's in, its index in there)
+        self._offsets: Dict[int, Tuple[int, int, int]] = {}
+        self._next_number = PAGES + 1
+        # the new numbers of the pages, in order
+        self._kids: List[int] = []
+        # the objects waiting to be packed into an object stream
+        self._packed: List[Tuple[int, bytes]] = []
+        # the top level bookmarks of all the inputs
+        self._bookmarks: List[_Bookmark] = []
+
+        # the hash of an object that can be shared -> its number
+        self._shared: Dict[bytes, int] = {}
+        # how many bytes were not written thanks to sharing
+        self.saved = 0
+
+        # the binary comment tells programs that the file isn't plain text
+        self.output.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _new_number(self) -> int:
+        number = self._next_number
+        self._next_number += 1
+        return number
+
+    def _write_raw(self, number: int, data: bytes):
+        self._offsets[number] = (1, self.output.tell(), 0)
+        self.output.write(b"%d 0 obj\n" % number)
+        self.output.write(data)
+        self.output.write(b"\nendobj\n")
+
+    def _write_object(self, number: int, value, data: Optional[bytes] = None):
+        """
+        Writes the object (or puts it into an object stream).
+        data is the object already serialized (without encryption), if it was.
+        """
+        if self.compact and not isinstance(value, StreamObject):
+            # the strings in there are encrypted along with the object stream
+            self._packed.append((number, data or _serialize(value)))
+            if len(self._packed) >= OBJECTS_PER_STREAM:
+                self._write_object_stream()
+            return
+
+        if self._encryption is not None:
+            data = _serialize(value, self._encryption.key(number))
+        elif data is None:
+            data = _serialize(value)
+
+        self._write_raw(number, data)
+
+    def _write_object_stream(self):
+        number = self._new_number()
+
+        header, body = [], []
+        position = 0
+        for index, (packed, data) in enumerate(self._packed):
+            header.append(b"%d %d" % (packed, position))
+            body.append(data)
+            position += len(data) + 1
+
+            self._offsets[packed] = (2, number, index)
+
+        header = b" ".join(header) + b"\n"
+        stream = StreamObject()
+        stream._data = zlib.compress(header + b"\n".join(body))
+        stream.update(
+            {
+                NameObject("/Type"): NameObject("/ObjStm"),
+                NameObject("/N"): NumberObject(len(self._packed)),
+                NameObject("/First"): NumberObject(len(header)),
+                NameObject("/Filter"): NameObject("/FlateDecode"),
+            }
+        )
+
+        self._packed = []
+        self._write_object(number, stream)
+
+    def _number_of(self, source: _Input, reference: IndirectObject) -> int:
+        key = (reference.idnum, reference.generation)
+
+        if key not in source.numbers:
+            if key in source.waiting:
+                # the object references (through others) the one that is
+                # waiting for it, so that one gets its number before it's written
+                source.numbers[key] = self._new_number()
+            else:
+                self._copy(source, reference)
+
+        return source.numbers[key]
+
+    def _copy(self, source: _Input, reference: IndirectObject):
+        """
+        Copies the object and everything it references.
+        The objects are written after the ones they reference, so by the time
+        an object is written its references are final, and it can be compared
+        to the objects that were written before.
+        """
+        number_of = partial(self._number_of, source)
+        renumber = partial(
+            _renumber, number_of=number_of, destinations=source.destinations
+        )
+        stack = [reference]
+
+        while stack:
+            reference = stack[-1]
+            key = (reference.idnum, reference.generation)
+
+            if key in source.done:
+                stack.pop()
+            elif key not in source.waiting:
+                # the objects it references go first
+                source.waiting.add(key)
+                stack.extend(
+                    used
+                    for used in _references(reference.getObject())
+                    if (used.idnum, used.generation) not in source.done
+                    and (used.idnum, used.generation) not in source.waiting
+                )
+            else:
+                stack.pop()
+                value = renumber(reference.getObject())
+
+                source.waiting.discard(key)
+                source.done.add(key)
+                self._store(source, key, value)
+
+    def _store(self, source: _Input, key: Tuple[int, int], value):
+        if self.compact:
+            value = _compress(value)
+        data = _serialize(value)
+
+        if key in source.numbers:
+            # it's a part of a cycle, so it was referenced already
+            self._write_object(source.numbers[key], value, data)
+            return
+
+        digest = None
+        if _shareable(value):
+            digest = hashlib.sha256(data).digest()
+
+            number = self._shared.get(digest)
+            if number is not None:
+                # the same object is in the output already
+                source.numbers[key] = number
+                self.saved += len(data)
+                return
+
+        number = source.numbers[key] = self._new_number()
+        self._write_object(number, value, data)
+
+        if digest is not None:
+            self._shared[digest] = number
+
+    def append(self, path: str):
+        """Copies all the pages of the PDF to the end of the output."""
+        with open(path, "rb") as file:
+            reader = PdfFileReader(file, strict=False)
+
+            # PDFs that only have an owner password open without one
+            if reader.isEncrypted:
+                reader.decrypt("")
+
+            self.copy_pages(reader)
+
+    def copy_pages(
+        self,
+        reader: PdfFileReader,
+        indexes: Optional[Iterable[int]] = None,
+        prune: bool = False,
+        pages: Optional[List[Tuple[IndirectObject, dict]]] = None,
+    ):
+        """
+        Copies the pages with these indexes (all of them by default)
+        to the end of the output, and the outline if all of them are copied.
+        The reader must be decrypted already.
+        prune: leave out the resources the pages don't use
+        pages: the page_tree() of the reader, if it's known already
+        """
+        if pages is None:
+            pages = page_tree(reader)
+        copy_outline = indexes is None
+        indexes = range(len(pages)) if indexes is None else list(indexes)
+
+        source = _Input()
+        source.destinations = _named_destinations(reader)
+        number_of = partial(self._number_of, source)
+
+        # the pages get their numbers first, so that the links between them
+        # point to the copies, and aren't copied as plain objects
+        # (the links to the pages that are left out are removed)
+        for reference, _ in pages:
+            key = (reference.idnum, reference.generation)
+            source.numbers[key] = None
+            source.done.add(key)
+        for index in indexes:
+            reference = pages[index][0]
+            key = (reference.idnum, reference.generation)
+            if source.numbers[key] is None:
+                source.numbers[key] = self._new_number()
+
+        written = set()
+        for index in indexes:
+            reference, inherited = pages[index]
+            key = (reference.idnum, reference.generation)
+
+            # a page that comes up more than once is written more than once
+            # (the links to it point to the first one)
+            if key in written:
+                number = self._new_number()
+            else:
+                number = source.numbers[key]
+                written.add(key)
+
+            page = DictionaryObject(reference.getObject())
+
+            for attribute, value in inherited.items():
+                if attribute not in page:
+                    page[NameObject(attribute)] = value
+            # the old page tree isn't copied
+            page.pop("/Parent", None)
+
+            if prune and "/Resources" in page:
+                resources = _pruned_resources(page)
+                if resources is not None:
+                    page[NameObject("/Resources")] = resources
+
+            # copies everything the page uses (that isn't in the output yet)
+            page = _renumber(page, number_of, source.destinations)
+            page[NameObject("/Parent")] = IndirectObject(PAGES, 0, None)
+
+            self._write_object(number, page)
+            self._kids.append(number)
+
+            # what was read for this page is in the output already,
+            # the parsed objects aren't needed anymore
+            reader.resolvedObjects.clear()
+
+        if copy_outline:
+            self._copy_outline(reader, source)
+
+    def _copy_outline(self, reader: PdfFileReader, source: _Input):
+        """Adds the bookmarks of the input after the ones that are there already."""
+        # the whole outline is read (and checked) before anything is copied
+        # (the numbers given out have to be written)
+        try:
+            outlines = reader.trailer["/Root"].get("/Outlines")
+            first = outlines and outlines.getObject().get("/First")
+            outline = _read_outline(first, set())
+        # a broken outline isn't worth failing the whole job for
+        except Exception:
+            logging.exception("Couldn't read the outline")
+            return
+
+        try:
+            self._bookmarks.extend(self._copy_bookmarks(source, outline))
+        except Exception:
+            # the numbers of the bookmarks that were copied stay unused
+            logging.exception("Couldn't copy the outline")
+
+    def _copy_bookmarks(
+        self, source: _Input, outline: List[Tuple[DictionaryObject, bool, list]]
+    ) -> List[_Bookmark]:
+        bookmarks = []
+
+        for item, is_open, children in outline:
+            bookmark = _Bookmark(
+                self._new_number(),
+                _renumber(item, partial(self._number_of, source), source.destinations),
+                is_open,
+            )
+            bookmark.children = self._copy_bookmarks(source, children)
+            bookmarks.append(bookmark)
+
+        return bookmarks
+
+    def _write_bookmarks(self, bookmarks: List[_Bookmark], parent: int) -> int:
+        """
+        Writes the outline items and returns how many of them are visible
+        (for the /Count of the parent).
+        """
+        visible = 0
+
+        for index, bookmark in enumerate(bookmarks):
+            item = bookmark.item
+            item[NameObject("/Parent")] = IndirectObject(parent, 0, None)
+            if index > 0:
+                item[NameObject("/Prev")] = IndirectObject(
+                    bookmarks[index - 1].number, 0, None
+                )
+            if index + 1 < len(bookmarks):
+                item[NameObject("/Next")] = IndirectObject(
+                    bookmarks[index + 1].number, 0, None
+                )
+
+            visible += 1
+            if bookmark.children:
+                item[NameObject("/First")] = IndirectObject(
+                    bookmark.children[0].number, 0, None
+                )
+                item[NameObject("/Last")] = IndirectObject(
+                    bookmark.children[-1].number, 0, None
+                )
+
+                count = self._write_bookmarks(bookmark.children, bookmark.number)
+                if bookmark.is_open:
+                    item[NameObject("/Count")] = NumberObject(count)
+                    visible += count
+                else:
+                    item[NameObject("/Count")] = NumberObject(-count)
+
+            self._write_object(bookmark.number, item)
+
+        return visible
+
+    def _trailer(self, size: int) -> DictionaryObject:
+        trailer = DictionaryObject(
+            {
+                NameObject("/Size"): NumberObject(size),
+                NameObject("/Root"): IndirectObject(CATALOG, 0, None),
+            }
+        )
+
+        if self._encryption is not None:
+            trailer[NameObject("/Encrypt")] = IndirectObject(
+                self._encryption_number, 0, None
+            )
+            trailer[NameObject("/ID")] = ArrayObject(
+                [self._encryption.id, self._encryption.id]
+            )
+
+        return trailer
+
+    def close(self):
+        """Writes the page tree, the catalog and the xref table."""
+        pages = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Kids"): ArrayObject(
+                    IndirectObject(number, 0, None) for number in self._kids
+                ),
+                NameObject("/Count"): NumberObject(len(self._kids)),
+            }
+        )
+        catalog = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Catalog"),
+                NameObject("/Pages"): IndirectObject(PAGES, 0, None),
+            }
+        )
+        if self._bookmarks:
+            outlines = self._new_number()
+            count = self._write_bookmarks(self._bookmarks, outlines)
+            self._write_object(
+                outlines,
+                DictionaryObject(
+                    {
+                        NameObject("/Type"): NameObject("/Outlines"),
+                        NameObject("/First"): IndirectObject(
+                            self._bookmarks[0].number, 0, None
+                        ),
+                        NameObject("/Last"): IndirectObject(
+                            self._bookmarks[-1].number, 0, None
+                        ),
+                        NameObject("/Count"): NumberObject(count),
+                    }
+                ),
+            )
+            catalog[NameObject("/Outlines")] = IndirectObject(outlines, 0, None)
+
+        self._write_object(PAGES, pages)
+        self._write_object(CATALOG, catalog)
+
+        if self._encryption is not None:
+            # the only object that is never encrypted (or packed)
+            self._encryption_number = self._new_number()
+            self._write_raw(
+                self._encryption_number, _serialize(self._encryption.dictionary)
+            )
+
+        if self._packed:
+            self._write_object_stream()
+
+        if self.compact:
+            self._write_xref_stream()
+        else:
+            self._write_xref_table()
+
+    def _write_xref_table(self):
+        size = self._next_number
+        xref = self.output.tell()
+
+        self.output.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        for number in range(1, size):
+            kind, offset, _ = self._offsets.get(number, FREE)
+            if kind == 0:
+                self.output.write(b"0000000000 00001 f \n")
+            else:
+                self.output.write(b"%010d 00000 n \n" % offset)
+
+        self.output.write(b"trailer\n")
+        self.output.write(_serialize(self._trailer(size)))
+        self.output.write(b"\nstartxref\n%d\n%%%%EOF\n" % xref)
+
+    def _write_xref_stream(self):
+        number = self._new_number()
+        size = self._next_number
+        xref = self.output.tell()
+        self._offsets[number] = (1, xref, 0)
+
+        # the offsets (and the object stream numbers) take up this many bytes
+        width = max(1, (xref.bit_length() + 7) // 8)
+
+        rows = [b"\x00" + (0).to_bytes(width, "big") + b"\xff\xff"]
+        for kind, offset, index in (
+            self._offsets.get(number, FREE) for number in range(1, size)
+        ):
+            rows.append(
+                bytes([kind]) + offset.to_bytes(width, "big") + index.to_bytes(2, "big")
+            )
+
+        stream = StreamObject()
+        stream._data = zlib.compress(b"".join(rows))
+        stream.update(self._trailer(size))
+        stream.update(
+            {
+                NameObject("/Type"): NameObject("/XRef"),
+                NameObject("/W"): ArrayObject(
+                    [NumberObject(1), NumberObject(width), NumberObject(2)]
+                ),
+                NameObject("/Filter"): NameObject("/FlateDecode"),
+            }
+        )
+
+        # the xref stream isn't encrypted
+        self._write_raw(number, _serialize(stream))
+        self.output.write(b"startxref\n%d\n%%%%EOF\n" % xref)
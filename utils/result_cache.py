@@ -0,0 +1,140 @@
+"""
+A cache of the results that were already sent to users.
+Telegram gives every file a `file_unique_id` that stays the same no matter
+who sends it, so (input files, operation, parameters) identifies a result.
+For every result we remember the `file_id` of the document we uploaded, and
+the next time somebody asks for the same thing, the bot just sends that
+file_id again instead of doing all the work and uploading it once more.
+The cache lives in an SQLite database, so it survives restarts.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Iterable, Optional
+
+from aiogram import types
+from aiogram.utils.exceptions import BadRequest
+from data import config
+
+cache_path = os.path.join(os.getcwd(), "user_files", "result_cache.sqlite3")
+
+
+def hash_password(password: str) -> str:
+    """Passwords never end up in the cache as they are."""
+    return hashlib.sha256(password.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path: str, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, file_id TEXT NOT NULL, summary TEXT, "
+            "created REAL NOT NULL, used REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+        self.db.commit()
+
+    @staticmethod
+    def make_key(operation: str, unique_ids: Iterable[str], **params) -> str:
+        """
+        Builds the cache key out of the unique ids of the input files
+        (the order matters), the operation and its parameters.
+        """
+        key = json.dumps(
+            [operation, list(unique_ids), params], sort_keys=True, default=str
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        row = self.db.execute(
+            "SELECT file_id, summary, created FROM results WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        file_id, summary, created = row
+        now = time.time()
+
+        if now - created > self.ttl:
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.db.commit()
+            return None
+
+        self.db.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+        self.db.commit()
+
+        return {"file_id": file_id, "summary": summary}
+
+    def delete(self, key: str):
+        self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+        self.db.commit()
+
+    def put(self, key: str, file_id: str, summary: Optional[str] = None):
+        now = time.time()
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+            (key, file_id, summary, now, now),
+        )
+        self.evict(now)
+        self.db.commit()
+
+    def evict(self, now: float):
+        """
+        Drops the expired entries and, if there are still too many,
+        the ones that haven't been used for the longest time.
+        """
+        self.db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+
+        (count,) = self.db.execute("SELECT COUNT(*) FROM results").fetchone()
+
+        if count > self.max_entries:
+            self.db.execute(
+                "DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            logging.info(f"Evicted {count - self.max_entries} cached results")
+
+
+result_cache = ResultCache(
+    cache_path, config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL
+)
+
+
+async def send_cached_result(message: types.Message, key: str) -> bool:
+    """
+    If the result is in the cache, sends it to the user and returns True.
+    If telegram doesn't take the file_id anymore (or never did, e.g. it's
+    from another bot token), the entry is dropped and False is returned,
+    so the handler does the job from scratch.
+    """
+    cached = result_cache.get(key)
+
+    if cached is None:
+        return False
+
+    logging.info("Sending a cached result")
+
+    if cached["summary"]:
+        await message.answer(cached["summary"])
+
+    await message.answer_chat_action(action="upload_document")
+
+    try:
+        await message.reply_document(cached["file_id"], caption="Here you go")
+    except BadRequest as err:
+        logging.info(f"The cached result can't be sent: {err!r}")
+        result_cache.delete(key)
+        return False
+
+    return True
@@ -0,0 +1,65 @@
+"""
+This module runs external tools (Ghostscript and friends) without blocking
+the event loop. Every tool has its own semaphore, so only a limited number
+of processes of the same kind run at once and the other jobs wait their turn
+while the bot keeps answering everybody else.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from data import config
+from utils.metrics import stage_seconds
+
+# maximum number of processes that may run at the same time for every tool
+limits = {
+    "gs": config.GS_WORKERS,
+}
+
+# semaphores are created lazily so that they belong to the running loop
+_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _get_semaphore(tool: str) -> asyncio.Semaphore:
+    if tool not in _semaphores:
+        _semaphores[tool] = asyncio.Semaphore(limits.get(tool, 1))
+    return _semaphores[tool]
+
+
+async def run_tool(
+    tool: str, args: List[str], timeout: Optional[float] = None
+) -> Tuple[int, bytes]:
+    """
+    Runs `tool` with the given arguments as an asyncio subprocess once
+    there is a free slot for that tool.
+    Returns the exit code and whatever the process wrote to stderr.
+    If the process takes longer than `timeout` seconds, it gets killed
+    and asyncio.TimeoutError is raised.
+    """
+    semaphore = _get_semaphore(tool)
+
+    if semaphore.locked():
+        logging.info(f"All {tool} slots are busy, waiting for a free one")
+
+    async with semaphore:
+        # stage_seconds.time is a plain (not async) context manager
+        with stage_seconds.time(stage=tool):
+            process = await asyncio.create_subprocess_exec(
+                tool,
+                *args,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logging.error(f"{tool} took too long and was killed")
+                raise
+
+    if process.returncode != 0:
+        logging.error(f"{tool} exited with code {process.returncode}: {stderr!r}")
+
+    return process.returncode, stderr
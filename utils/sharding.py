@@ -0,0 +1,247 @@
+"""
+Runs the bot as several worker processes, so that more than one event loop
+(and more than one CPU core) handles the updates.
+
+The front process polls telegram (or, in webhook mode, runs the web server
+telegram sends the updates to) and sends every update to one of the workers,
+the worker is chosen by the chat of the update (chat id % number of workers).
+That way all the updates of a chat are handled by the same worker, in the
+order in which telegram sent them, and the in-memory parts of the bot (the
+cache of the FSM storage, the locks of the merge lists) still work.
+The workers share the FSM storage and the user_files/ directory.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+from typing import Callable, List, Optional
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+
+def update_chat_id(update: dict) -> Optional[int]:
+    """
+    Finds the chat the update belongs to. For the updates that don't have a
+    chat (inline queries and such) the user id is used, it's the same as the
+    id of the private chat with that user.
+    """
+    for kind in (
+        "message",
+        "edited_message",
+        "channel_post",
+        "edited_channel_post",
+        "my_chat_member",
+        "chat_member",
+    ):
+        if kind in update:
+            return update[kind]["chat"]["id"]
+
+    if "callback_query" in update:
+        query = update["callback_query"]
+        if "message" in query:
+            return query["message"]["chat"]["id"]
+        return query["from"]["id"]
+
+    for kind in (
+        "inline_query",
+        "chosen_inline_result",
+        "shipping_query",
+        "pre_checkout_query",
+    ):
+        if kind in update:
+            return update[kind]["from"]["id"]
+
+    if "poll_answer" in update:
+        return update["poll_answer"]["user"]["id"]
+
+    return None
+
+
+def shard_of(update: dict, workers: int) -> int:
+    # updates without a chat (polls) go to the first worker
+    return (update_chat_id(update) or 0) % workers
+
+
+async def _process(dp: Dispatcher, data: dict):
+    try:
+        await dp.process_update(types.Update.to_object(data))
+    except Exception:
+        logging.exception("Failed to process an update")
+
+
+async def _serve(dp: Dispatcher, queue, on_startup: Callable, on_shutdown: Callable):
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    await on_startup(dp)
+
+    loop = asyncio.get_event_loop()
+    # the updates are handled at the same time (like in polling mode),
+    # the albums depend on it
+    tasks = set()
+
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+
+            # the front process is shutting down
+            if data is None:
+                break
+
+            task = asyncio.ensure_future(_process(dp, data))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await dp.bot.session.close()
+
+
+def _worker(index: int, queue, on_startup: Callable, on_shutdown: Callable):
+    # Ctrl+C reaches the whole process group, but the workers are stopped
+    # by the front process, once it's done polling
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from loader import dp
+
+    logging.info(f"Worker {index} started")
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_serve(dp, queue, on_startup, on_shutdown))
+
+
+def _dispatch(queues: List, data: dict):
+    queues[shard_of(data, len(queues))].put(data)
+
+
+async def _poll(dp: Dispatcher, queues: List, on_startup: Callable):
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    await on_startup(dp)
+
+    offset = None
+
+    while True:
+        try:
+            updates = await dp.bot.get_updates(offset=offset, timeout=20)
+        except Exception:
+            logging.exception("Failed to get the updates")
+            await asyncio.sleep(5)
+            continue
+
+        for update in updates:
+            offset = update.update_id + 1
+
+            _dispatch(queues, update.to_python())
+
+
+async def _listen(
+    dp: Dispatcher, queues: List, on_startup: Callable, path: str, host: str, port: int
+):
+    """Passes on the updates telegram sends to the webhook."""
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+
+    async def receive(request: web.Request) -> web.Response:
+        _dispatch(queues, await request.json())
+        # the update is handled by the worker, telegram only has to know
+        # that it arrived
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # listening before the webhook is set, so the first updates aren't refused
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Listening for the updates on {host}:{port}{path}")
+
+    try:
+        await on_startup(dp)
+        # until the process is stopped
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def start_sharded(
+    dp: Dispatcher,
+    workers: int,
+    on_startup: Callable,
+    worker_startup: Callable,
+    worker_shutdown: Callable,
+    webhook_path: Optional[str] = None,
+    host: str = "127.0.0.1",
+    port: int = 8080,
+):
+    """
+    Starts the workers and polls telegram until the process is stopped.
+    If `webhook_path` is set, the updates are received on host:port instead.
+    `on_startup` is called in the front process, `worker_startup` and
+    `worker_shutdown` in every worker.
+    """
+    if isinstance(dp.storage, MemoryStorage):
+        raise RuntimeError(
+            "The workers can't share the memory storage, "
+            "set FSM_STORAGE to sqlite or redis"
+        )
+
+    # the workers import everything from scratch instead of inheriting the
+    # event loop and the connections of the front process
+    context = multiprocessing.get_context("spawn")
+
+    queues = [context.Queue() for _ in range(workers)]
+    processes = []
+
+    for index in range(workers):
+        # lets the worker know which one it is (see SHARD in the config)
+        os.environ["SHARD"] = str(index)
+
+        process = context.Process(
+            target=_worker,
+            args=(index, queues[index], worker_startup, worker_shutdown),
+            name=f"worker-{index}",
+        )
+        process.start()
+        processes.append(process)
+
+    logging.info(f"Shard map ({workers} workers):")
+    for index, process in enumerate(processes):
+        logging.info(
+            f"  worker {index} (pid {process.pid}): chats with id % {workers} == {index}"
+        )
+
+    # docker stops the bot with SIGTERM
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    loop = asyncio.get_event_loop()
+
+    try:
+        if webhook_path is not None:
+            loop.run_until_complete(
+                _listen(dp, queues, on_startup, webhook_path, host, port)
+            )
+        else:
+            loop.run_until_complete(_poll(dp, queues, on_startup))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        logging.info("Stopping the workers")
+
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join()
+
+        loop.run_until_complete(dp.storage.close())
+        loop.run_until_complete(dp.bot.session.close())
@@ -0,0 +1,319 @@
+"""
+A pool of long-lived headless LibreOffice (soffice) instances used for
+converting Word documents to PDF.
+Starting LibreOffice takes several seconds, so instead of launching a new
+process for every document, a few instances are kept running and the
+documents are sent to them over a local socket (through utils/uno_bridge.py).
+Every instance has its own user profile, so they don't step on each other.
+Instances that crash, grow too big or have done too many jobs are restarted.
+The instances are started in the background when the bot starts (the
+conversions wait for the first one that's ready). If LibreOffice isn't
+installed, the bot still runs fine, only Word conversions fail.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from os.path import basename, splitext
+from typing import List, Optional
+
+from data import config
+from utils.metrics import stage_seconds
+
+# every instance keeps its LibreOffice user profile in here
+profiles_path = os.path.join(os.getcwd(), "user_files", "soffice")
+
+bridge_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uno_bridge.py")
+
+
+def _rss(pid: str) -> int:
+    """The resident memory of a process in bytes (0 if it's gone)."""
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def _children(pid: str) -> Optional[List[str]]:
+    """
+    The child processes of a process, None if the kernel doesn't list them
+    (it needs CONFIG_PROC_CHILDREN).
+    """
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+
+    children = []
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as file:
+                children += file.read().split()
+        except FileNotFoundError:
+            if not os.path.exists(f"/proc/{pid}/task/{task}"):
+                # the thread has just exited
+                continue
+            return None
+        except OSError:
+            continue
+
+    return children
+
+
+def _session_rss(session_id: int) -> int:
+    """
+    Returns the resident memory (in MB) of all the processes in a session.
+    soffice is a wrapper script that spawns the real soffice.bin process,
+    so looking only at the process we started is not enough.
+    The session is started by the process with the same id, so only its
+    process tree is read (the whole /proc only if the kernel doesn't list
+    the children). Blocks, so it's run in an executor.
+    Works only on Linux, returns 0 anywhere else.
+    """
+    if not sys.platform.startswith("linux"):
+        return 0
+
+    total = 0
+    pids = [str(session_id)]
+
+    while pids:
+        pid = pids.pop()
+        children = _children(pid)
+
+        if children is None:
+            return _scan_session_rss(session_id)
+
+        total += _rss(pid)
+        pids += children
+
+    return total // (1024 * 1024)
+
+
+def _scan_session_rss(session_id: int) -> int:
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{pid}/stat") as stat:
+                # the process name is in parentheses and may contain spaces
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+
+        # fields[3] is the session id and fields[21] is the rss in pages
+        if int(fields[3]) == session_id:
+            total += int(fields[21]) * page_size
+
+    return total // (1024 * 1024)
+
+
+class SofficeInstance:
+    """One headless soffice process plus the bridge that talks to it."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.port = config.SOFFICE_BASE_PORT + index
+        self.profile = os.path.join(profiles_path, f"profile_{index}")
+        self.office: Optional[asyncio.subprocess.Process] = None
+        self.bridge: Optional[asyncio.subprocess.Process] = None
+        self.jobs_done = 0
+
+    async def start(self):
+        """Raises OSError if soffice or the UNO python can't be started."""
+        os.makedirs(self.profile, exist_ok=True)
+
+        # a new session is started so that the whole process group
+        # (including soffice.bin) can be killed later on
+        self.office = await asyncio.create_subprocess_exec(
+            config.SOFFICE_BINARY,
+            "--headless",
+            "--invisible",
+            "--nologo",
+            "--nodefault",
+            "--norestore",
+            "--nolockcheck",
+            f"-env:UserInstallation=file://{self.profile}",
+            f"--accept=socket,host=127.0.0.1,port={self.port};urp;"
+            "StarOffice.ComponentContext",
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+        self.bridge = await asyncio.create_subprocess_exec(
+            config.UNO_PYTHON,
+            bridge_script,
+            str(self.port),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+
+        self.jobs_done = 0
+        logging.info(f"LibreOffice instance {self.index} started on port {self.port}")
+
+    async def stop(self):
+        if self.bridge and self.bridge.returncode is None:
+            self.bridge.kill()
+            await self.bridge.wait()
+
+        if self.office and self.office.returncode is None:
+            try:
+                os.killpg(self.office.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await self.office.wait()
+
+        self.office = self.bridge = None
+
+    async def restart(self):
+        if self.office is not None:
+            logging.info(f"Restarting LibreOffice instance {self.index}")
+        await self.stop()
+        await self.start()
+
+    async def needs_restart(self) -> bool:
+        """
+        Checks if the instance has crashed, has done too many jobs or
+        uses too much memory (or hasn't been started yet).
+        """
+        if self.office is None or self.bridge is None:
+            return True
+        if self.office.returncode is not None or self.bridge.returncode is not None:
+            return True
+        if self.jobs_done >= config.SOFFICE_MAX_JOBS:
+            return True
+
+        rss = await asyncio.get_event_loop().run_in_executor(
+            None, _session_rss, self.office.pid
+        )
+        return rss > config.SOFFICE_MAX_RSS_MB
+
+    async def prepare(self) -> bool:
+        """
+        (Re)starts the instance if it needs it.
+        Returns False if it can't be started.
+        """
+        if not await self.needs_restart():
+            return True
+
+        try:
+            await self.restart()
+        except OSError:
+            logging.exception(f"Couldn't start LibreOffice instance {self.index}")
+            await self.stop()
+            return False
+
+        return True
+
+    async def convert(self, src: str, dst: str) -> bool:
+        """
+        Sends the job to the bridge and waits for the answer.
+        Raises ConnectionError if the bridge is gone.
+        """
+        job = json.dumps({"src": src, "dst": dst}) + "\n"
+        self.bridge.stdin.write(job.encode())
+        await self.bridge.stdin.drain()
+
+        line = await asyncio.wait_for(
+            self.bridge.stdout.readline(), config.SOFFICE_TIMEOUT
+        )
+        if not line:
+            raise ConnectionError("LibreOffice bridge exited")
+
+        self.jobs_done += 1
+        reply = json.loads(line)
+
+        if not reply["ok"]:
+            logging.error(f"LibreOffice failed to convert {src}: {reply['error']}")
+
+        return reply["ok"]
+
+
+class SofficePool:
+    """Hands out idle LibreOffice instances to conversion jobs."""
+
+    def __init__(self, size: int, first_index: int = 0):
+        # the index decides the port and the profile of an instance, so
+        # pools of different worker processes get different indexes
+        self.instances: List[SofficeInstance] = [
+            SofficeInstance(index) for index in range(first_index, first_index + size)
+        ]
+        # created by start() so that it belongs to the running loop
+        self._idle: Optional[asyncio.Queue] = None
+        self._starting: List[asyncio.Task] = []
+
+    @property
+    def size(self) -> int:
+        return len(self.instances)
+
+    def start(self):
+        """
+        Starts the instances in the background, each one is handed out
+        once it's up (or once it failed to start, then the conversions
+        try again and fail on their own).
+        """
+        self._idle = asyncio.Queue()
+        self._starting = [
+            asyncio.ensure_future(self._start(instance)) for instance in self.instances
+        ]
+
+    async def _start(self, instance: SofficeInstance):
+        try:
+            await instance.prepare()
+        finally:
+            self._idle.put_nowait(instance)
+
+    async def close(self):
+        for task in self._starting:
+            task.cancel()
+        self._starting = []
+
+        for instance in self.instances:
+            await instance.stop()
+        self._idle = None
+
+    async def convert(self, src: str, out_dir: str) -> Optional[str]:
+        """
+        Converts a Word document to PDF using the first idle instance.
+        Returns the path of the PDF or None if the conversion failed.
+        The instance is (re)started here if it crashed, grew too big, etc.
+        """
+        if not self.instances:
+            logging.error("The LibreOffice pool is empty (SOFFICE_POOL_SIZE=0)")
+            return None
+
+        # the pool wasn't started (e.g. a script using it on its own)
+        if self._idle is None:
+            self.start()
+
+        dst = os.path.join(out_dir, splitext(basename(src))[0] + ".pdf")
+
+        instance = await self._idle.get()
+        try:
+            if not await instance.prepare():
+                return None
+
+            try:
+                with stage_seconds.time(stage="soffice"):
+                    converted = await instance.convert(src, dst)
+            except (asyncio.TimeoutError, ConnectionError, ValueError):
+                logging.exception(f"LibreOffice instance {instance.index} failed")
+                # started again by the next conversion
+                await instance.stop()
+                converted = False
+        finally:
+            self._idle.put_nowait(instance)
+
+        return dst if converted else None
+
+
+soffice_pool = SofficePool(
+    config.SOFFICE_POOL_SIZE, first_index=config.SHARD * config.SOFFICE_POOL_SIZE
+)
@@ -0,0 +1,269 @@
+"""
+Does the merging work ahead of time, while the user is still sending files
+(or reading the list, or typing the name of the merged file).
+
+Every PDF is checked (and its pages counted) in the background right after
+it's downloaded, so the broken ones are pointed out right away and the list
+of files shows the page counts. Once the list hasn't changed for a moment,
+the files are merged in the background in the order of the list. If the list
+is still the same when the user names the file, that result is sent instead
+of merging everything from scratch.
+
+The checks and the merges only use the slots of the PDF engine that no job
+of the queue needs (see JobQueue.background_slot). A merge is stopped as
+soon as a job needs its slot, or the list changes, instead of finishing
+work nobody is going to use.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.dispatcher import FSMContext
+from aiogram.utils.markdown import quote_html
+from data import config
+from loader import bot, output_path
+from utils.job_queue import job_queue
+from utils.merge_manifest import file_path, get_files, set_pages
+from utils.pdf_engine import compact_output, run_pdf_job
+from utils.pdf_ops import CountPagesJob, JobStoppedError, MergeJob, PdfJobError
+
+
+class _Merge:
+    def __init__(self, key: Tuple[str, ...], path: str):
+        # the ids of the files, in the order they were merged
+        self.key = key
+        self.path = path
+        # the merge is given up once this file exists (see MergeJob.stop_file)
+        self.stop_file = path + ".stop"
+        # whether it got a slot of the PDF engine (it waits for one until then)
+        self.started = False
+        # returns the bytes saved by MergeJob
+        self.task: Optional[asyncio.Future] = None
+
+
+# chat id -> the timer of the next speculative merge
+_timers: Dict[int, asyncio.TimerHandle] = {}
+# chat id -> the latest speculative merge
+_merges: Dict[int, _Merge] = {}
+# the checks running in the background (so they don't get garbage collected)
+_tasks = set()
+
+
+def _key(files: List[dict]) -> Tuple[str, ...]:
+    return tuple(file["id"] for file in files)
+
+
+def check_files(state: FSMContext, chat_id: int, entries: List[dict]):
+    """
+    Checks the new files of the list in the background,
+    then schedules a speculative merge.
+    """
+    task = asyncio.ensure_future(_check_files(state, chat_id, entries))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def _check_file(state: FSMContext, chat_id: int, entry: dict):
+    path = file_path(chat_id, entry)
+
+    try:
+        async with job_queue.background_slot("pdf"):
+            # merging was cancelled (or is over) while it waited
+            if not os.path.exists(path):
+                return
+
+            pages = await run_pdf_job(CountPagesJob(path))
+    except Exception as err:
+        logging.info(f"A file to merge can't be read: {err!r}")
+
+        files = await set_pages(state, chat_id, entry["id"], None)
+
+        # the file may not be in the list anymore (e.g. merging was cancelled)
+        if files is not None:
+            if isinstance(err, PdfJobError):
+                reason = str(err)
+            else:
+                reason = "seems to be broken"
+            await bot.send_message(
+                chat_id,
+                f"{quote_html(entry['name'])} {reason}, "
+                "so I took it off the list of files to merge.",
+            )
+    else:
+        await set_pages(state, chat_id, entry["id"], pages)
+
+
+async def _check_files(state: FSMContext, chat_id: int, entries: List[dict]):
+    await asyncio.gather(*(_check_file(state, chat_id, entry) for entry in entries))
+
+    # the list is empty if merging was cancelled or is over
+    schedule(chat_id, await get_files(state))
+
+
+def schedule(chat_id: int, files: List[dict], delay: Optional[float] = None):
+    """
+    Merges the files in the background once the list hasn't changed for
+    SPECULATIVE_MERGE_DELAY_MS (or for `delay` seconds).
+    """
+    if config.SPECULATIVE_MERGE_DELAY_MS < 0:
+        return
+
+    if delay is None:
+        delay = config.SPECULATIVE_MERGE_DELAY_MS / 1000
+
+    timer = _timers.pop(chat_id, None)
+    if timer is not None:
+        timer.cancel()
+
+    if len(files) > 1:
+        _timers[chat_id] = asyncio.get_event_loop().call_later(
+            delay, _start, chat_id, list(files)
+        )
+
+
+def _stop(merge: _Merge):
+    try:
+        open(merge.stop_file, "w").close()
+    except OSError:
+        # the files were cleaned up, so the merge fails anyway
+        pass
+
+
+def _discard(merge: _Merge):
+    """
+    Stops the merge (without waiting for it) and deletes its result
+    once it's done.
+    """
+    if merge.started:
+        _stop(merge)
+    else:
+        merge.task.cancel()
+
+    def delete(_):
+        for file in (merge.path, merge.stop_file):
+            try:
+                os.unlink(file)
+            except OSError:
+                pass
+
+    merge.task.add_done_callback(delete)
+
+
+def _log_failure(task: asyncio.Future):
+    if task.cancelled():
+        return
+
+    if isinstance(task.exception(), JobStoppedError):
+        logging.info("Speculative merge stopped")
+    elif task.exception() is not None:
+        logging.info(f"Speculative merge failed: {task.exception()!r}")
+
+
+async def _merge(merge: _Merge, inputs: List[str]) -> int:
+    async with job_queue.background_slot("pdf") as stop:
+        merge.started = True
+        logging.info(f"Speculative merge of {len(inputs)} files started")
+
+        job = asyncio.ensure_future(
+            run_pdf_job(
+                MergeJob(
+                    inputs,
+                    merge.path,
+                    compact=compact_output(*inputs),
+                    stop_file=merge.stop_file,
+                )
+            )
+        )
+        stopped = asyncio.ensure_future(stop.wait())
+
+        try:
+            await asyncio.wait([job, stopped], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopped.cancel()
+
+        if not job.done():
+            # a job of the queue needs the slot
+            _stop(merge)
+
+        # the slot is given back only once the worker is done with the merge
+        return await job
+
+
+def _start(chat_id: int, files: List[dict]):
+    _timers.pop(chat_id, None)
+
+    key = _key(files)
+    current = _merges.get(chat_id)
+    if (
+        current is not None
+        and current.key == key
+        and (not current.task.done() or os.path.exists(current.path))
+    ):
+        # merged (or being merged) already
+        return
+
+    inputs = [file_path(chat_id, file) for file in files]
+    if not all(os.path.exists(file) for file in inputs):
+        # the files were cleaned up in the meantime
+        return
+
+    # kept in the user's output directory, so it's deleted along with the
+    # files once they are done (and the handlers that take the first file
+    # of the input directory never see a half-written merge)
+    path = os.path.join(output_path, str(chat_id), f"merged_{uuid.uuid4().hex}.pdf")
+
+    if current is not None:
+        _discard(current)
+
+    merge = _Merge(key, path)
+    merge.task = asyncio.ensure_future(_merge(merge, inputs))
+    merge.task.add_done_callback(_log_failure)
+
+    _merges[chat_id] = merge
+
+
+async def merged(chat_id: int, files: List[dict]) -> Optional[Tuple[str, int]]:
+    """
+    If these files were merged in the background in this order, returns the
+    path of the result and the bytes MergeJob saved, otherwise None.
+    Waits for the merge if it's still running (the ones that are still
+    waiting for a slot are dropped, the job of the user waits in the queue
+    like everybody else's).
+    """
+    timer = _timers.pop(chat_id, None)
+    if timer is not None:
+        timer.cancel()
+
+    merge = _merges.pop(chat_id, None)
+    if merge is None:
+        return None
+
+    if merge.key != _key(files) or not merge.started:
+        _discard(merge)
+        return None
+
+    try:
+        saved = await merge.task
+    except Exception:
+        # merging from scratch lets the user know what went wrong
+        _discard(merge)
+        return None
+
+    if not os.path.exists(merge.path):
+        return None
+
+    logging.info("Using the speculative merge")
+    return merge.path, saved
+
+
+def forget(chat_id: int):
+    """Stops and throws away the speculative merge of the user."""
+    timer = _timers.pop(chat_id, None)
+    if timer is not None:
+        timer.cancel()
+
+    merge = _merges.pop(chat_id, None)
+    if merge is not None:
+        _discard(merge)
@@ -0,0 +1,21 @@
+"""
+The decorator for telling the throttling middleware (middlewares/throttling.py)
+how expensive a handler is.
+"""
+
+
+def rate_limit(cost: float, operation: str):
+    """
+    Every chat has a limited number of tokens that refill over time, and every
+    handler call takes `cost` of them. The handlers of the same `operation`
+    also share a smaller bucket of their own, so one operation can't take up
+    the whole budget of a chat. Handlers without this decorator cost 1 token
+    and their operation is the name of the handler.
+    """
+
+    def decorator(func):
+        setattr(func, "throttling_cost", cost)
+        setattr(func, "throttling_operation", operation)
+        return func
+
+    return decorator
@@ -0,0 +1,84 @@
+"""
+A tiny helper that is run by the LibreOffice pool (utils/soffice_pool.py).
+It has to be run with a Python interpreter that has the LibreOffice UNO
+bindings (on Debian that's /usr/bin/python3 with the python3-uno package),
+which is why it doesn't import anything from the bot itself.
+
+It connects to an already running headless soffice instance and then reads
+conversion jobs from stdin, one JSON object per line:
+    {"src": "/path/to/file.docx", "dst": "/path/to/file.pdf"}
+and answers every job with a single line on stdout:
+    {"ok": true} or {"ok": false, "error": "..."}
+"""
+import json
+import sys
+import time
+
+import uno
+from com.sun.star.beans import PropertyValue
+from com.sun.star.connection import NoConnectException
+
+# how long to wait for a freshly started soffice to start accepting connections
+CONNECT_TIMEOUT = 60
+
+
+def prop(name, value):
+    property_value = PropertyValue()
+    property_value.Name = name
+    property_value.Value = value
+    return property_value
+
+
+def connect(port):
+    local_context = uno.getComponentContext()
+    resolver = local_context.ServiceManager.createInstanceWithContext(
+        "com.sun.star.bridge.UnoUrlResolver", local_context
+    )
+    url = f"uno:socket,host=127.0.0.1,port={port};urp;StarOffice.ComponentContext"
+
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while True:
+        try:
+            context = resolver.resolve(url)
+            break
+        except NoConnectException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+    return context.ServiceManager.createInstanceWithContext(
+        "com.sun.star.frame.Desktop", context
+    )
+
+
+def convert(desktop, src, dst):
+    document = desktop.loadComponentFromURL(
+        uno.systemPathToFileUrl(src), "_blank", 0, (prop("Hidden", True),)
+    )
+    try:
+        document.storeToURL(
+            uno.systemPathToFileUrl(dst), (prop("FilterName", "writer_pdf_Export"),)
+        )
+    finally:
+        document.close(True)
+
+
+def main():
+    desktop = connect(int(sys.argv[1]))
+
+    for line in sys.stdin:
+        job = json.loads(line)
+
+        try:
+            convert(desktop, job["src"], job["dst"])
+        except Exception as err:
+            reply = {"ok": False, "error": str(err)}
+        else:
+            reply = {"ok": True}
+
+        sys.stdout.write(json.dumps(reply) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()